@@ -0,0 +1,241 @@
+"""Local stand-ins for the OpenAI and Telegram Bot APIs used by the benchmarks."""
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(__file__), 'recordings', 'completions.jsonl')
+
+# 1x1 transparent PNG served for generated images
+TINY_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082'
+)
+
+def load_recordings(path=RECORDINGS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response (e.g. at shutdown) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class FakeServer:
+    def __init__(self, handler_class):
+        self.server = QuietHTTPServer(('127.0.0.1', 0), handler_class)
+        self.server.owner = self
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def record_call(self, name):
+        with self.calls_lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Keep-alive responses are small; without this, delayed ACKs add ~40ms per call
+    disable_nagle_algorithm = True
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_event_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def send_event(self, payload):
+        data = b'data: ' + (payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode('utf-8')) + b'\n\n'
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def end_event_stream(self):
+        self.send_event(b'[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeOpenAIHandler(JSONRequestHandler):
+    def do_POST(self):
+        fake = self.server.owner
+        body = self.read_body()
+        request = json.loads(body) if body else {}
+        if self.path.endswith('/chat/completions'):
+            fake.record_call('chat.completions')
+            fake.handle_completion(self, request)
+        elif self.path.endswith('/images/generations'):
+            fake.record_call('images.generate')
+            fake.sleep(request.get('model'))
+            self.send_json({'created': int(time.time()), 'data': [{'url': f"{fake.url}/images/generated.png"}]})
+        else:
+            self.send_json({'error': {'message': f"unknown path {self.path}"}}, status=404)
+
+    def do_GET(self):
+        self.server.owner.record_call('image.download')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(TINY_PNG)))
+        self.end_headers()
+        self.wfile.write(TINY_PNG)
+
+class FakeOpenAIServer(FakeServer):
+    """Replays recorded completions with configurable latency and failure injection.
+
+    latency_ms and jitter_ms apply to every call; model_latency_ms overrides the
+    base latency for specific model names. failure_rate is the share of calls
+    answered with HTTP 500. Streamed completions spend the same latency spread
+    evenly across their chunks.
+    """
+
+    def __init__(self, recordings=None, latency_ms=0, jitter_ms=0, failure_rate=0.0, model_latency_ms=None, seed=0):
+        super().__init__(FakeOpenAIHandler)
+        self.recordings = recordings or load_recordings()
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.model_latency_ms = model_latency_ms or {}
+        self.random = random.Random(seed)
+        self.counter = itertools.count()
+
+    def latency(self, model=None):
+        latency = self.model_latency_ms.get(model, self.latency_ms)
+        if self.jitter_ms:
+            latency += self.random.uniform(0, self.jitter_ms)
+        return latency / 1000
+
+    def sleep(self, model=None):
+        latency = self.latency(model)
+        if latency:
+            time.sleep(latency)
+
+    def next_completion(self, request=None):
+        # Batched prompts ("Generate 5 different ...") get that many recordings joined by separators
+        prompt = ''.join(message.get('content', '') for message in (request or {}).get('messages', []))
+        match = re.search(r'Generate (\d+) different', prompt)
+        count = int(match.group(1)) if match else 1
+        content = '\n---\n'.join(self.recordings[next(self.counter) % len(self.recordings)]['content'] for _ in range(count))
+        if '[Hindi]' in prompt:
+            # Bilingual prompt: the recording, marked as a translation, stands in for the Hindi version
+            content = f"[English]\n{content}\n[Hindi]\n{content.replace('Question:', 'Question: (हिंदी)', 1)}"
+        return content
+
+    def handle_completion(self, handler, request):
+        streaming = request.get('stream')
+        latency = self.latency(request.get('model'))
+        if not streaming and latency:
+            time.sleep(latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.record_call('failure')
+            handler.send_json({'error': {'message': 'injected failure', 'type': 'server_error'}}, status=500)
+            return
+        content = self.next_completion(request)
+        completion_tokens = max(1, len(content) // 4)
+        usage = {'prompt_tokens': 400, 'completion_tokens': completion_tokens, 'total_tokens': 400 + completion_tokens}
+        base = {'id': f"chatcmpl-fake-{time.time_ns()}", 'created': int(time.time()), 'model': request.get('model', 'gpt-4')}
+        if not streaming:
+            handler.send_json(dict(base, object='chat.completion', usage=usage, choices=[
+                {'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}]))
+            return
+        
+        # Word-sized pieces stand in for tokens
+        pieces = re.findall(r'\S+\s*|\s+', content)
+        handler.start_event_stream()
+        for piece in pieces:
+            if latency:
+                time.sleep(latency / len(pieces))
+            handler.send_event(dict(base, object='chat.completion.chunk', choices=[
+                {'index': 0, 'finish_reason': None, 'delta': {'content': piece}}]))
+        handler.send_event(dict(base, object='chat.completion.chunk', choices=[
+            {'index': 0, 'finish_reason': 'stop', 'delta': {}}]))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            handler.send_event(dict(base, object='chat.completion.chunk', choices=[], usage=usage))
+        handler.end_event_stream()
+
+class FakeTelegramHandler(JSONRequestHandler):
+    def do_POST(self):
+        fake = self.server.owner
+        body = self.read_body()
+        method = self.path.rsplit('/', 1)[-1]
+        fake.record_call(method)
+        if method == 'sendMessage' and fake.failure_texts and fake.message_text(body) in fake.failure_texts:
+            fake.record_call('failure_reply')
+        fake.sleep()
+        self.send_json({'ok': True, 'result': fake.result_for(method)})
+
+    do_GET = do_POST
+
+class FakeTelegramServer(FakeServer):
+    """Minimal Bot API: every method succeeds and returns a plausible result object.
+
+    Messages whose text is in failure_texts (e.g. the bot's "service unavailable"
+    reply) are counted as 'failure_reply' calls, so load tests can see failures
+    the bot handled itself.
+    """
+
+    def __init__(self, latency_ms=0, failure_texts=()):
+        super().__init__(FakeTelegramHandler)
+        self.latency_ms = latency_ms
+        self.failure_texts = set(failure_texts)
+        self.message_ids = itertools.count(1)
+        self.poll_ids = itertools.count(1)
+
+    @staticmethod
+    def message_text(body):
+        # The Bot API accepts JSON and form-encoded parameters
+        try:
+            return json.loads(body).get('text')
+        except (ValueError, AttributeError):
+            return (parse_qs(body.decode('utf-8', 'replace')).get('text') or [None])[0]
+
+    def sleep(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def result_for(self, method):
+        if method == 'getMe':
+            return {'id': 1000, 'is_bot': True, 'first_name': 'BenchBot', 'username': 'bench_bot',
+                    'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if method == 'sendPoll':
+            return {'message_id': next(self.message_ids), 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'},
+                    'poll': {'id': f"poll-{next(self.poll_ids)}", 'question': 'Quiz', 'total_voter_count': 0,
+                             'options': [{'text': letter, 'voter_count': 0} for letter in 'ABCD'],
+                             'is_closed': False, 'is_anonymous': False, 'type': 'quiz', 'allows_multiple_answers': False}}
+        if method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            return {'message_id': next(self.message_ids), 'date': int(time.time()),
+                    'chat': {'id': 1, 'type': 'private'}, 'text': ''}
+        return True
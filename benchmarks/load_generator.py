@@ -0,0 +1,190 @@
+"""Synthetic load generator: ramps simulated users until latency SLOs break.
+
+Each simulated chat loops over a weighted mix of /question, answers, /stats and
+settings callbacks with exponential think times. Updates go through
+Application.process_update against the local fakes; a semaphore sized like the
+application's concurrent_updates setting reproduces the real dispatch, so the
+measured latency includes time spent queued behind other updates.
+
+An update counts as an error when its handler raised (the application's error
+handlers see it, process_update does not re-raise) or when the bot answered
+with a failure reply such as "questions are temporarily unavailable".
+
+Usage:
+    python -m benchmarks.load_generator --start-users 10 --max-users 2000 --stage-seconds 20 --slo-p95-ms 3000
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+
+from benchmarks import updates
+from benchmarks.fake_servers import FakeOpenAIServer, FakeTelegramServer
+from benchmarks.run_benchmarks import BOT_TOKEN, load_bot, parse_model_latency, percentile
+
+ACTION_WEIGHTS = {'question': 0.30, 'answer': 0.35, 'stats': 0.10, 'settings': 0.25}
+SETTINGS_FLOWS = [
+    ['settings_topic', 'topic_General Science'],
+    ['settings_difficulty', 'difficulty_Easy'],
+    ['settings_language', 'language_English'],
+    ['settings_topic', 'topic_General Mathematics', 'topic_math_subtopic_Percentages'],
+]
+
+class StageStats:
+    def __init__(self, failure_replies=0):
+        self.latencies = []
+        self.errors = 0
+        # Fake Telegram's failure reply count when the stage started
+        self.failure_replies = failure_replies
+
+class LoadGenerator:
+    def __init__(self, bot, app, args, telegram_server):
+        self.bot = bot
+        self.app = app
+        self.args = args
+        self.telegram_server = telegram_server
+        self.random = random.Random(args.seed)
+        self.dispatch = asyncio.Semaphore(args.concurrency or max(1, app.concurrent_updates))
+        self.stats = StageStats()
+        self.running = True
+        app.add_error_handler(self.on_error)
+
+    async def on_error(self, update, context):
+        self.stats.errors += 1
+
+    def failure_replies(self):
+        return self.telegram_server.calls.get('failure_reply', 0)
+
+    async def send(self, update):
+        started = time.perf_counter()
+        try:
+            async with self.dispatch:
+                await self.app.process_update(update)
+        except Exception:
+            self.stats.errors += 1
+        finally:
+            self.stats.latencies.append(time.perf_counter() - started)
+
+    def think_time(self):
+        return self.random.expovariate(1000 / self.args.think_ms)
+
+    async def simulate_user(self, chat_id):
+        bot = self.app.bot
+        await self.send(updates.message_update(bot, chat_id, '/start'))
+        has_question = False
+        actions, weights = zip(*ACTION_WEIGHTS.items())
+        while self.running:
+            await asyncio.sleep(self.think_time())
+            action = self.random.choices(actions, weights)[0]
+            if action == 'answer' and not has_question:
+                action = 'question'
+            if action == 'question':
+                await self.send(updates.message_update(bot, chat_id, '/question'))
+                has_question = True
+            elif action == 'answer':
+                await self.send(updates.message_update(bot, chat_id, self.random.choice('ABCD')))
+                has_question = False
+            elif action == 'stats':
+                await self.send(updates.message_update(bot, chat_id, '/stats'))
+            else:
+                for data in self.random.choice(SETTINGS_FLOWS):
+                    await self.send(updates.callback_update(bot, chat_id, data))
+
+    async def run_stage(self, users, tasks):
+        # Users persist across stages; only the newly added ones are started
+        for chat_id in range(len(tasks), users):
+            tasks.append(asyncio.create_task(self.simulate_user(500000 + chat_id)))
+        self.stats = StageStats(self.failure_replies())
+        started = time.perf_counter()
+        await asyncio.sleep(self.args.stage_seconds)
+        elapsed = time.perf_counter() - started
+        stats = self.stats
+        completed = len(stats.latencies)
+        errors = stats.errors + self.failure_replies() - stats.failure_replies
+        return {
+            'users': users,
+            'updates': completed,
+            'throughput_per_s': completed / elapsed,
+            'p50_ms': percentile(stats.latencies, 0.50) * 1000,
+            'p95_ms': percentile(stats.latencies, 0.95) * 1000,
+            'p99_ms': percentile(stats.latencies, 0.99) * 1000,
+            'error_rate': min(1.0, errors / completed) if completed else 0.0
+        }
+
+    def meets_slo(self, result):
+        return (result['updates'] > 0 and result['p95_ms'] <= self.args.slo_p95_ms
+                and result['error_rate'] <= self.args.slo_error_rate)
+
+    async def ramp(self):
+        tasks = []
+        results = []
+        users = self.args.start_users
+        try:
+            while users <= self.args.max_users:
+                result = await self.run_stage(users, tasks)
+                result['slo_ok'] = self.meets_slo(result)
+                results.append(result)
+                print_stage(result)
+                if not result['slo_ok']:
+                    break
+                users = int(users * self.args.ramp_factor) + 1
+        finally:
+            self.running = False
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return results
+
+def print_stage(result):
+    status = 'ok' if result['slo_ok'] else 'SLO BROKEN'
+    print(f"{result['users']:>7} users {result['updates']:>8} updates {result['throughput_per_s']:>8.1f}/s "
+          f"p50 {result['p50_ms']:>8.1f}ms p95 {result['p95_ms']:>8.1f}ms p99 {result['p99_ms']:>8.1f}ms "
+          f"errors {result['error_rate'] * 100:>5.1f}%  {status}")
+
+async def run(args):
+    openai_server = FakeOpenAIServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, failure_rate=args.failure_rate,
+                                     model_latency_ms=parse_model_latency(args.model_latency), seed=args.seed).start()
+    telegram_server = FakeTelegramServer(latency_ms=args.telegram_latency_ms).start()
+    bot = load_bot(openai_server.url, telegram_server.url, tempfile.mkdtemp(prefix='mcq-load-'))
+    telegram_server.failure_texts = {texts[key] for texts in bot.interface_texts.values() for key in ('service_unavailable', 'question_withdrawn')}
+    app = bot.build_application(token=BOT_TOKEN, base_url=telegram_server.url)
+    await app.initialize()
+    try:
+        results = await LoadGenerator(bot, app, args, telegram_server).ramp()
+    finally:
+        await app.shutdown()
+        openai_server.stop()
+        telegram_server.stop()
+
+    passing = [result for result in results if result['slo_ok']]
+    if not passing:
+        print("SLO was broken at the first stage; lower --start-users.")
+    elif results[-1]['slo_ok']:
+        print(f"No saturation up to {passing[-1]['users']} users ({passing[-1]['throughput_per_s']:.1f} updates/s).")
+    else:
+        print(f"Saturation point: {passing[-1]['users']} concurrent users, "
+              f"{passing[-1]['throughput_per_s']:.1f} updates/s within SLO "
+              f"(broke at {results[-1]['users']} users).")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--start-users', type=int, default=10)
+    parser.add_argument('--max-users', type=int, default=5000)
+    parser.add_argument('--ramp-factor', type=float, default=2.0)
+    parser.add_argument('--stage-seconds', type=float, default=20)
+    parser.add_argument('--think-ms', type=float, default=5000, help='mean think time between a user\'s actions')
+    parser.add_argument('--slo-p95-ms', type=float, default=3000)
+    parser.add_argument('--slo-error-rate', type=float, default=0.01)
+    parser.add_argument('--concurrency', type=int, default=0, help='override concurrent update processing (default: the app setting)')
+    parser.add_argument('--latency-ms', type=float, default=1500, help='fake OpenAI latency per call')
+    parser.add_argument('--jitter-ms', type=float, default=500)
+    parser.add_argument('--model-latency', action='append', metavar='MODEL=MS', help='per-model fake OpenAI latency (repeatable)')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency-ms', type=float, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+"""Offline benchmarks for the bot's real handlers.
+
+Runs manual_question (with and without streaming generation, and from templates), /quiz sessions, handle_answer, send_scheduled_questions and the settings
+callbacks through Application.process_update against local fake OpenAI and
+Telegram servers, and reports throughput, p50/p95/p99 latency, DB operations,
+LLM calls and peak traced memory per scenario.
+
+Usage:
+    python -m benchmarks.run_benchmarks --iterations 50 --latency-ms 200
+    python -m benchmarks.run_benchmarks --json baseline.json
+    python -m benchmarks.run_benchmarks --compare baseline.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fake_servers import FakeOpenAIServer, FakeTelegramServer
+from benchmarks import updates
+
+BOT_TOKEN = '123456:BENCHMARK'
+
+def load_bot(openai_url, telegram_url, workdir):
+    # The bot reads its configuration at import time
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': BOT_TOKEN,
+        'OPENAI_API_KEY': 'sk-benchmark',
+        'OPENAI_BASE_URL': f"{openai_url}/v1",
+        'TELEGRAM_API_BASE_URL': telegram_url,
+        'DB_PATH': os.path.join(workdir, 'bench.db'),
+        'STATE_DB_PATH': os.path.join(workdir, 'bench_state.db'),
+        'SCHEDULED_QUESTIONS': 'off',
+        'SCHEDULE_SLOTS': '1',
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    bot = importlib.import_module('patwari_mcq_bot')
+    bot.init_database()
+    return bot
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def db_ops(bot):
+    return bot.metric_counters.get(('mcq_db_ops_total', ()), 0)
+
+class Scenario:
+    name = None
+
+    def __init__(self, bot, app, iterations):
+        self.bot = bot
+        self.app = app
+        self.iterations = iterations
+
+    def setup(self):
+        pass
+
+    async def run(self, samples):
+        for i in range(self.iterations):
+            started = time.perf_counter()
+            await self.run_once(i)
+            samples.append(time.perf_counter() - started)
+
+    async def run_once(self, i):
+        raise NotImplementedError
+
+class ManualQuestionScenario(Scenario):
+    name = 'manual_question'
+
+    async def run_once(self, i):
+        # A fresh chat per iteration keeps the 5 second cooldown out of the measurement
+        await self.app.process_update(updates.message_update(self.app.bot, 100000 + i, '/question'))
+
+class StreamingQuestionScenario(Scenario):
+    """/question with STREAMING_GENERATION on; each sample is the time until the question text is formatted for sending."""
+    name = 'manual_question_streaming'
+
+    async def run(self, samples):
+        bot = self.bot
+        original_format = bot.format_question_message
+        original_streaming = bot.STREAMING_GENERATION
+        shown = []
+
+        def timed_format(question_data, texts):
+            shown.append(time.perf_counter())
+            return original_format(question_data, texts)
+
+        bot.format_question_message = timed_format
+        bot.STREAMING_GENERATION = True
+        try:
+            for i in range(self.iterations):
+                shown.clear()
+                started = time.perf_counter()
+                await self.app.process_update(updates.message_update(self.app.bot, 150000 + i, '/question'))
+                samples.append((shown[0] if shown else time.perf_counter()) - started)
+        finally:
+            bot.format_question_message = original_format
+            bot.STREAMING_GENERATION = original_streaming
+
+class TemplateQuestionScenario(Scenario):
+    """/question for a subtopic with templates and TEMPLATE_SHARE=1: served without an LLM call."""
+    name = 'template_question'
+
+    def setup(self):
+        for i in range(self.iterations):
+            chat_id = 170000 + i
+            self.bot.register_user(chat_id, None, 'Bench', None)
+            self.bot.update_user_preferences(chat_id, topic='General Mathematics', math_subtopic='Profit and Loss')
+
+    async def run(self, samples):
+        original_share = self.bot.TEMPLATE_SHARE
+        self.bot.TEMPLATE_SHARE = 1.0
+        try:
+            await super().run(samples)
+        finally:
+            self.bot.TEMPLATE_SHARE = original_share
+
+    async def run_once(self, i):
+        await self.app.process_update(updates.message_update(self.app.bot, 170000 + i, '/question'))
+
+class HandleAnswerScenario(Scenario):
+    name = 'handle_answer'
+
+    def setup(self):
+        question_id = self.bot.save_question_to_db('General Knowledge', 'Easy', 'Capital of MP?', 'C', 'Bhopal.', None,
+                                                   'A) Indore\nB) Gwalior\nC) Bhopal\nD) Jabalpur\n')
+        for i in range(self.iterations):
+            chat_id = 200000 + i
+            self.bot.register_user(chat_id, None, 'Bench', None)
+            self.bot.state_backend.set_active_question(chat_id, {
+                'question_id': question_id, 'question_text': 'Capital of MP?',
+                'options_text': 'A) Indore\nB) Gwalior\nC) Bhopal\nD) Jabalpur\n',
+                'correct_answer': 'C', 'explanation': 'Bhopal.', 'topic': 'General Knowledge',
+                'difficulty': 'Easy', 'math_subtopic': None, 'sent_at': time.time()
+            })
+
+    async def run_once(self, i):
+        answer = 'C' if i % 2 else 'A'
+        await self.app.process_update(updates.message_update(self.app.bot, 200000 + i, answer))
+
+class QuizSessionScenario(Scenario):
+    """A /quiz 5 session per iteration: the batch-prepared polls plus five poll answers ending the session."""
+    name = 'quiz_session'
+    questions = 5
+
+    async def run_once(self, i):
+        chat_id = 250000 + i
+        bot = self.app.bot
+        await self.app.process_update(updates.message_update(bot, chat_id, f"/quiz {self.questions}"))
+        # The benchmark runs with the in-memory state backend
+        poll_ids = [poll_id for poll_id, owner in list(self.bot.state_backend.quiz_polls.items()) if owner == chat_id]
+        for option, poll_id in enumerate(poll_ids):
+            await self.app.process_update(updates.poll_answer_update(bot, chat_id, poll_id, option % 4))
+
+class SettingsCallbacksScenario(Scenario):
+    name = 'settings_callbacks'
+    callbacks = ['settings_topic', 'topic_General Science', 'settings_difficulty', 'difficulty_Hard',
+                 'settings_language', 'language_Hindi', 'topic_General Mathematics',
+                 'topic_math_subtopic_Percentages', 'settings_stats']
+
+    def setup(self):
+        self.bot.register_user(300000, None, 'Bench', None)
+
+    async def run_once(self, i):
+        data = self.callbacks[i % len(self.callbacks)]
+        await self.app.process_update(updates.callback_update(self.app.bot, 300000, data))
+
+class ScheduledBroadcastScenario(Scenario):
+    """One broadcast cycle over `iterations` users; each user's send is one sample."""
+    name = 'send_scheduled_questions'
+
+    def setup(self):
+        for i in range(self.iterations):
+            self.bot.register_user(400000 + i, None, 'Bench', None)
+
+    async def run(self, samples):
+        bot = self.bot
+        original = bot.send_question_to_user
+
+        async def timed_send(context, chat_id):
+            started = time.perf_counter()
+            try:
+                return await original(context, chat_id)
+            finally:
+                samples.append(time.perf_counter() - started)
+
+        bot.send_question_to_user = timed_send
+        try:
+            await bot.send_scheduled_questions(self.app)
+        finally:
+            bot.send_question_to_user = original
+
+SCENARIOS = [ManualQuestionScenario, StreamingQuestionScenario, TemplateQuestionScenario, QuizSessionScenario, HandleAnswerScenario, SettingsCallbacksScenario, ScheduledBroadcastScenario]
+
+async def run_scenario(bot, app, openai_server, scenario_class, iterations):
+    scenario = scenario_class(bot, app, iterations)
+    scenario.setup()
+    ops_before = db_ops(bot)
+    llm_before = openai_server.calls.get('chat.completions', 0)
+    samples = []
+    tracemalloc.start()
+    started = time.perf_counter()
+    await scenario.run(samples)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    operations = len(samples) or 1
+    return {
+        'scenario': scenario.name,
+        'operations': len(samples),
+        'throughput_per_s': len(samples) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p95_ms': percentile(samples, 0.95) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'db_ops_per_op': (db_ops(bot) - ops_before) / operations,
+        'llm_calls_per_op': (openai_server.calls.get('chat.completions', 0) - llm_before) / operations,
+        'peak_memory_kb': peak / 1024
+    }
+
+async def run_all(args):
+    openai_server = FakeOpenAIServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, failure_rate=args.failure_rate,
+                                     model_latency_ms=parse_model_latency(args.model_latency), seed=args.seed).start()
+    telegram_server = FakeTelegramServer(latency_ms=args.telegram_latency_ms).start()
+    workdir = tempfile.mkdtemp(prefix='mcq-bench-')
+    bot = load_bot(openai_server.url, telegram_server.url, workdir)
+    app = bot.build_application(token=BOT_TOKEN, base_url=telegram_server.url)
+    await app.initialize()
+    results = []
+    try:
+        for scenario_class in SCENARIOS:
+            if args.scenario and scenario_class.name not in args.scenario:
+                continue
+            results.append(await run_scenario(bot, app, openai_server, scenario_class, args.iterations))
+    finally:
+        await app.shutdown()
+        openai_server.stop()
+        telegram_server.stop()
+    return results
+
+def parse_model_latency(values):
+    # ['gpt-4=2000', 'gpt-4o-mini=400'] -> {'gpt-4': 2000.0, 'gpt-4o-mini': 400.0}
+    return {model: float(ms) for model, ms in (value.split('=', 1) for value in values or [])}
+
+def print_results(results):
+    header = f"{'scenario':<26}{'ops':>6}{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db/op':>7}{'llm/op':>8}{'peak KB':>10}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<26}{r['operations']:>6}{r['throughput_per_s']:>9.1f}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}"
+              f"{r['p99_ms']:>9.1f}{r['db_ops_per_op']:>7.1f}{r['llm_calls_per_op']:>8.2f}{r['peak_memory_kb']:>10.0f}")
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {r['scenario']: r for r in json.load(f)}
+    regressions = []
+    for r in results:
+        base = baseline.get(r['scenario'])
+        if not base:
+            continue
+        if base['p95_ms'] and r['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{r['scenario']}: p95 {base['p95_ms']:.1f}ms -> {r['p95_ms']:.1f}ms")
+        if base['throughput_per_s'] and r['throughput_per_s'] < base['throughput_per_s'] * (1 - tolerance):
+            regressions.append(f"{r['scenario']}: throughput {base['throughput_per_s']:.1f}/s -> {r['throughput_per_s']:.1f}/s")
+        if r['db_ops_per_op'] > base['db_ops_per_op'] + 0.5:
+            regressions.append(f"{r['scenario']}: db ops/op {base['db_ops_per_op']:.1f} -> {r['db_ops_per_op']:.1f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=0, help='fake OpenAI latency per call')
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--model-latency', action='append', metavar='MODEL=MS', help='per-model fake OpenAI latency (repeatable)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of OpenAI calls that fail')
+    parser.add_argument('--telegram-latency-ms', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenario', action='append', help='run only the named scenario (repeatable)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='baseline results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+
+    results = asyncio.run(run_all(args))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Builders for the raw Telegram update payloads fed through Application.process_update."""
+import itertools
+import time
+
+from telegram import Update
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+def _user(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': f"User{chat_id}", 'username': f"user{chat_id}"}
+
+def _message(chat_id, text):
+    message = {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': _user(chat_id),
+        'text': text
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return message
+
+def message_payload(chat_id, text):
+    return {'update_id': next(update_ids), 'message': _message(chat_id, text)}
+
+def callback_payload(chat_id, data):
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)),
+            'from': _user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': _message(chat_id, 'settings')
+        }
+    }
+
+def poll_answer_payload(chat_id, poll_id, option):
+    return {'update_id': next(update_ids), 'poll_answer': {'poll_id': poll_id, 'user': _user(chat_id), 'option_ids': [option]}}
+
+def message_update(bot, chat_id, text):
+    return Update.de_json(message_payload(chat_id, text), bot)
+
+def callback_update(bot, chat_id, data):
+    return Update.de_json(callback_payload(chat_id, data), bot)
+
+def poll_answer_update(bot, chat_id, poll_id, option):
+    return Update.de_json(poll_answer_payload(chat_id, poll_id, option), bot)
@@ -3,12 +3,37 @@ import asyncio
 import sqlite3
 import datetime
 import random
+import math
 import re
+import json
+import time
 import threading
+import zoneinfo
+import functools
+import contextlib
+import contextvars
+import collections
+import cProfile
+import pstats
+import io
+import concurrent.futures
+import multiprocessing
+import argparse
+import hashlib
+import gzip
+import sys
+import atexit
+import queue
+import logging
+import logging.handlers
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.error
+import urllib.request
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, PollAnswerHandler, ContextTypes, filters
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from openai import OpenAI
+from openai.types import CompletionUsage
 from dotenv import load_dotenv
 from sympy import sympify
 import requests
@@ -19,45 +44,760 @@ load_dotenv()
 # Configuration
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+DB_PATH = os.getenv('DB_PATH', 'mcq_bot.db')
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv('ADMIN_CHAT_IDS', '').split(',') if chat_id.strip()}
+PORT = int(os.getenv('PORT', '8000'))
+
+# Scheduled questions: each interval is split into slots and every user is
+# hashed into one slot, so broadcasts run as small batches instead of one burst.
+# The slot uses chat_id // WORKER_COUNT, so it does not repeat a worker's shard
+# (chat_id % WORKER_COUNT) and each worker's users spread over every slot.
+SCHEDULED_QUESTIONS = os.getenv('SCHEDULED_QUESTIONS', 'on') == 'on'
+SCHEDULE_INTERVAL_MINUTES = int(os.getenv('SCHEDULE_INTERVAL_MINUTES', '30'))
+SCHEDULE_SLOTS = int(os.getenv('SCHEDULE_SLOTS', '30'))
+SCHEDULE_BATCH_SIZE = int(os.getenv('SCHEDULE_BATCH_SIZE', '10'))
+TIMEZONE = zoneinfo.ZoneInfo(os.getenv('TIMEZONE', 'Asia/Kolkata'))
 
 # Rate limiting and processing flags
-user_last_question_time = {}
-user_processing_questions = {}
-question_generation_lock = threading.Lock()
 QUESTION_COOLDOWN = 5
+INFLIGHT_TIMEOUT = 300
 
-def can_generate_question(chat_id):
-    current_time = datetime.datetime.now()
-    if chat_id not in user_last_question_time:
-        user_last_question_time[chat_id] = current_time
-        return True
-    time_diff = (current_time - user_last_question_time[chat_id]).total_seconds()
-    if time_diff >= QUESTION_COOLDOWN:
-        user_last_question_time[chat_id] = current_time
-        return True
-    return False
+# Shared state configuration (memory for a single process, sqlite for several workers on one host)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'mcq_state.db')
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '1'))
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', '0'))
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}"
+# With several workers, `route-webhook` listens on PORT and forwards every webhook update
+# to the worker that owns its chat (see update_shard); worker i listens on PORT + 1 + i
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', str(PORT + 1 + WORKER_INDEX if WORKER_COUNT > 1 else PORT)))
+ROUTER_UPSTREAM_HOST = os.getenv('ROUTER_UPSTREAM_HOST', '127.0.0.1')
+# Updates processed at once per worker; per-chat guards (cooldown, in-flight) keep one chat consistent
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))
+
+class MemoryStateBackend:
+    """Process-local coordination state.
+
+    Every backend exposes the same methods, so a Redis-compatible store only needs
+    to implement these (hash per table, SET NX EX for in-flight locks and leases).
+    """
+
+    def __init__(self):
+        self.active_questions = {}
+        self.last_question_time = {}
+        self.processing = {}
+        self.leases = {}
+        self.quiz_sessions = {}
+        self.quiz_polls = {}
+        self.lock = threading.Lock()
+
+    def get_active_question(self, chat_id):
+        return self.active_questions.get(chat_id)
+
+    def set_active_question(self, chat_id, question):
+        self.active_questions[chat_id] = question
+
+    def pop_active_question(self, chat_id):
+        return self.active_questions.pop(chat_id, None)
+
+    def try_start_question(self, chat_id, cooldown):
+        now = time.time()
+        with self.lock:
+            started = self.processing.get(chat_id)
+            if started is not None and now - started < INFLIGHT_TIMEOUT:
+                return False
+            if now - self.last_question_time.get(chat_id, 0) < cooldown:
+                return False
+            self.last_question_time[chat_id] = now
+            self.processing[chat_id] = now
+            return True
+
+    def finish_question(self, chat_id):
+        with self.lock:
+            self.processing.pop(chat_id, None)
+
+    def cooldown_remaining(self, chat_id, cooldown):
+        last = self.last_question_time.get(chat_id)
+        if last is None:
+            return 0
+        return max(0, cooldown - (time.time() - last))
+
+    def acquire_leadership(self, name, owner, ttl):
+        now = time.time()
+        with self.lock:
+            holder = self.leases.get(name)
+            if holder and holder[0] != owner and holder[1] > now:
+                return False
+            self.leases[name] = (owner, now + ttl)
+            return True
+
+    def start_quiz_session(self, chat_id, session):
+        with self.lock:
+            self._drop_quiz_session(chat_id)
+            # poll_count stays None while polls are still being sent
+            self.quiz_sessions[chat_id] = {'session': session, 'polls': {}, 'poll_count': None}
+
+    def add_quiz_poll(self, chat_id, poll_id, index, sent_at):
+        with self.lock:
+            entry = self.quiz_sessions.get(chat_id)
+            if entry is not None:
+                entry['polls'][poll_id] = {'index': index, 'sent_at': sent_at, 'chosen': None, 'answered_at': None}
+                self.quiz_polls[poll_id] = chat_id
+
+    def record_quiz_answer(self, poll_id, chosen, answered_at):
+        """Store a poll answer; returns (chat_id, answered, question_count) or None for unknown polls"""
+        with self.lock:
+            chat_id = self.quiz_polls.get(poll_id)
+            entry = self.quiz_sessions.get(chat_id)
+            if entry is None:
+                return None
+            poll = entry['polls'][poll_id]
+            if poll['chosen'] is None:
+                poll['chosen'] = chosen
+                poll['answered_at'] = answered_at
+            answered = sum(1 for p in entry['polls'].values() if p['chosen'] is not None)
+            return chat_id, answered, entry.get('poll_count') or len(entry['session']['questions'])
+    
+    def set_quiz_poll_count(self, chat_id, count):
+        """Record how many polls were actually sent; returns the answers so far, or None without a session"""
+        with self.lock:
+            entry = self.quiz_sessions.get(chat_id)
+            if entry is None:
+                return None
+            entry['poll_count'] = count
+            return sum(1 for p in entry['polls'].values() if p['chosen'] is not None)
+    
+    def expired_quiz_sessions(self, started_before):
+        with self.lock:
+            return [chat_id for chat_id, entry in self.quiz_sessions.items() if entry['session']['started_at'] < started_before]
+
+    def pop_quiz_session(self, chat_id):
+        """Remove a quiz session; returns (session, polls) or None"""
+        with self.lock:
+            entry = self._drop_quiz_session(chat_id)
+            return (entry['session'], list(entry['polls'].values())) if entry else None
+
+    def _drop_quiz_session(self, chat_id):
+        entry = self.quiz_sessions.pop(chat_id, None)
+        if entry:
+            for poll_id in entry['polls']:
+                self.quiz_polls.pop(poll_id, None)
+        return entry
+
+class SQLiteStateBackend:
+    """Coordination state shared by every worker process on one host."""
+
+    def __init__(self, path):
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS active_questions (chat_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, updated_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cooldowns (chat_id INTEGER PRIMARY KEY, last_question_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS inflight (chat_id INTEGER PRIMARY KEY, owner TEXT NOT NULL, started_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS quiz_sessions (chat_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, question_count INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS quiz_polls (poll_id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, question_index INTEGER NOT NULL, '
+                         'sent_at REAL NOT NULL, chosen TEXT, answered_at REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_quiz_polls_chat ON quiz_polls (chat_id)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Autocommit mode so BEGIN IMMEDIATE can take the write lock explicitly
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def get_active_question(self, chat_id):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT payload FROM active_questions WHERE chat_id = ?', (chat_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def set_active_question(self, chat_id, question):
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO active_questions (chat_id, payload, updated_at) VALUES (?, ?, ?)',
+                         (chat_id, json.dumps(question, ensure_ascii=False), time.time()))
+        finally:
+            conn.close()
+
+    def pop_active_question(self, chat_id):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT payload FROM active_questions WHERE chat_id = ?', (chat_id,)).fetchone()
+            if row:
+                conn.execute('DELETE FROM active_questions WHERE chat_id = ?', (chat_id,))
+            conn.execute('COMMIT')
+            return json.loads(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def try_start_question(self, chat_id, cooldown):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            inflight = conn.execute('SELECT started_at FROM inflight WHERE chat_id = ?', (chat_id,)).fetchone()
+            last = conn.execute('SELECT last_question_at FROM cooldowns WHERE chat_id = ?', (chat_id,)).fetchone()
+            if (inflight and now - inflight[0] < INFLIGHT_TIMEOUT) or (last and now - last[0] < cooldown):
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute('INSERT OR REPLACE INTO cooldowns (chat_id, last_question_at) VALUES (?, ?)', (chat_id, now))
+            conn.execute('INSERT OR REPLACE INTO inflight (chat_id, owner, started_at) VALUES (?, ?, ?)', (chat_id, WORKER_ID, now))
+            conn.execute('COMMIT')
+            return True
+        finally:
+            conn.close()
+
+    def finish_question(self, chat_id):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM inflight WHERE chat_id = ?', (chat_id,))
+        finally:
+            conn.close()
+
+    def cooldown_remaining(self, chat_id, cooldown):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT last_question_at FROM cooldowns WHERE chat_id = ?', (chat_id,)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return 0
+        return max(0, cooldown - (time.time() - row[0]))
+
+    def acquire_leadership(self, name, owner, ttl):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT owner, expires_at FROM leases WHERE name = ?', (name,)).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute('INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)', (name, owner, now + ttl))
+            conn.execute('COMMIT')
+            return True
+        finally:
+            conn.close()
+
+    def start_quiz_session(self, chat_id, session):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM quiz_polls WHERE chat_id = ?', (chat_id,))
+            conn.execute('INSERT OR REPLACE INTO quiz_sessions (chat_id, payload, question_count) VALUES (?, ?, ?)',
+                         (chat_id, json.dumps(session, ensure_ascii=False), len(session['questions'])))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def add_quiz_poll(self, chat_id, poll_id, index, sent_at):
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO quiz_polls (poll_id, chat_id, question_index, sent_at) VALUES (?, ?, ?, ?)',
+                         (poll_id, chat_id, index, sent_at))
+        finally:
+            conn.close()
+
+    def record_quiz_answer(self, poll_id, chosen, answered_at):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT p.chat_id, s.question_count FROM quiz_polls p JOIN quiz_sessions s ON s.chat_id = p.chat_id '
+                               'WHERE p.poll_id = ?', (poll_id,)).fetchone()
+            if not row:
+                conn.execute('ROLLBACK')
+                return None
+            conn.execute('UPDATE quiz_polls SET chosen = ?, answered_at = ? WHERE poll_id = ? AND chosen IS NULL', (chosen, answered_at, poll_id))
+            answered = conn.execute('SELECT COUNT(*) FROM quiz_polls WHERE chat_id = ? AND chosen IS NOT NULL', (row[0],)).fetchone()[0]
+            conn.execute('COMMIT')
+            return row[0], answered, row[1]
+        finally:
+            conn.close()
+
+    def set_quiz_poll_count(self, chat_id, count):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if not conn.execute('UPDATE quiz_sessions SET question_count = ? WHERE chat_id = ?', (count, chat_id)).rowcount:
+                conn.execute('ROLLBACK')
+                return None
+            answered = conn.execute('SELECT COUNT(*) FROM quiz_polls WHERE chat_id = ? AND chosen IS NOT NULL', (chat_id,)).fetchone()[0]
+            conn.execute('COMMIT')
+            return answered
+        finally:
+            conn.close()
+
+    def expired_quiz_sessions(self, started_before):
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute("SELECT chat_id FROM quiz_sessions WHERE json_extract(payload, '$.started_at') < ?",
+                                                   (started_before,))]
+        finally:
+            conn.close()
+
+    def pop_quiz_session(self, chat_id):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT payload FROM quiz_sessions WHERE chat_id = ?', (chat_id,)).fetchone()
+            polls = conn.execute('SELECT question_index, sent_at, chosen, answered_at FROM quiz_polls WHERE chat_id = ?', (chat_id,)).fetchall()
+            conn.execute('DELETE FROM quiz_polls WHERE chat_id = ?', (chat_id,))
+            conn.execute('DELETE FROM quiz_sessions WHERE chat_id = ?', (chat_id,))
+            conn.execute('COMMIT')
+            if not row:
+                return None
+            return json.loads(row[0]), [{'index': p[0], 'sent_at': p[1], 'chosen': p[2], 'answered_at': p[3]} for p in polls]
+        finally:
+            conn.close()
+
+def create_state_backend(name):
+    if name == 'sqlite':
+        return SQLiteStateBackend(STATE_DB_PATH)
+    return MemoryStateBackend()
+
+state_backend = create_state_backend(STATE_BACKEND)
+
+def owns_chat(chat_id):
+    # Scheduled work for a chat is done only by the worker that owns its shard
+    return WORKER_COUNT <= 1 or chat_id % WORKER_COUNT == WORKER_INDEX
+
+def update_shard(data, worker_count=WORKER_COUNT):
+    """Worker index for a raw webhook update (dict), by the same chat_id rule as owns_chat"""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if data.get(key):
+            return data[key]['chat']['id'] % worker_count
+    callback = data.get('callback_query')
+    if callback:
+        chat = (callback.get('message') or {}).get('chat') or callback['from']
+        return chat['id'] % worker_count
+    if data.get('poll_answer'):
+        # Quiz polls are sent to private chats, whose chat_id is the user id
+        return data['poll_answer']['user']['id'] % worker_count
+    for key in ('my_chat_member', 'chat_member', 'chat_join_request'):
+        if data.get(key):
+            return data[key]['chat']['id'] % worker_count
+    return 0
+
+async def run_state(func, *args):
+    """Call a state backend function from a handler. The SQLite backend can wait up to its busy
+    timeout on another worker's write lock, so it runs in a thread instead of on the event loop."""
+    if isinstance(state_backend, SQLiteStateBackend):
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
 
 def get_cooldown_remaining(chat_id):
-    if chat_id not in user_last_question_time:
-        return 0
-    current_time = datetime.datetime.now()
-    time_diff = (current_time - user_last_question_time[chat_id]).total_seconds()
-    return max(0, QUESTION_COOLDOWN - time_diff)
+    return state_backend.cooldown_remaining(chat_id, QUESTION_COOLDOWN)
 
 def check_and_set_processing(chat_id):
-    with question_generation_lock:
-        if chat_id in user_processing_questions or not can_generate_question(chat_id):
+    started = state_backend.try_start_question(chat_id, QUESTION_COOLDOWN)
+    if started:
+        inc_gauge('mcq_questions_in_flight')
+    else:
+        inc_counter('mcq_question_requests_rejected_total')
+    return started
+
+def clear_processing(chat_id):
+    state_backend.finish_question(chat_id)
+    inc_gauge('mcq_questions_in_flight', -1)
+
+# Metrics (Prometheus text format; endpoint is enabled by setting METRICS_PORT)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+metrics_lock = threading.Lock()
+metric_counters = {}
+metric_gauges = {}
+metric_histograms = {}
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc_counter(name, value=1, **labels):
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metric_counters[key] = metric_counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    with metrics_lock:
+        metric_gauges[_metric_key(name, labels)] = value
+
+def inc_gauge(name, value=1, **labels):
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metric_gauges[key] = metric_gauges.get(key, 0) + value
+
+def observe_latency(name, seconds, **labels):
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        histogram = metric_histograms.get(key)
+        if histogram is None:
+            histogram = metric_histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+@contextlib.contextmanager
+def measure(stage, **labels):
+    started = time.perf_counter()
+    trace = current_trace.get()
+    if trace is not None:
+        trace['depth'] += 1
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe_latency('mcq_stage_seconds', elapsed, stage=stage, **labels)
+        if trace is not None:
+            trace['depth'] -= 1
+            trace['spans'].append((stage, (started - trace['started']) * 1000, elapsed * 1000, trace['depth']))
+
+def timed_stage(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument_handler(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        token = start_trace(update, handler.__name__, started)
+        chat = getattr(update, 'effective_chat', None)
+        log_token = log_context.set((getattr(update, 'update_id', None), chat.id if chat else None, handler.__name__))
+        try:
+            return await handler(update, context)
+        except Exception:
+            inc_counter('mcq_handler_errors_total', handler=handler.__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            observe_latency('mcq_handler_seconds', elapsed, handler=handler.__name__)
+            log_context.reset(log_token)
+            if token is not None:
+                finish_trace(token, elapsed)
+    return wrapper
+
+# Tracing: spans recorded by measure() are attached to the update being handled.
+# Slow traces are kept in a ring buffer for /traces.
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '2000'))
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', '50'))
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+slow_traces = collections.deque(maxlen=TRACE_BUFFER_SIZE)
+
+def start_trace(update, handler_name, started):
+    if random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    chat = getattr(update, 'effective_chat', None)
+    trace = {
+        'update_id': getattr(update, 'update_id', None),
+        'chat_id': chat.id if chat else None,
+        'handler': handler_name,
+        'started': started,
+        'wall_time': time.time(),
+        'depth': 0,
+        'spans': []
+    }
+    return current_trace.set(trace)
+
+def finish_trace(token, elapsed):
+    trace = current_trace.get()
+    current_trace.reset(token)
+    trace['duration_ms'] = elapsed * 1000
+    if trace['duration_ms'] >= TRACE_SLOW_MS:
+        slow_traces.append(trace)
+        inc_counter('mcq_slow_traces_total', handler=trace['handler'])
+
+def format_trace(trace):
+    when = datetime.datetime.fromtimestamp(trace['wall_time'], TIMEZONE).strftime('%H:%M:%S')
+    lines = [f"{when} {trace['handler']} update={trace['update_id']} chat={trace['chat_id']} {trace['duration_ms']:.0f}ms"]
+    for name, offset_ms, duration_ms, depth in sorted(trace['spans'], key=lambda span: span[1]):
+        lines.append(f"{'  ' * (depth + 1)}{name} +{offset_ms:.0f}ms {duration_ms:.0f}ms")
+    return "\n".join(lines)
+
+# Logging: records are queued as they are and formatted and written as JSON lines
+# by a background listener thread, so logging from a handler costs one enqueue.
+# Records below WARNING can be sampled, and a message repeated more than
+# LOG_RATE_LIMIT_BURST times within a window is suppressed until the window ends,
+# when (or at shutdown) one summary record with the suppressed count is written.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()  # json | text
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+LOG_RATE_LIMIT_SECONDS = float(os.getenv('LOG_RATE_LIMIT_SECONDS', '60'))
+LOG_RATE_LIMIT_BURST = int(os.getenv('LOG_RATE_LIMIT_BURST', '10'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+logger = logging.getLogger('patwari_mcq_bot')
+# (update_id, chat_id, handler) of the update being handled
+log_context = contextvars.ContextVar('log_context', default=None)
+log_listener = None
+LOG_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+class LogContextFilter(logging.Filter):
+    """Samples and rate-limits records and stamps them with the current update's ids.
+
+    Runs on the thread that logs, before the record is queued, which is why
+    log_context still holds the update being handled.
+    """
+    def __init__(self, sink):
+        super().__init__()
+        # Handler that receives suppression summaries directly, past this filter
+        self.sink = sink
+        self.lock = threading.Lock()
+        # (logger, level, formatted message) -> [window start, count in window]
+        self.windows = {}
+    
+    def filter(self, record):
+        if record.levelno < logging.WARNING and LOG_SAMPLE_RATE < 1 and random.random() >= LOG_SAMPLE_RATE:
+            inc_counter('mcq_log_records_dropped_total', reason='sampled')
             return False
-        user_processing_questions[chat_id] = True
+        # Key on the formatted message: one template logged with different
+        # arguments (e.g. each schema migration) is not a repeat
+        try:
+            message = record.getMessage()
+        except Exception:
+            message = str(record.msg)
+        key = (record.name, record.levelno, message)
+        ended = None
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or record.created - window[0] >= LOG_RATE_LIMIT_SECONDS:
+                if window is not None and window[1] > LOG_RATE_LIMIT_BURST:
+                    ended = window
+                if len(self.windows) > 10000:
+                    self.windows.clear()
+                window = self.windows[key] = [record.created, 0]
+            window[1] += 1
+            suppressed = window[1] > LOG_RATE_LIMIT_BURST
+            if window[1] == LOG_RATE_LIMIT_BURST + 1:
+                # Report this window's suppressed count when it ends, even if the message never recurs
+                timer = threading.Timer(max(0, window[0] + LOG_RATE_LIMIT_SECONDS - time.time()), self.end_window, (key, window))
+                timer.daemon = True
+                timer.start()
+        if ended is not None:
+            self.emit_summary(key, ended)
+        if suppressed:
+            inc_counter('mcq_log_records_dropped_total', reason='rate_limited')
+            return False
+        
+        context = log_context.get()
+        if context is not None:
+            update_id, chat_id, handler = context
+            if getattr(record, 'update_id', None) is None:
+                record.update_id = update_id
+            if getattr(record, 'chat_id', None) is None:
+                record.chat_id = chat_id
+            record.handler = handler
         return True
+    
+    def end_window(self, key, window):
+        with self.lock:
+            if self.windows.get(key) is not window:
+                return  # a newer record already closed it and wrote the summary
+            del self.windows[key]
+        self.emit_summary(key, window)
+    
+    def flush(self):
+        """Write summaries for every window still suppressing records (at shutdown)"""
+        with self.lock:
+            pending = [(key, window) for key, window in self.windows.items() if window[1] > LOG_RATE_LIMIT_BURST]
+            self.windows.clear()
+        for key, window in pending:
+            self.emit_summary(key, window)
+    
+    def emit_summary(self, key, window):
+        name, levelno, msg = key
+        suppressed = window[1] - LOG_RATE_LIMIT_BURST
+        self.sink.emit(logging.makeLogRecord({
+            'name': name, 'levelno': levelno, 'levelname': logging.getLevelName(levelno),
+            'msg': "Suppressed %d more records like: %s", 'args': (suppressed, msg), 'suppressed': suppressed
+        }))
 
-def clear_processing(chat_id):
-    with question_generation_lock:
-        user_processing_questions.pop(chat_id, None)
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues the record unformatted; message formatting and tracebacks are rendered on the listener thread"""
+    def prepare(self, record):
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            inc_counter('mcq_log_records_dropped_total', reason='queue_full')
+
+class JSONLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        # Anything passed in `extra` (chat_id, update_id, handler, suppressed, ...) becomes a field
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value if isinstance(value, (str, int, float, bool)) else str(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging():
+    """Route all logging through the queue to a background writer on stderr"""
+    global log_listener
+    if log_listener is not None:
+        return
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JSONLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DeferredQueueHandler(log_queue)
+    context_filter = LogContextFilter(queue_handler)
+    queue_handler.addFilter(context_filter)
+    
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every Bot API and OpenAI request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    log_listener.start()
+    # atexit runs in reverse order: summaries are queued before the listener drains and stops
+    atexit.register(log_listener.stop)
+    atexit.register(context_filter.flush)
+
+# On-demand profiler: profiles everything running on the event loop thread for a few seconds
+PROFILE_MAX_SECONDS = 120
+active_profiler = None
+# Set by /profile before its first await, so concurrent commands cannot both start a run
+profile_running = False
+
+async def run_profiler(seconds, top=15):
+    global active_profiler
+    active_profiler = cProfile.Profile()
+    active_profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        active_profiler.disable()
+    output = io.StringIO()
+    pstats.Stats(active_profiler, stream=output).strip_dirs().sort_stats('cumulative').print_stats(top)
+    active_profiler = None
+    return output.getvalue()
+
+def histogram_quantile(histogram, q):
+    # Upper bound of the bucket that contains the q-th observation
+    target = histogram['count'] * q
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+        seen += count
+        if seen >= target:
+            return bound
+    return float('inf')
+
+def _escape_label_value(value):
+    # Prometheus text format: backslash, double quote and newline are escaped in label values
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label_value(value)}"' for key, value in items) + '}'
+
+def render_metrics():
+    lines = []
+    with metrics_lock:
+        counters = sorted(metric_counters.items())
+        gauges = sorted(metric_gauges.items())
+        histograms = sorted((key, dict(value, buckets=list(value['buckets']))) for key, value in metric_histograms.items())
+    
+    declared = set()
+    for (name, labels), value in counters:
+        if name not in declared:
+            lines.append(f"# TYPE {name} counter")
+            declared.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        if name not in declared:
+            lines.append(f"# TYPE {name} gauge")
+            declared.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), histogram in histograms:
+        if name not in declared:
+            lines.append(f"# TYPE {name} histogram")
+            declared.add(name)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def metrics_summary():
+    lines = ["📈 Metrics", ""]
+    with metrics_lock:
+        histograms = sorted((key, dict(value)) for key, value in metric_histograms.items())
+        counters = sorted(metric_counters.items())
+        gauges = sorted(metric_gauges.items())
+    for (name, labels), histogram in histograms:
+        if histogram['count']:
+            label_text = ",".join(f"{key}={value}" for key, value in labels)
+            average_ms = histogram['sum'] / histogram['count'] * 1000
+            lines.append(f"{name}{{{label_text}}}: n={histogram['count']} avg={average_ms:.0f}ms p95<={histogram_quantile(histogram, 0.95)}s")
+    lines.append("")
+    for (name, labels), value in counters + gauges:
+        label_text = ",".join(f"{key}={value}" for key, value in labels)
+        lines.append(f"{name}{{{label_text}}} = {value}")
+    return "\n".join(lines)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
 
 # Database functions
+def db_connect():
+    inc_counter('mcq_db_ops_total')
+    return sqlite3.connect(DB_PATH)
+
+@timed_stage('sqlite')
 def db_execute(query, params=None, fetch=False):
-    conn = sqlite3.connect('mcq_bot.db')
+    conn = db_connect()
     cursor = conn.cursor()
     try:
         cursor.execute(query, params or ())
@@ -70,12 +810,16 @@ def db_execute(query, params=None, fetch=False):
     finally:
         conn.close()
 
-def init_database():
-    conn = sqlite3.connect('mcq_bot.db')
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
+# Schema migrations: each step runs once, in order, and the schema version is
+# kept in PRAGMA user_version. Steps are idempotent so databases created before
+# versioning (user_version 0) are brought up to date without errors.
+def add_column(conn, table, column_definition, schema='main'):
+    column = column_definition.split()[0]
+    if column not in {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")}:
+        conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {column_definition}")
+
+def migration_base_tables(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             chat_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -85,9 +829,7 @@ def init_database():
             is_active BOOLEAN DEFAULT TRUE
         )
     ''')
-    
-    # User preferences table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS user_preferences (
             chat_id INTEGER PRIMARY KEY,
             topic TEXT DEFAULT 'General Knowledge',
@@ -97,9 +839,7 @@ def init_database():
             FOREIGN KEY (chat_id) REFERENCES users (chat_id)
         )
     ''')
-    
-    # User statistics table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS user_stats (
             chat_id INTEGER PRIMARY KEY,
             total_questions INTEGER DEFAULT 0,
@@ -108,9 +848,7 @@ def init_database():
             FOREIGN KEY (chat_id) REFERENCES users (chat_id)
         )
     ''')
-    
-    # Questions table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS questions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             topic TEXT,
@@ -122,16 +860,298 @@ def init_database():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
-    # Add math_subtopic column if it doesn't exist
+    add_column(conn, 'questions', 'math_subtopic TEXT DEFAULT NULL')
+
+def migration_answer_log(conn):
+    # Answer event log (append-only) and per-topic/per-difficulty aggregates maintained with each answer
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            question_id INTEGER,
+            topic TEXT,
+            subtopic TEXT,
+            difficulty TEXT,
+            chosen TEXT,
+            correct BOOLEAN,
+            latency_ms INTEGER,
+            answered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_answers_chat_time ON answers (chat_id, answered_at, correct)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_answers_chat_topic ON answers (chat_id, topic, subtopic, difficulty, correct)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_answers_question ON answers (question_id, correct)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_answers_chat_question ON answers (chat_id, question_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_topic_stats (
+            chat_id INTEGER NOT NULL,
+            topic TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            correct INTEGER DEFAULT 0,
+            total_latency_ms INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, topic)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_difficulty_stats (
+            chat_id INTEGER NOT NULL,
+            difficulty TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            correct INTEGER DEFAULT 0,
+            total_latency_ms INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, difficulty)
+        )
+    ''')
+
+def migration_schedule(conn):
+    # Per-user schedule: minutes between scheduled questions (0 = off) and quiet hours
+    for column in ['schedule_minutes INTEGER DEFAULT 30', 'quiet_start INTEGER DEFAULT NULL', 'quiet_end INTEGER DEFAULT NULL']:
+        add_column(conn, 'user_preferences', column)
+    # Broadcast progress, so a restart in the middle of a cycle does not resend
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_progress (
+            chat_id INTEGER PRIMARY KEY,
+            last_cycle INTEGER,
+            last_sent_at REAL
+        )
+    ''')
+
+def migration_review_queue(conn):
+    # Options are needed to re-send a stored question for review
+    add_column(conn, 'questions', 'options_text TEXT DEFAULT NULL')
+    # Spaced repetition queue of wrongly answered questions, ordered by due time
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS review_queue (
+            chat_id INTEGER NOT NULL,
+            question_id INTEGER NOT NULL,
+            box INTEGER DEFAULT 0,
+            lapses INTEGER DEFAULT 0,
+            due_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, question_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_review_due ON review_queue (chat_id, due_at)')
+
+def migration_model_route_log(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS model_route_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT,
+            difficulty TEXT,
+            language TEXT,
+            base_tier TEXT,
+            tier TEXT,
+            model TEXT,
+            reason TEXT,
+            latency_ms INTEGER,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            cost_usd REAL,
+            parsed BOOLEAN,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migration_content_hash(conn):
+    # Content hash of the normalized question and options, used to skip duplicates
+    add_column(conn, 'questions', 'content_hash TEXT DEFAULT NULL')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_questions_content_hash ON questions (content_hash)')
+    # Older rows get a hash once; duplicates among them keep NULL
+    rows = conn.execute('SELECT id, question_text, options_text FROM questions WHERE content_hash IS NULL').fetchall()
+    conn.executemany('UPDATE OR IGNORE questions SET content_hash = ? WHERE id = ?',
+                     [(question_content_hash(question_text, options_text), question_id) for question_id, question_text, options_text in rows])
+
+def migration_query_indexes(conn):
+    # Recent questions by topic (prompt avoid-list) and overall (retention)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_questions_topic_created ON questions (topic, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_questions_created ON questions (created_at)')
+    # Stored questions by preference key; the implicit rowid keeps "newest first" in index order
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_questions_preference ON questions (topic, difficulty, math_subtopic)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_route_log_created ON model_route_log (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_review_question ON review_queue (question_id)')
+
+def migration_incremental_vacuum(conn):
+    # Lets retention hand freed pages back with PRAGMA incremental_vacuum; switching
+    # an existing database over needs one full VACUUM, which cannot run in a transaction
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+
+def migration_question_language(conn):
+    # Language of each stored question, and the shared id of an English/Hindi pair generated together
+    add_column(conn, 'questions', 'language TEXT DEFAULT NULL')
+    add_column(conn, 'questions', 'pair_id INTEGER DEFAULT NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_questions_pair ON questions (pair_id)')
+
+def migration_math_verification(conn):
+    # Outcome of the local answer-key check, and per-subtopic counts of each outcome
+    add_column(conn, 'questions', 'key_check TEXT DEFAULT NULL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS math_verification_stats (
+            subtopic TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (subtopic, outcome)
+        )
+    ''')
+
+def migration_cost_accounting(conn):
+    # One row per delivery that spent tokens or image calls, plus running totals per scope and time bucket
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generation_costs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            source TEXT,
+            topic TEXT,
+            difficulty TEXT,
+            language TEXT,
+            model TEXT,
+            llm_calls INTEGER,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            image_calls INTEGER,
+            wall_ms INTEGER,
+            cost_usd REAL,
+            outcome TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_generation_costs_created ON generation_costs (created_at)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cost_rollups (
+            scope TEXT NOT NULL,
+            scope_key TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            generations INTEGER DEFAULT 0,
+            llm_calls INTEGER DEFAULT 0,
+            prompt_tokens INTEGER DEFAULT 0,
+            completion_tokens INTEGER DEFAULT 0,
+            image_calls INTEGER DEFAULT 0,
+            retries INTEGER DEFAULT 0,
+            wall_ms INTEGER DEFAULT 0,
+            cost_usd REAL DEFAULT 0,
+            PRIMARY KEY (scope, scope_key, bucket)
+        )
+    ''')
+
+def migration_hedge_costs(conn):
+    # Hedged second requests are counted apart from retries
+    add_column(conn, 'generation_costs', 'hedges INTEGER DEFAULT 0')
+    add_column(conn, 'cost_rollups', 'hedges INTEGER DEFAULT 0')
+
+# (version, description, function, runs inside a transaction)
+SCHEMA_MIGRATIONS = [
+    (1, 'base tables', migration_base_tables, True),
+    (2, 'answer log and aggregates', migration_answer_log, True),
+    (3, 'per-user schedule', migration_schedule, True),
+    (4, 'review queue', migration_review_queue, True),
+    (5, 'model route log', migration_model_route_log, True),
+    (6, 'question content hash', migration_content_hash, True),
+    (7, 'query indexes', migration_query_indexes, True),
+    (8, 'incremental auto-vacuum', migration_incremental_vacuum, False),
+    (9, 'question language and pairs', migration_question_language, True),
+    (10, 'math answer verification', migration_math_verification, True),
+    (11, 'cost accounting', migration_cost_accounting, True),
+    (12, 'hedged request costs', migration_hedge_costs, True),
+]
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def init_database():
+    """Apply pending schema migrations; returns the resulting schema version"""
+    conn = db_connect()
+    conn.isolation_level = None
     try:
-        cursor.execute('ALTER TABLE questions ADD COLUMN math_subtopic TEXT DEFAULT NULL')
-    except sqlite3.OperationalError:
-        # Column already exists
-        pass
-    
-    conn.commit()
-    conn.close()
+        version = schema_version(conn)
+        if version == 0 and not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'").fetchone():
+            # A brand-new file: auto_vacuum takes effect without a VACUUM when set before the first table
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        for migration_version, description, migration, transactional in SCHEMA_MIGRATIONS:
+            if migration_version <= version:
+                continue
+            if transactional:
+                conn.execute('BEGIN IMMEDIATE')
+            try:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {migration_version}')
+                if transactional:
+                    conn.execute('COMMIT')
+            except Exception:
+                if transactional:
+                    conn.execute('ROLLBACK')
+                raise
+            logger.info("Applied schema migration %d: %s", migration_version, description)
+            version = migration_version
+        return version
+    finally:
+        conn.close()
+
+# Retention: old questions move to an archive database so the hot table (and the
+# indexes scanned on every generation) stays bounded
+ARCHIVE_DB_PATH = os.getenv('ARCHIVE_DB_PATH', 'mcq_archive.db')
+QUESTION_RETENTION_DAYS = int(os.getenv('QUESTION_RETENTION_DAYS', '180'))
+ROUTE_LOG_RETENTION_DAYS = int(os.getenv('ROUTE_LOG_RETENTION_DAYS', '30'))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv('ARCHIVE_INTERVAL_HOURS', '24'))
+ARCHIVE_BATCH_SIZE = 5000
+
+GENERATION_COST_COLUMNS = ("id, chat_id, source, topic, difficulty, language, model, llm_calls, prompt_tokens, completion_tokens, "
+                           "image_calls, wall_ms, cost_usd, outcome, created_at, hedges")
+QUESTION_COLUMNS = "id, topic, difficulty, question_text, correct_answer, explanation, math_subtopic, created_at, options_text, content_hash, language, pair_id, key_check"
+
+@timed_stage('sqlite')
+def archive_old_rows(question_days=QUESTION_RETENTION_DAYS, route_log_days=ROUTE_LOG_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move expired questions, route log rows and cost events to the archive database; returns counts moved"""
+    moved = {'questions': 0, 'model_route_log': 0, 'generation_costs': 0}
+    conn = db_connect()
+    conn.isolation_level = None
+    try:
+        conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+        conn.execute(f'CREATE TABLE IF NOT EXISTS archive.questions AS SELECT {QUESTION_COLUMNS}, NULL AS archived_at FROM main.questions WHERE 0')
+        conn.execute('CREATE TABLE IF NOT EXISTS archive.model_route_log AS SELECT *, NULL AS archived_at FROM main.model_route_log WHERE 0')
+        conn.execute('CREATE TABLE IF NOT EXISTS archive.generation_costs AS SELECT *, NULL AS archived_at FROM main.generation_costs WHERE 0')
+        # Archives created before a column existed get it appended; inserts name their columns
+        for column in ('language TEXT', 'pair_id INTEGER', 'key_check TEXT'):
+            add_column(conn, 'questions', column, schema='archive')
+        add_column(conn, 'generation_costs', 'hedges INTEGER', schema='archive')
+        
+        # Questions still queued for a user's review stay in the hot table
+        question_filter = ("created_at < datetime('now', ?) AND NOT EXISTS (SELECT 1 FROM review_queue r WHERE r.question_id = questions.id)",
+                           f'-{question_days} days')
+        route_filter = ("created_at < datetime('now', ?)", f'-{route_log_days} days')
+        # Cost events follow the route log's retention; the rollups are kept
+        for table, (condition, age), columns in (('questions', question_filter, QUESTION_COLUMNS), ('model_route_log', route_filter, '*'),
+                                                 ('generation_costs', route_filter, GENERATION_COST_COLUMNS)):
+            while True:
+                # Small batches keep each write lock short while the bot is serving
+                conn.execute('BEGIN IMMEDIATE')
+                ids = [row[0] for row in conn.execute(f'SELECT id FROM main.{table} WHERE {condition} ORDER BY id LIMIT ?', (age, batch_size))]
+                if ids:
+                    placeholders = ','.join('?' * len(ids))
+                    target = f"({columns}, archived_at)" if columns != '*' else ''
+                    conn.execute(f"INSERT INTO archive.{table} {target} SELECT {columns}, CURRENT_TIMESTAMP FROM main.{table} WHERE id IN ({placeholders})", ids)
+                    conn.execute(f'DELETE FROM main.{table} WHERE id IN ({placeholders})', ids)
+                conn.execute('COMMIT')
+                moved[table] += len(ids)
+                if len(ids) < batch_size:
+                    break
+        
+        conn.execute('DETACH DATABASE archive')
+        # Return the freed pages to the filesystem
+        conn.execute('PRAGMA incremental_vacuum')
+    finally:
+        conn.close()
+    inc_counter('mcq_archived_rows_total', moved['questions'], table='questions')
+    inc_counter('mcq_archived_rows_total', moved['model_route_log'], table='model_route_log')
+    inc_counter('mcq_archived_rows_total', moved['generation_costs'], table='generation_costs')
+    return moved
+
+async def archive_job(application):
+    # Any worker may run the job; the lease makes sure only one does per interval
+    if not await run_state(state_backend.acquire_leadership, 'archive', WORKER_ID, ARCHIVE_INTERVAL_HOURS * 3600):
+        return
+    moved = await asyncio.to_thread(archive_old_rows)
+    logger.info("Archived %d questions, %d route log rows and %d cost events", moved['questions'], moved['model_route_log'], moved['generation_costs'])
 
 def register_user(chat_id, username, first_name, last_name):
     query = "INSERT OR REPLACE INTO users (chat_id, username, first_name, last_name, is_active) VALUES (?, ?, ?, ?, TRUE)"
@@ -145,12 +1165,23 @@ def register_user(chat_id, username, first_name, last_name):
     query = "INSERT OR IGNORE INTO user_stats (chat_id) VALUES (?)"
     db_execute(query, (chat_id,))
 
+# Preferences are read on nearly every update. The cache is only invalidated in the
+# process that changed them, so it is off by default when several workers share the database.
+PREFERENCE_CACHE_SECONDS = float(os.getenv('PREFERENCE_CACHE_SECONDS', '300' if WORKER_COUNT <= 1 else '0'))
+preference_cache = {}
+
 def get_user_preferences(chat_id):
+    cached = preference_cache.get(chat_id) if PREFERENCE_CACHE_SECONDS > 0 else None
+    if cached and cached[0] > time.time():
+        inc_counter('mcq_cache_requests_total', cache='preferences', result='hit')
+        return dict(cached[1])
+    inc_counter('mcq_cache_requests_total', cache='preferences', result='miss')
+    
     query = "SELECT topic, difficulty, language, math_subtopic FROM user_preferences WHERE chat_id = ?"
     result = db_execute(query, (chat_id,), fetch=True)
     
     if result:
-        return {
+        preferences = {
             "topic": result[0],
             "difficulty": result[1],
             "language": result[2],
@@ -158,12 +1189,15 @@ def get_user_preferences(chat_id):
         }
     else:
         # Default preferences
-        return {
+        preferences = {
             "topic": "General Knowledge",
             "difficulty": "Medium",
             "language": "English",
             "math_subtopic": None
         }
+    if PREFERENCE_CACHE_SECONDS > 0:
+        preference_cache[chat_id] = (time.time() + PREFERENCE_CACHE_SECONDS, preferences)
+    return dict(preferences)
 
 def update_user_preferences(chat_id, **kwargs):
     if not kwargs:
@@ -173,38 +1207,393 @@ def update_user_preferences(chat_id, **kwargs):
     query = f"UPDATE user_preferences SET {set_clause} WHERE chat_id = ?"
     params = list(kwargs.values()) + [chat_id]
     db_execute(query, params)
+    preference_cache.pop(chat_id, None)
+
+def save_user_answer(chat_id, is_correct, question_data=None, chosen=None):
+    save_user_answers(chat_id, [(question_data or {}, chosen, is_correct, time.time())])
+
+@timed_stage('sqlite')
+def save_user_answers(chat_id, results):
+    """Record (question_data, chosen, is_correct, answered_at) tuples for one chat"""
+    answer_rows = []
+    topic_rows = []
+    difficulty_rows = []
+    for question_data, chosen, is_correct, answered_at in results:
+        topic = question_data.get('topic') or 'Unknown'
+        difficulty = question_data.get('difficulty') or 'Unknown'
+        sent_at = question_data.get('sent_at')
+        latency_ms = int((answered_at - sent_at) * 1000) if sent_at else None
+        correct = 1 if is_correct else 0
+        answer_rows.append((chat_id, question_data.get('question_id'), topic, question_data.get('math_subtopic'), difficulty, chosen, correct, latency_ms))
+        topic_rows.append((chat_id, topic, correct, latency_ms or 0))
+        difficulty_rows.append((chat_id, difficulty, correct, latency_ms or 0))
+    if not answer_rows:
+        return
+    correct_total = sum(row[6] for row in answer_rows)
+    
+    # Event rows and every aggregate are written in one transaction
+    conn = db_connect()
+    try:
+        with conn:
+            conn.execute("UPDATE user_stats SET total_questions = total_questions + ?, correct_answers = correct_answers + ?, wrong_answers = wrong_answers + ? WHERE chat_id = ?",
+                         (len(answer_rows), correct_total, len(answer_rows) - correct_total, chat_id))
+            conn.executemany("INSERT INTO answers (chat_id, question_id, topic, subtopic, difficulty, chosen, correct, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             answer_rows)
+            conn.executemany("INSERT INTO user_topic_stats (chat_id, topic, total, correct, total_latency_ms) VALUES (?, ?, 1, ?, ?) "
+                             "ON CONFLICT (chat_id, topic) DO UPDATE SET total = total + 1, correct = correct + excluded.correct, total_latency_ms = total_latency_ms + excluded.total_latency_ms",
+                             topic_rows)
+            conn.executemany("INSERT INTO user_difficulty_stats (chat_id, difficulty, total, correct, total_latency_ms) VALUES (?, ?, 1, ?, ?) "
+                             "ON CONFLICT (chat_id, difficulty) DO UPDATE SET total = total + 1, correct = correct + excluded.correct, total_latency_ms = total_latency_ms + excluded.total_latency_ms",
+                             difficulty_rows)
+            for question_data, _, is_correct, _ in results:
+                if question_data.get('question_id'):
+                    schedule_review(conn, chat_id, question_data['question_id'], is_correct)
+    finally:
+        conn.close()
+
+def question_content_hash(question_text, options_text):
+    normalized = re.sub(r'\s+', ' ', f"{question_text}\n{options_text or ''}").strip().lower()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+QUESTION_INSERT = ("INSERT OR IGNORE INTO questions (topic, difficulty, question_text, correct_answer, explanation, math_subtopic, options_text, content_hash, language, key_check, created_at) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))")
+
+def question_row(question):
+    return (question['topic'], question['difficulty'], question['question_text'], question['correct_answer'], question['explanation'],
+            question.get('math_subtopic'), question['options_text'], question_content_hash(question['question_text'], question['options_text']),
+            question.get('language'), question.get('key_check'), question.get('created_at'))
+
+def save_question_to_db(topic, difficulty, question_text, correct_answer, explanation, math_subtopic=None, options_text=None, language=None, key_check=None):
+    question = {'topic': topic, 'difficulty': difficulty, 'question_text': question_text, 'correct_answer': correct_answer,
+                'explanation': explanation, 'math_subtopic': math_subtopic, 'options_text': options_text, 'language': language,
+                'key_check': key_check}
+    return save_questions_to_db([question])[0]['question_id']
+
+@timed_stage('sqlite')
+def save_questions_to_db(questions, paired=False):
+    """Insert question dicts in one transaction, filling in their question_id (the existing row's id for duplicates).
+    With paired=True the rows are translations of one question and share a pair_id."""
+    conn = db_connect()
+    try:
+        with conn:
+            for question in questions:
+                row = question_row(question)
+                cursor = conn.execute(QUESTION_INSERT, row)
+                if cursor.rowcount:
+                    question['question_id'] = cursor.lastrowid
+                else:
+                    question['question_id'] = conn.execute("SELECT id FROM questions WHERE content_hash = ?", (row[7],)).fetchone()[0]
+            if paired and questions:
+                pair_id = questions[0]['question_id']
+                conn.executemany("UPDATE questions SET pair_id = ? WHERE id = ?", [(pair_id, question['question_id']) for question in questions])
+                for question in questions:
+                    question['pair_id'] = pair_id
+    finally:
+        conn.close()
+    return questions
+
+# Question bank import/export (JSONL, one question per line)
+QUESTION_DIFFICULTIES = ("Easy", "Medium", "Hard")
+IMPORT_BATCH_SIZE = 5000
+
+def validate_question_record(record):
+    """Return a question dict ready for insertion, or raise ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+    for field in ('topic', 'question_text', 'explanation'):
+        if not isinstance(record.get(field), str) or not record[field].strip():
+            raise ValueError(f"missing or empty {field}")
+    if record.get('difficulty') not in QUESTION_DIFFICULTIES:
+        raise ValueError(f"difficulty must be one of {', '.join(QUESTION_DIFFICULTIES)}")
+    correct_answer = str(record.get('correct_answer', '')).strip().upper()
+    if correct_answer not in ('A', 'B', 'C', 'D'):
+        raise ValueError("correct_answer must be A, B, C or D")
+    
+    options = record.get('options')
+    if isinstance(options, list):
+        if len(options) != 4 or not all(isinstance(option, str) and option.strip() for option in options):
+            raise ValueError("options must be a list of 4 non-empty strings")
+        options_text = "".join(f"{letter}) {option.strip()}\n" for letter, option in zip('ABCD', options))
+    elif isinstance(record.get('options_text'), str):
+        options_text = record['options_text']
+    else:
+        raise ValueError("missing options")
+    if len(re.findall(r'^[A-D]\) \S', options_text, re.MULTILINE)) != 4:
+        raise ValueError("options must have four A) - D) lines")
+    
+    math_subtopic = record.get('math_subtopic')
+    if math_subtopic is not None and not isinstance(math_subtopic, str):
+        raise ValueError("math_subtopic must be a string")
+    if record.get('language') not in (None, "English", "Hindi"):
+        raise ValueError("language must be English or Hindi")
+    created_at = record.get('created_at')
+    if created_at is not None:
+        # Stored like SQLite's CURRENT_TIMESTAMP: UTC, 'YYYY-MM-DD HH:MM:SS'
+        try:
+            created_at = datetime.datetime.fromisoformat(str(created_at).strip())
+        except ValueError:
+            raise ValueError("created_at must be an ISO date or datetime")
+        if created_at.tzinfo:
+            created_at = created_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        created_at = created_at.strftime('%Y-%m-%d %H:%M:%S')
+    return {
+        'topic': record['topic'].strip(),
+        'difficulty': record['difficulty'],
+        'question_text': record['question_text'].strip(),
+        'correct_answer': correct_answer,
+        'explanation': record['explanation'].strip(),
+        'math_subtopic': math_subtopic or None,
+        'options_text': options_text,
+        'language': record.get('language'),
+        'created_at': created_at
+    }
 
-def save_user_answer(chat_id, is_correct):
-    query = "UPDATE user_stats SET total_questions = total_questions + 1, correct_answers = correct_answers + ?, wrong_answers = wrong_answers + ? WHERE chat_id = ?"
-    db_execute(query, (1 if is_correct else 0, 0 if is_correct else 1, chat_id))
+def import_questions(stream, batch_size=IMPORT_BATCH_SIZE, max_errors_shown=20):
+    """Load JSONL questions from a file object in batched transactions; returns counts"""
+    counts = {'read': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0}
+    conn = db_connect()
+    batch = []
+    
+    def flush():
+        before = conn.total_changes
+        with conn:
+            conn.executemany(QUESTION_INSERT, batch)
+        inserted = conn.total_changes - before
+        counts['inserted'] += inserted
+        counts['duplicates'] += len(batch) - inserted
+        batch.clear()
+    
+    try:
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            counts['read'] += 1
+            try:
+                batch.append(question_row(validate_question_record(json.loads(line))))
+            except ValueError as e:
+                # json.JSONDecodeError is a ValueError too
+                counts['invalid'] += 1
+                if counts['invalid'] <= max_errors_shown:
+                    logger.warning("Skipping invalid question on line %d: %s", line_number, e)
+                continue
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        conn.close()
+    return counts
 
-def save_question_to_db(topic, difficulty, question_text, correct_answer, explanation, math_subtopic=None):
-    query = "INSERT INTO questions (topic, difficulty, question_text, correct_answer, explanation, math_subtopic) VALUES (?, ?, ?, ?, ?, ?)"
-    db_execute(query, (topic, difficulty, question_text, correct_answer, explanation, math_subtopic))
+def export_questions(stream, topic=None, difficulty=None, math_subtopic=None, since=None, until=None):
+    """Write matching questions to a file object as JSONL; returns the number written"""
+    conditions = ["options_text IS NOT NULL"]
+    params = []
+    for column, value in (('topic', topic), ('difficulty', difficulty), ('math_subtopic', math_subtopic)):
+        if value:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if since:
+        conditions.append("created_at >= ?")
+        params.append(since)
+    if until:
+        # Dates are inclusive: --until 2024-05-31 covers the whole day
+        conditions.append("created_at < date(?, '+1 day')")
+        params.append(until)
+    query = ("SELECT topic, difficulty, math_subtopic, question_text, options_text, correct_answer, explanation, created_at, language "
+             f"FROM questions WHERE {' AND '.join(conditions)} ORDER BY id")
+    
+    written = 0
+    conn = db_connect()
+    try:
+        # Iterating the cursor streams rows instead of loading the whole table
+        for topic, difficulty, math_subtopic, question_text, options_text, correct_answer, explanation, created_at, language in conn.execute(query, params):
+            options = re.findall(r'^[A-D]\) (.*)$', options_text, re.MULTILINE)
+            record = {'topic': topic, 'difficulty': difficulty, 'math_subtopic': math_subtopic, 'question_text': question_text,
+                      'options': options if len(options) == 4 else None, 'correct_answer': correct_answer,
+                      'explanation': explanation, 'language': language, 'created_at': created_at}
+            if record['options'] is None:
+                del record['options']
+                record['options_text'] = options_text
+            stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+            written += 1
+    finally:
+        conn.close()
+    return written
 
+@timed_stage('sqlite')
 def reset_user_stats(chat_id):
-    query = "UPDATE user_stats SET total_questions = 0, correct_answers = 0, wrong_answers = 0 WHERE chat_id = ?"
-    db_execute(query, (chat_id,))
+    # The answers log is kept; only the counters shown in /stats are reset
+    conn = db_connect()
+    try:
+        with conn:
+            conn.execute("UPDATE user_stats SET total_questions = 0, correct_answers = 0, wrong_answers = 0 WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM user_topic_stats WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM user_difficulty_stats WHERE chat_id = ?", (chat_id,))
+    finally:
+        conn.close()
 
 def get_user_stats(chat_id):
     query = "SELECT total_questions, correct_answers, wrong_answers FROM user_stats WHERE chat_id = ?"
     result = db_execute(query, (chat_id,), fetch=True)
     return result if result else (0, 0, 0)
 
+@timed_stage('sqlite')
+def get_user_breakdown(chat_id):
+    # Reads only the aggregate rows for this chat, independent of answer history size
+    conn = db_connect()
+    try:
+        by_topic = conn.execute("SELECT topic, total, correct, total_latency_ms FROM user_topic_stats WHERE chat_id = ? ORDER BY total DESC", (chat_id,)).fetchall()
+        by_difficulty = conn.execute("SELECT difficulty, total, correct, total_latency_ms FROM user_difficulty_stats WHERE chat_id = ?", (chat_id,)).fetchall()
+        return by_topic, by_difficulty
+    finally:
+        conn.close()
+
+# Spaced repetition (Leitner boxes): a wrong answer puts the question in box 0,
+# each correct review moves it up a box, and it leaves the queue after the last box
+REVIEW_INTERVALS = [10 * 60, 24 * 3600, 3 * 24 * 3600, 7 * 24 * 3600, 16 * 24 * 3600]
+
+def schedule_review(conn, chat_id, question_id, is_correct):
+    now = time.time()
+    if not is_correct:
+        conn.execute("INSERT INTO review_queue (chat_id, question_id, box, lapses, due_at) VALUES (?, ?, 0, 1, ?) "
+                     "ON CONFLICT (chat_id, question_id) DO UPDATE SET box = 0, lapses = lapses + 1, due_at = excluded.due_at",
+                     (chat_id, question_id, now + REVIEW_INTERVALS[0]))
+        return
+    
+    row = conn.execute("SELECT box FROM review_queue WHERE chat_id = ? AND question_id = ?", (chat_id, question_id)).fetchone()
+    if not row:
+        return
+    box = row[0] + 1
+    if box >= len(REVIEW_INTERVALS):
+        conn.execute("DELETE FROM review_queue WHERE chat_id = ? AND question_id = ?", (chat_id, question_id))
+    else:
+        conn.execute("UPDATE review_queue SET box = ?, due_at = ? WHERE chat_id = ? AND question_id = ?",
+                     (box, now + REVIEW_INTERVALS[box], chat_id, question_id))
+
+def get_due_review(chat_id):
+    query = """
+        SELECT q.id, q.topic, q.difficulty, q.question_text, q.options_text, q.correct_answer, q.explanation, q.math_subtopic
+        FROM review_queue r JOIN questions q ON q.id = r.question_id
+        WHERE r.chat_id = ? AND r.due_at <= ? AND q.options_text IS NOT NULL
+        ORDER BY r.due_at LIMIT 1
+    """
+    result = db_execute(query, (chat_id, time.time()), fetch=True)
+    if not result:
+        return None
+    return {
+        'question_id': result[0],
+        'topic': result[1],
+        'difficulty': result[2],
+        'question_text': result[3],
+        'options_text': result[4],
+        'correct_answer': result[5],
+        'explanation': result[6],
+        'math_subtopic': result[7],
+        'is_review': True
+    }
+
+@timed_stage('sqlite')
+def get_fallback_question(chat_id, preferences, exclude_ids=()):
+    # Recent stored questions this chat has not answered yet: the exact preference key first,
+    # then the same topic and difficulty, then the topic. Each step is a prefix of idx_questions_preference.
+    query = """
+        SELECT q.id, q.topic, q.difficulty, q.question_text, q.options_text, q.correct_answer, q.explanation, q.math_subtopic
+        FROM questions q
+        WHERE {key} AND q.options_text IS NOT NULL AND (q.language = ? OR q.language IS NULL) AND q.key_check IS NOT 'mismatch'
+          AND NOT EXISTS (SELECT 1 FROM answers a WHERE a.chat_id = ? AND a.question_id = q.id)
+        ORDER BY q.id DESC LIMIT 200
+    """
+    keys = [
+        ("q.topic = ? AND q.difficulty = ? AND q.math_subtopic IS ?", (preferences["topic"], preferences["difficulty"], preferences.get("math_subtopic"))),
+        ("q.topic = ? AND q.difficulty = ?", (preferences["topic"], preferences["difficulty"])),
+        ("q.topic = ?", (preferences["topic"],)),
+    ]
+    rows = []
+    conn = db_connect()
+    try:
+        for key, params in keys:
+            rows = [row for row in conn.execute(query.format(key=key), params + (preferences.get("language", "English"), chat_id)).fetchall()
+                    if row[0] not in exclude_ids]
+            if rows:
+                break
+    finally:
+        conn.close()
+    if not rows:
+        return None
+    
+    row = random.choice(rows)
+    return {
+        'question_id': row[0],
+        'topic': row[1],
+        'difficulty': row[2],
+        'question_text': row[3],
+        'options_text': row[4],
+        'correct_answer': row[5],
+        'explanation': row[6],
+        'math_subtopic': row[7],
+        'is_fallback': True
+    }
+
 def get_all_active_users():
     query = "SELECT chat_id FROM users WHERE is_active = TRUE"
-    conn = sqlite3.connect('mcq_bot.db')
+    conn = db_connect()
     cursor = conn.cursor()
     cursor.execute(query)
     result = [row[0] for row in cursor.fetchall()]
     conn.close()
     return result
 
-def get_recent_questions(limit=5):
-    query = "SELECT question_text FROM questions ORDER BY created_at DESC LIMIT ?"
-    conn = sqlite3.connect('mcq_bot.db')
+def schedule_slot(chat_id, slot_count, worker_count=WORKER_COUNT):
+    return (chat_id // max(1, worker_count)) % slot_count
+
+@timed_stage('sqlite')
+def get_slot_users(slot, slot_count, worker_count=WORKER_COUNT):
+    # Same as schedule_slot: SQLite's / and % truncate toward zero, so negative (group) chat ids
+    # are floored explicitly before dividing
+    query = """
+        SELECT u.chat_id, COALESCE(p.schedule_minutes, 30), p.quiet_start, p.quiet_end, b.last_cycle, b.last_sent_at
+        FROM users u
+        LEFT JOIN user_preferences p ON p.chat_id = u.chat_id
+        LEFT JOIN broadcast_progress b ON b.chat_id = u.chat_id
+        WHERE u.is_active = TRUE AND ((((u.chat_id - ((u.chat_id % :workers) + :workers) % :workers) / :workers) % :slots) + :slots) % :slots = :slot
+    """
+    conn = db_connect()
+    try:
+        return conn.execute(query, {'workers': max(1, worker_count), 'slots': slot_count, 'slot': slot}).fetchall()
+    finally:
+        conn.close()
+
+@timed_stage('sqlite')
+def mark_broadcast_sent(chat_ids, cycle):
+    conn = db_connect()
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO broadcast_progress (chat_id, last_cycle, last_sent_at) VALUES (?, ?, ?)",
+                             [(chat_id, cycle, time.time()) for chat_id in chat_ids])
+    finally:
+        conn.close()
+
+@timed_stage('sqlite')
+def restore_broadcast_progress(rows):
+    """Put back (chat_id, last_cycle, last_sent_at) for users marked as sent who were not served"""
+    conn = db_connect()
+    try:
+        with conn:
+            conn.executemany("DELETE FROM broadcast_progress WHERE chat_id = ?", [(row[0],) for row in rows if row[1] is None])
+            conn.executemany("INSERT OR REPLACE INTO broadcast_progress (chat_id, last_cycle, last_sent_at) VALUES (?, ?, ?)",
+                             [row for row in rows if row[1] is not None])
+    finally:
+        conn.close()
+
+@timed_stage('sqlite')
+def get_recent_questions(limit=5, topic=None):
+    if topic:
+        query, params = "SELECT question_text FROM questions WHERE topic = ? ORDER BY created_at DESC LIMIT ?", (topic, limit)
+    else:
+        query, params = "SELECT question_text FROM questions ORDER BY created_at DESC LIMIT ?", (limit,)
+    conn = db_connect()
     cursor = conn.cursor()
-    cursor.execute(query, (limit,))
+    cursor.execute(query, params)
     result = [row[0] for row in cursor.fetchall()]
     conn.close()
     return result
@@ -233,7 +1622,8 @@ def clean_mathematical_text(text):
         
         if any(op in cleaned_text for op in ['+', '-', '*', '/', '^', '=', '(', ')']):
             try:
-                expr = sympify(cleaned_text, transformations='all')
+                with measure('sympy'):
+                    expr = sympify(cleaned_text, transformations='all')
                 return str(expr).replace('**', '^').replace(' ', '')
             except:
                 pass
@@ -243,6 +1633,7 @@ def clean_mathematical_text(text):
         return re.sub(r'\\[a-zA-Z]+', '', text.strip())
 
 # Question parsing function
+@timed_stage('parse_question')
 def parse_question(full_response):
     full_response = clean_mathematical_text(full_response.replace('\n\n', '\n').replace('  ', ' ').strip())
     
@@ -287,6 +1678,7 @@ def parse_question(full_response):
     return question_text, options_text, correct_answer, explanation
 
 # Image generation functions
+@timed_stage('download_image')
 def download_image(url, filename):
     try:
         response = requests.get(url)
@@ -295,7 +1687,7 @@ def download_image(url, filename):
             f.write(response.content)
         return True
     except Exception as e:
-        print(f"Error downloading image: {e}")
+        logger.warning("Error downloading image: %s", e)
         return False
 
 def create_image_prompt(topic, math_subtopic, question_content):
@@ -507,12 +1899,13 @@ def create_image_prompt(topic, math_subtopic, question_content):
     
     return f"Educational diagram or illustration relevant to {topic} with clear labels and professional appearance. Clean, educational style."
 
+@timed_stage('generate_question_image')
 def generate_question_image(topic, math_subtopic=None, question_text="", options_text="", question_type="MCQ"):
     try:
         question_content = f"{question_text} {options_text}".lower()
         prompt = create_image_prompt(topic, math_subtopic, question_content)
         
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = get_openai_client()
         response = client.images.generate(
             model="dall-e-3",
             prompt=prompt,
@@ -520,24 +1913,587 @@ def generate_question_image(topic, math_subtopic=None, question_text="", options
             quality="standard",
             n=1
         )
+        record_image_call()
         
         return response.data[0].url
     except Exception as e:
-        print(f"Error generating image: {e}")
+        logger.warning("Error generating image: %s", e)
+        return None
+
+# One client (and connection pool) shared by all generations
+LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', '30'))
+openai_client = None
+
+def get_openai_client():
+    global openai_client
+    if openai_client is None:
+        openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, timeout=LLM_TIMEOUT_SECONDS, max_retries=1)
+    return openai_client
+
+# LLM resilience: a hedged second request when the first is slower than the
+# observed p95, and a circuit breaker that stops calling a failing backend
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY', '8'))
+LLM_HEDGE_MIN_DELAY = 1.0
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '5'))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv('LLM_BREAKER_RESET_SECONDS', '60'))
+
+llm_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv('LLM_MAX_WORKERS', '16')), thread_name_prefix='llm')
+llm_latencies = collections.defaultdict(lambda: collections.deque(maxlen=200))
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # Start of the half-open probe in flight; None when no probe is
+        self.probing = None
+        self.lock = threading.Lock()
+
+    def is_rejecting(self):
+        # Open and still inside the reset timeout, so no probe would be allowed either
+        with self.lock:
+            return self.opened_at is not None and time.time() - self.opened_at < self.reset_timeout
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            # After the reset timeout a single probe request is let through (half-open). A probe
+            # that never reported back is given up after another reset timeout and replaced.
+            now = time.time()
+            if now - self.opened_at >= self.reset_timeout and (self.probing is None or now - self.probing >= self.reset_timeout):
+                self.probing = now
+                return True
+            return False
+    
+    def is_probing(self):
+        with self.lock:
+            return self.probing is not None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = None
+        set_gauge('mcq_llm_circuit_open', 0)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self.probing = None
+        if self.opened_at is not None:
+            set_gauge('mcq_llm_circuit_open', 1)
+
+llm_breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+
+def llm_hedge_delay(model):
+    latencies = list(llm_latencies[model])
+    if len(latencies) < 20:
+        return LLM_HEDGE_DEFAULT_DELAY
+    ordered = sorted(latencies)
+    return max(LLM_HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+def _timed_completion(**kwargs):
+    started = time.perf_counter()
+    response = get_openai_client().chat.completions.create(**kwargs)
+    llm_latencies[kwargs.get('model')].append(time.perf_counter() - started)
+    return response
+
+def _submit_completion(kwargs):
+    # copy_context keeps the caller's trace attached to the worker thread
+    return llm_executor.submit(contextvars.copy_context().run, _timed_completion, **kwargs)
+
+def request_completion(**kwargs):
+    """Chat completion with hedging and circuit breaking; returns None when the LLM is unavailable"""
+    if not llm_breaker.allow_request():
+        inc_counter('mcq_llm_short_circuited_total')
+        return None
+    
+    # Every path that does not record a success records a failure, so a half-open probe is never left claimed
+    succeeded = False
+    try:
+        last_error = None
+        with measure('openai_completion'):
+            futures = [_submit_completion(kwargs)]
+            done, _ = concurrent.futures.wait(futures, timeout=llm_hedge_delay(kwargs.get('model')))
+            # Slow or already failed: fire a second request and take whichever succeeds first. Not while
+            # half-open, where this request is the single probe.
+            if (not done or futures[0].exception() is not None) and not llm_breaker.is_probing():
+                inc_counter('mcq_llm_hedged_requests_total')
+                futures.append(_submit_completion(kwargs))
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        llm_breaker.record_success()
+                        succeeded = True
+                        if len(futures) > 1:
+                            inc_counter('mcq_llm_hedge_wins_total', winner='primary' if future is futures[0] else 'hedge')
+                            for loser in futures:
+                                if loser is not future:
+                                    loser.add_done_callback(functools.partial(record_hedge_usage, current_ledger.get(), kwargs.get('model')))
+                        return future.result()
+                    last_error = future.exception()
+        
+        inc_counter('mcq_llm_errors_total', model=kwargs.get('model'))
+        logger.error("Error generating MCQ: %s", last_error)
+        return None
+    finally:
+        if not succeeded:
+            llm_breaker.record_failure()
+
+# Model routing: (topic, difficulty, language) maps to a model tier by the first
+# matching rule, then rolling per-model stats can move traffic between tiers
+MODEL_TIERS = {
+    "fast": os.getenv('LLM_FAST_MODEL', 'gpt-4o-mini'),
+    "standard": os.getenv('LLM_STANDARD_MODEL', 'gpt-4'),
+}
+MODEL_ROUTE_RULES = [
+    # (topic, difficulty, language, tier); '*' matches anything
+    ("*", "Hard", "*", "standard"),
+    ("General Mathematics", "Medium", "*", "standard"),
+    ("Reasoning Ability", "Medium", "*", "standard"),
+    ("*", "*", "*", "fast"),
+]
+ROUTE_MAX_TOKENS = {
+    # Devanagari text takes several times more tokens than English
+    ("fast", "English"): 250,
+    ("fast", "Hindi"): 450,
+    ("standard", "English"): 400,
+    ("standard", "Hindi"): 600,
+}
+# USD per 1K (prompt, completion) tokens
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4o": (0.0025, 0.01),
+    "gpt-4": (0.03, 0.06),
+}
+ROUTER_WINDOW = 100
+ROUTER_MIN_SAMPLES = 20
+ROUTER_MIN_PARSE_RATE = float(os.getenv('ROUTER_MIN_PARSE_RATE', '0.85'))
+ROUTER_MAX_P95_SECONDS = float(os.getenv('ROUTER_MAX_P95_SECONDS', '12'))
+# Shift standard traffic once a parsed standard question costs this many times a parsed fast one; 0 turns it off
+ROUTER_MAX_COST_RATIO = float(os.getenv('ROUTER_MAX_COST_RATIO', '50'))
+ROUTER_SHIFT_SHARE = float(os.getenv('ROUTER_SHIFT_SHARE', '0.5'))
+ROUTER_EXPLORE_RATE = float(os.getenv('ROUTER_EXPLORE_RATE', '0.05'))
+
+# Rolling (latency seconds, parsed, cost) outcomes per model
+model_outcomes = collections.defaultdict(lambda: collections.deque(maxlen=ROUTER_WINDOW))
+
+def model_parse_rate(model):
+    outcomes = list(model_outcomes[model])
+    if len(outcomes) < ROUTER_MIN_SAMPLES:
+        return None
+    return sum(1 for _, parsed, _ in outcomes if parsed) / len(outcomes)
+
+def model_p95_latency(model):
+    latencies = sorted(latency for latency, _, _ in model_outcomes[model])
+    if len(latencies) < ROUTER_MIN_SAMPLES:
+        return None
+    return latencies[int(len(latencies) * 0.95) - 1]
+
+def model_cost_per_parse(model):
+    # Failed parses are paid for too, so they raise the cost of each usable question
+    outcomes = list(model_outcomes[model])
+    parsed_count = sum(1 for _, parsed, _ in outcomes if parsed)
+    if len(outcomes) < ROUTER_MIN_SAMPLES or not parsed_count:
+        return None
+    return sum(cost for _, _, cost in outcomes) / parsed_count
+
+def completion_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0, 0))
+    return prompt_tokens / 1000 * prompt_price + completion_tokens / 1000 * completion_price
+
+def choose_route(topic, difficulty, language):
+    base_tier = next(tier for rule_topic, rule_difficulty, rule_language, tier in MODEL_ROUTE_RULES
+                     if rule_topic in ("*", topic) and rule_difficulty in ("*", difficulty) and rule_language in ("*", language))
+    tier, reason = base_tier, "rule"
+    fast_parse_rate = model_parse_rate(MODEL_TIERS["fast"])
+    standard_p95 = model_p95_latency(MODEL_TIERS["standard"])
+    fast_cost = model_cost_per_parse(MODEL_TIERS["fast"])
+    standard_cost = model_cost_per_parse(MODEL_TIERS["standard"])
+    too_slow = standard_p95 is not None and standard_p95 > ROUTER_MAX_P95_SECONDS
+    too_costly = (ROUTER_MAX_COST_RATIO > 0 and fast_cost and standard_cost is not None
+                  and standard_cost > fast_cost * ROUTER_MAX_COST_RATIO)
+    
+    if base_tier == "fast" and fast_parse_rate is not None and fast_parse_rate < ROUTER_MIN_PARSE_RATE:
+        tier, reason = "standard", "escalated_parse_rate"
+    elif (base_tier == "standard" and (too_slow or too_costly)
+          and (fast_parse_rate is None or fast_parse_rate >= ROUTER_MIN_PARSE_RATE) and random.random() < ROUTER_SHIFT_SHARE):
+        tier, reason = "fast", "shifted_latency" if too_slow else "shifted_cost"
+    elif random.random() < ROUTER_EXPLORE_RATE:
+        # A little traffic on the other tier keeps its stats current
+        tier, reason = ("standard" if base_tier == "fast" else "fast"), "explore"
+    
+    inc_counter('mcq_route_decisions_total', tier=tier, reason=reason)
+    return {
+        'topic': topic,
+        'difficulty': difficulty,
+        'language': language,
+        'base_tier': base_tier,
+        'tier': tier,
+        'reason': reason,
+        'model': MODEL_TIERS[tier],
+        'max_tokens': ROUTE_MAX_TOKENS.get((tier, language), 500)
+    }
+
+def record_route_outcome(generation_info, parsed):
+    route = generation_info.get('route')
+    if not route or 'latency' not in generation_info:
+        return
+    model = route['model']
+    prompt_tokens = generation_info.get('prompt_tokens', 0)
+    completion_tokens = generation_info.get('completion_tokens', 0)
+    cost = completion_cost(model, prompt_tokens, completion_tokens)
+    model_outcomes[model].append((generation_info['latency'], parsed, cost))
+    inc_counter('mcq_route_outcomes_total', model=model, parsed='yes' if parsed else 'no')
+    inc_counter('mcq_llm_cost_usd_total', cost, model=model)
+    db_execute("INSERT INTO model_route_log (topic, difficulty, language, base_tier, tier, model, reason, latency_ms, prompt_tokens, completion_tokens, cost_usd, parsed) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+               (route['topic'], route['difficulty'], route['language'], route['base_tier'], route['tier'], model, route['reason'],
+                int(generation_info['latency'] * 1000), prompt_tokens, completion_tokens, cost, parsed))
+
+def router_summary():
+    lines = ["🧭 Model routing"]
+    for tier, model in MODEL_TIERS.items():
+        outcomes = list(model_outcomes[model])
+        if not outcomes:
+            lines.append(f"{tier} ({model}): no data")
+            continue
+        parse_rate = sum(1 for _, parsed, _ in outcomes if parsed) / len(outcomes)
+        average_latency = sum(latency for latency, _, _ in outcomes) / len(outcomes)
+        average_cost = sum(cost for _, _, cost in outcomes) / len(outcomes)
+        cost_per_parse = model_cost_per_parse(model)
+        parsed_cost = f" (${cost_per_parse:.4f}/parsed)" if cost_per_parse is not None else ""
+        lines.append(f"{tier} ({model}): n={len(outcomes)} parsed={parse_rate * 100:.0f}% avg={average_latency:.1f}s cost=${average_cost:.4f}/q{parsed_cost}")
+    return "\n".join(lines)
+
+# Cost accounting: tokens, image calls and wall time spent on one delivery (a
+# /question, a broadcast send or a /quiz) are collected in a ledger carried by a
+# context variable, then written as one event row plus rollups per chat and day,
+# per (topic, difficulty, language) and day, and per hour.
+IMAGE_PRICE_USD = float(os.getenv('IMAGE_PRICE_USD', '0.04'))
+# Daily budgets in USD; 0 means unlimited. Over budget, only stored questions are served.
+USER_DAILY_BUDGET_USD = float(os.getenv('USER_DAILY_BUDGET_USD', '0'))
+DAILY_BUDGET_USD = float(os.getenv('DAILY_BUDGET_USD', '0'))
+
+current_ledger = contextvars.ContextVar('current_ledger', default=None)
+# A hedge's losing request reports its usage from another thread, possibly after the ledger was saved
+ledger_lock = threading.Lock()
+
+COST_ROLLUP_UPSERT = ("INSERT INTO cost_rollups (scope, scope_key, bucket, generations, llm_calls, prompt_tokens, completion_tokens, image_calls, retries, hedges, wall_ms, cost_usd) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                      "ON CONFLICT (scope, scope_key, bucket) DO UPDATE SET generations = generations + excluded.generations, llm_calls = llm_calls + excluded.llm_calls, "
+                      "prompt_tokens = prompt_tokens + excluded.prompt_tokens, completion_tokens = completion_tokens + excluded.completion_tokens, "
+                      "image_calls = image_calls + excluded.image_calls, retries = retries + excluded.retries, hedges = hedges + excluded.hedges, "
+                      "wall_ms = wall_ms + excluded.wall_ms, cost_usd = cost_usd + excluded.cost_usd")
+
+def cost_buckets():
+    now = datetime.datetime.now(TIMEZONE)
+    return now.strftime('%Y-%m-%d'), now.strftime('%Y-%m-%d %H')
+
+def start_ledger(chat_id, source, preferences):
+    ledger = {
+        'chat_id': chat_id, 'source': source, 'topic': preferences["topic"], 'difficulty': preferences["difficulty"],
+        'language': preferences["language"], 'model': None, 'llm_calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+        'image_calls': 0, 'hedges': 0, 'cost_usd': 0.0, 'started': time.perf_counter(), 'closed': False
+    }
+    return current_ledger.set(ledger)
+
+async def finish_ledger(token, outcome):
+    ledger = current_ledger.get()
+    current_ledger.reset(token)
+    with ledger_lock:
+        ledger['closed'] = True
+    # Reviews and stored questions cost nothing and are not recorded
+    if not ledger['llm_calls'] and not ledger['image_calls']:
+        return
+    ledger['wall_ms'] = int((time.perf_counter() - ledger['started']) * 1000)
+    try:
+        await asyncio.to_thread(save_cost_event, ledger, outcome)
+    except Exception as e:
+        logger.exception("Error recording generation cost")
+
+def record_token_usage(generation_info, model, usage):
+    """Note a completion's token usage in generation_info, the metrics and the current ledger"""
+    if not usage:
+        return
+    generation_info['prompt_tokens'] = usage.prompt_tokens
+    generation_info['completion_tokens'] = usage.completion_tokens
+    inc_counter('mcq_llm_tokens_total', usage.prompt_tokens, kind='prompt', model=model)
+    inc_counter('mcq_llm_tokens_total', usage.completion_tokens, kind='completion', model=model)
+    ledger = current_ledger.get()
+    if ledger is not None:
+        with ledger_lock:
+            add_ledger_usage(ledger, model, usage)
+
+def add_ledger_usage(ledger, model, usage):
+    ledger['model'] = model
+    ledger['llm_calls'] += 1
+    ledger['prompt_tokens'] += usage.prompt_tokens
+    ledger['completion_tokens'] += usage.completion_tokens
+    ledger['cost_usd'] += completion_cost(model, usage.prompt_tokens, usage.completion_tokens)
+
+def record_hedge_usage(ledger, model, future):
+    """Done-callback for the request that lost a hedge: it was billed too, so its usage goes to the
+    same ledger, or into its own cost event when the delivery was already recorded"""
+    if future.cancelled() or future.exception() is not None or not future.result().usage:
+        return
+    usage = future.result().usage
+    inc_counter('mcq_llm_tokens_total', usage.prompt_tokens, kind='prompt', model=model)
+    inc_counter('mcq_llm_tokens_total', usage.completion_tokens, kind='completion', model=model)
+    if ledger is None:
+        return
+    with ledger_lock:
+        if not ledger['closed']:
+            add_ledger_usage(ledger, model, usage)
+            ledger['hedges'] += 1
+            return
+    late = dict(ledger, llm_calls=0, prompt_tokens=0, completion_tokens=0, image_calls=0, hedges=1, cost_usd=0.0, wall_ms=0)
+    add_ledger_usage(late, model, usage)
+    try:
+        save_cost_event(late, 'hedge', generations=0)
+    except Exception as e:
+        logger.exception("Error recording hedged request cost")
+
+def estimate_usage(prompt, completion_text):
+    """Approximate usage (about 4 characters per token) for a stream that ended before its usage chunk"""
+    prompt_tokens = len(prompt) // 4 + 1
+    completion_tokens = len(completion_text) // 4
+    return CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                           total_tokens=prompt_tokens + completion_tokens)
+
+def record_image_call():
+    inc_counter('mcq_image_generations_total')
+    inc_counter('mcq_llm_cost_usd_total', IMAGE_PRICE_USD, model='dall-e-3')
+    ledger = current_ledger.get()
+    if ledger is not None:
+        ledger['image_calls'] += 1
+        ledger['cost_usd'] += IMAGE_PRICE_USD
+
+@timed_stage('sqlite')
+def save_cost_event(ledger, outcome, generations=1):
+    day, hour = cost_buckets()
+    # Besides hedged second requests, every completion after the first in one delivery is a retry
+    # (parse failure, rejected key or stream fallback)
+    retries = max(0, ledger['llm_calls'] - 1 - ledger['hedges']) if generations else 0
+    totals = (generations, ledger['llm_calls'], ledger['prompt_tokens'], ledger['completion_tokens'], ledger['image_calls'],
+              retries, ledger['hedges'], ledger['wall_ms'], ledger['cost_usd'])
+    preference_key = f"{ledger['topic']}|{ledger['difficulty']}|{ledger['language']}"
+    conn = db_connect()
+    try:
+        with conn:
+            conn.execute("INSERT INTO generation_costs (chat_id, source, topic, difficulty, language, model, llm_calls, prompt_tokens, completion_tokens, image_calls, hedges, wall_ms, cost_usd, outcome) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (ledger['chat_id'], ledger['source'], ledger['topic'], ledger['difficulty'], ledger['language'], ledger['model'],
+                          ledger['llm_calls'], ledger['prompt_tokens'], ledger['completion_tokens'], ledger['image_calls'],
+                          ledger['hedges'], ledger['wall_ms'], ledger['cost_usd'], outcome))
+            conn.executemany(COST_ROLLUP_UPSERT, [('chat', str(ledger['chat_id']), day) + totals,
+                                                  ('preference', preference_key, day) + totals,
+                                                  ('hour', '*', hour) + totals])
+    finally:
+        conn.close()
+
+@timed_stage('sqlite')
+def budget_exceeded(chat_id):
+    """Return 'user' or 'global' when today's spend has reached a configured budget, else None"""
+    if not USER_DAILY_BUDGET_USD and not DAILY_BUDGET_USD:
         return None
+    day, _ = cost_buckets()
+    conn = db_connect()
+    try:
+        user_spend = conn.execute("SELECT cost_usd FROM cost_rollups WHERE scope = 'chat' AND scope_key = ? AND bucket = ?",
+                                  (str(chat_id), day)).fetchone()
+        global_spend = conn.execute("SELECT SUM(cost_usd) FROM cost_rollups WHERE scope = 'hour' AND scope_key = '*' AND bucket BETWEEN ? AND ?",
+                                    (f"{day} 00", f"{day} 23")).fetchone()
+    finally:
+        conn.close()
+    scope = None
+    if DAILY_BUDGET_USD and (global_spend[0] or 0) >= DAILY_BUDGET_USD:
+        scope = 'global'
+    elif USER_DAILY_BUDGET_USD and user_spend and user_spend[0] >= USER_DAILY_BUDGET_USD:
+        scope = 'user'
+    if scope:
+        inc_counter('mcq_budget_exceeded_total', scope=scope)
+    return scope
+
+def cost_summary(top=5):
+    day, hour = cost_buckets()
+    conn = db_connect()
+    try:
+        hours = conn.execute("SELECT bucket, generations, llm_calls, prompt_tokens + completion_tokens, image_calls, retries, hedges, cost_usd FROM cost_rollups "
+                             "WHERE scope = 'hour' AND scope_key = '*' AND bucket BETWEEN ? AND ? ORDER BY bucket DESC", (f"{day} 00", hour)).fetchall()
+        chats = conn.execute("SELECT scope_key, generations, cost_usd FROM cost_rollups WHERE scope = 'chat' AND bucket = ? ORDER BY cost_usd DESC LIMIT ?",
+                             (day, top)).fetchall()
+        preferences = conn.execute("SELECT scope_key, generations, retries, cost_usd FROM cost_rollups WHERE scope = 'preference' AND bucket = ? "
+                                   "ORDER BY cost_usd DESC LIMIT ?", (day, top)).fetchall()
+        sources = conn.execute("SELECT source, outcome, COUNT(*), AVG(wall_ms), SUM(cost_usd) FROM generation_costs "
+                               "WHERE created_at >= datetime('now', '-1 day') GROUP BY source, outcome ORDER BY source, outcome").fetchall()
+    finally:
+        conn.close()
+    
+    generations = sum(row[1] for row in hours)
+    spend = sum(row[7] for row in hours)
+    lines = [f"💰 Costs today ({day}): ${spend:.4f} over {generations} deliveries, "
+             f"{sum(row[3] for row in hours)} tokens, {sum(row[4] for row in hours)} images, {sum(row[5] for row in hours)} retries, "
+             f"{sum(row[6] for row in hours)} hedges"]
+    if DAILY_BUDGET_USD:
+        lines.append(f"Global budget: ${spend:.2f} of ${DAILY_BUDGET_USD:.2f}")
+    lines.append("By hour:")
+    lines.extend(f"  {bucket[-2:]}:00 n={n} calls={calls} tokens={tokens} images={images} hedges={hedges} ${cost:.4f}"
+                 for bucket, n, calls, tokens, images, _, hedges, cost in hours[:6])
+    lines.append("Top chats:")
+    lines.extend(f"  {chat_id}: n={n} ${cost:.4f}" for chat_id, n, cost in chats)
+    lines.append("Top preferences:")
+    lines.extend(f"  {key.replace('|', ' / ')}: n={n} retries={retries} ${cost:.4f}" for key, n, retries, cost in preferences)
+    lines.append("Last 24h by source:")
+    lines.extend(f"  {source} {outcome}: n={n} avg={avg_ms or 0:.0f}ms ${cost or 0:.4f} (${(cost or 0) / n:.4f} each)"
+                 for source, outcome, n, avg_ms, cost in sources)
+    return "\n".join(lines)
 
 # Question generation function
-def generate_mcq(topic, difficulty, chat_id, language="English", math_subtopic=None):
-    client = OpenAI(api_key=OPENAI_API_KEY)
+@timed_stage('generate_mcq')
+def generate_mcq(topic, difficulty, chat_id, language="English", math_subtopic=None, generation_info=None):
+    """Return (full_response, topic, math_subtopic, needs_image); full_response is None if generation failed.
+    If generation_info is a dict, the route taken, latency and token usage are recorded in it."""
+    if llm_breaker.is_rejecting():
+        # Skip building the prompt (and its DB read) while the circuit is open
+        inc_counter('mcq_llm_short_circuited_total')
+        return None, topic, math_subtopic, False
+    
+    prompt = build_mcq_prompt(topic, difficulty, language, math_subtopic)
+    route = choose_route(topic, difficulty, language)
+    if generation_info is None:
+        generation_info = {}
+    generation_info['route'] = route
+    
+    try:
+        started = time.perf_counter()
+        response = request_completion(
+            model=route['model'],
+            messages=[{"role": "user", "content": prompt}],
+            # A bilingual completion carries the question twice
+            max_tokens=route['max_tokens'] * (2 if language == BILINGUAL else 1),
+            temperature=0.7
+        )
+        if response is None:
+            return None, topic, math_subtopic, False
+        generation_info['latency'] = time.perf_counter() - started
+        record_token_usage(generation_info, route['model'], response.usage)
+        
+        full_response = response.choices[0].message.content.strip()
+        needs_image = question_needs_image(topic, math_subtopic, full_response)
+        return full_response, topic, math_subtopic, needs_image
+        
+    except Exception as e:
+        logger.error("Error generating MCQ: %s", e)
+        return None, topic, math_subtopic, False
+
+# Bilingual generation: one completion carries the English and Hindi versions of
+# the same MCQ with one answer key. Both are stored as a linked pair; the version
+# the requesting user did not ask for waits in a ready buffer for the next user
+# with the same topic, difficulty and subtopic in the other language.
+BILINGUAL = "Bilingual"
+BILINGUAL_GENERATION = os.getenv('BILINGUAL_GENERATION', 'off').lower() in ('1', 'on', 'true', 'yes')
+READY_BUFFER_SIZE = int(os.getenv('READY_BUFFER_SIZE', '20'))
+LANGUAGE_SECTION = re.compile(r'^\s*\[(English|Hindi)\]\s*$', re.MULTILINE | re.IGNORECASE)
+
+# (topic, difficulty, language, math_subtopic) -> questions generated but not yet served
+ready_questions = collections.defaultdict(lambda: collections.deque(maxlen=READY_BUFFER_SIZE))
+
+def parse_bilingual_response(full_response):
+    """{'English': parsed, 'Hindi': parsed} for a complete pair with matching answer keys, else None"""
+    parts = LANGUAGE_SECTION.split(full_response)
+    # split() yields [preamble, name, body, name, body, ...]
+    versions = {}
+    for name, body in zip(parts[1::2], parts[2::2]):
+        versions[name.capitalize()] = parse_question(body)
+    english, hindi = versions.get("English"), versions.get("Hindi")
+    if not english or not hindi:
+        return None
+    if not all(is_complete_question(*version[:3]) for version in (english, hindi)) or english[2] != hindi[2]:
+        return None
+    return versions
+
+def take_ready_question(chat_id, preferences):
+    key = (preferences["topic"], preferences["difficulty"], preferences["language"],
+           preferences.get("math_subtopic") if preferences["topic"] == "General Mathematics" else None)
+    buffer = ready_questions.get(key) or ()
+    for _ in range(len(buffer)):
+        question = buffer.popleft()
+        # The chat that triggered the generation has already seen the other version
+        if question.get('origin_chat_id') != chat_id:
+            inc_counter('mcq_cache_requests_total', cache='ready_buffer', result='hit')
+            return dict(question)
+        buffer.append(question)
+    inc_counter('mcq_cache_requests_total', cache='ready_buffer', result='miss')
+    return None
+
+def buffer_ready_question(question):
+    key = (question['topic'], question['difficulty'], question['language'], question.get('math_subtopic'))
+    ready_questions[key].append(question)
+
+QUESTION_SEPARATOR = re.compile(r'^\s*-{3,}\s*$|(?=^\s*Question:)', re.MULTILINE | re.IGNORECASE)
+
+def generate_mcq_batch(topic, difficulty, chat_id, language, math_subtopic, count):
+    """Generate up to `count` questions in one completion; returns the ones that parse completely"""
+    if llm_breaker.is_rejecting():
+        inc_counter('mcq_llm_short_circuited_total')
+        return []
+    
+    math_subtopic = math_subtopic if topic == "General Mathematics" else None
+    prompt = build_mcq_prompt(topic, difficulty, language, math_subtopic, count)
+    route = choose_route(topic, difficulty, language)
+    started = time.perf_counter()
+    response = request_completion(
+        model=route['model'],
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=route['max_tokens'] * count,
+        temperature=0.7
+    )
+    if response is None:
+        return []
+    generation_info = {'route': route, 'latency': time.perf_counter() - started}
+    record_token_usage(generation_info, route['model'], response.usage)
     
+    questions = []
+    for block in QUESTION_SEPARATOR.split(response.choices[0].message.content.strip()):
+        if not block or not block.strip() or len(questions) == count:
+            continue
+        question_text, options_text, correct_answer, explanation = parse_question(block)
+        if not is_complete_question(question_text, options_text, correct_answer):
+            continue
+        correct_answer, key_check = check_answer_key(topic, math_subtopic, question_text, options_text, correct_answer)
+        if correct_answer is not None:
+            questions.append({
+                'question_text': question_text,
+                'options_text': options_text,
+                'correct_answer': correct_answer,
+                'explanation': explanation,
+                'topic': topic,
+                'difficulty': difficulty,
+                'math_subtopic': math_subtopic,
+                'language': language,
+                'key_check': key_check
+            })
+    inc_counter('mcq_parse_attempts_total', len(questions), result='ok')
+    record_route_outcome(generation_info, len(questions) == count)
+    return questions
+
+def build_mcq_prompt(topic, difficulty, language, math_subtopic, count=1):
     # Get recent questions to avoid repetition
-    recent_questions = get_recent_questions(5)
+    recent_questions = get_recent_questions(5, topic)
     avoid_text = "\n".join([f"- {q}" for q in recent_questions]) if recent_questions else "No recent questions"
     
     # Language instructions
     language_instructions = {
         "English": "Generate the question and all content in English. Use English numerals (1, 2, 3, etc.) for all numbers.",
-        "Hindi": "Generate the question and all content in Hindi. Use English numerals (1, 2, 3, etc.) for all numbers, not Hindi numerals. Keep mathematical expressions in standard English format (1, 2, 3, etc.)."
+        "Hindi": "Generate the question and all content in Hindi. Use English numerals (1, 2, 3, etc.) for all numbers, not Hindi numerals. Keep mathematical expressions in standard English format (1, 2, 3, etc.).",
+        BILINGUAL: "Write the question first in English and then the same question translated into Hindi, with the options in the same order and the same correct answer. Use English numerals (1, 2, 3, etc.) for all numbers in both versions."
     }
     
     # Difficulty prompts
@@ -572,8 +2528,18 @@ def generate_mcq(topic, difficulty, chat_id, language="English", math_subtopic=N
     if topic == "General Mathematics" and math_subtopic:
         math_subtopic_text = f"Focus specifically on: {math_subtopic}"
     
+    if count > 1:
+        request_text = f"Generate {count} different SHORT MCQ questions for {topic} at {difficulty} difficulty level."
+        format_text = "Format each question as follows, with a line containing only --- between questions:"
+    elif language == BILINGUAL:
+        request_text = f"Generate a SHORT MCQ question for {topic} at {difficulty} difficulty level, in English and in Hindi."
+        format_text = "Put a line [English] before the English version and a line [Hindi] before the Hindi version, and format each version as:"
+    else:
+        request_text = f"Generate a SHORT MCQ question for {topic} at {difficulty} difficulty level."
+        format_text = "Format your response as:"
+    
     prompt = f"""
-    Generate a SHORT MCQ question for {topic} at {difficulty} difficulty level.
+    {request_text}
     
     {language_instructions.get(language, language_instructions["English"])}
     {difficulty_prompts.get(difficulty, difficulty_prompts["Medium"])}
@@ -594,7 +2560,7 @@ def generate_mcq(topic, difficulty, chat_id, language="English", math_subtopic=N
     
     Random seed: {random.randint(1000, 9999)}
     
-    Format your response as:
+    {format_text}
     Question: [Your question here]
     A) [Option A]
     B) [Option B]
@@ -603,56 +2569,858 @@ def generate_mcq(topic, difficulty, chat_id, language="English", math_subtopic=N
     Correct Answer: [A/B/C/D]
     Explanation: [One sentence explanation]
     """
-    
+    return prompt
+
+# Topics whose questions can come with a generated image
+IMAGE_MATH_SUBTOPICS = ["data interpretation", "quadratic equations", "geometry", "trigonometry", "statistics"]
+IMAGE_TOPICS = ["General Science", "General Management with MP GK"]
+
+def may_need_image(topic, math_subtopic):
+    if topic == "General Mathematics":
+        return bool(math_subtopic) and any(img_topic in math_subtopic.lower() for img_topic in IMAGE_MATH_SUBTOPICS)
+    return topic in IMAGE_TOPICS
+
+def question_needs_image(topic, math_subtopic, full_response):
+    # Determine if image is needed - ONLY for cases where visual representation is absolutely essential
+    needs_image = False
+    if topic == "General Mathematics" and math_subtopic:
+        # Only for topics that absolutely require visual representation
+        if any(img_topic in math_subtopic.lower() for img_topic in IMAGE_MATH_SUBTOPICS):
+            # Additional check: only generate image if question explicitly mentions visual elements
+            essential_visual_keywords = ["chart", "graph", "diagram", "figure", "triangle", "circle", "rectangle", "bar chart", "pie chart", "plot", "visual"]
+            question_lower = full_response.lower()
+            needs_image = any(keyword in question_lower for keyword in essential_visual_keywords)
+    elif topic in ["General Science"]:
+        # Only for science topics that explicitly mention visual elements
+        essential_science_keywords = ["diagram", "structure", "cell", "molecule", "reaction", "circuit", "organ"]
+        question_lower = full_response.lower()
+        needs_image = any(keyword in question_lower for keyword in essential_science_keywords)
+    elif topic in ["General Management with MP GK"]:
+        # Only for MP topics that explicitly mention maps or diagrams
+        essential_mp_keywords = ["map", "district", "state", "geography", "location", "diagram"]
+        question_lower = full_response.lower()
+        needs_image = any(keyword in question_lower for keyword in essential_mp_keywords)
+    return needs_image
+
+# Math answer verification: for subtopics whose questions follow a known formula,
+# the numbers are pulled out of the question text and the answer is recomputed in
+# a process pool (so a pathological input cannot stall generation). Outcomes are
+# recorded by default; in fix mode a disagreeing key is only changed (or the question
+# regenerated) when the question is worded exactly like a phrase the checks model.
+MATH_VERIFY_MODE = os.getenv('MATH_VERIFY_MODE', 'flag').lower()  # off | flag | fix
+MATH_VERIFY_TIMEOUT_SECONDS = float(os.getenv('MATH_VERIFY_TIMEOUT_SECONDS', '2'))
+MATH_VERIFY_WORKERS = int(os.getenv('MATH_VERIFY_WORKERS', '2'))
+NUMBER = r'(\d+(?:,\d{3})*(?:\.\d+)?)'
+MONEY = r'(?:rs\.?|₹|inr)?\s*'
+verify_pool = None
+verify_pool_warmup = []  # futures that finish once the pool's workers have started
+verify_pool_lock = threading.Lock()
+
+def _number(text):
+    return float(text.replace(',', ''))
+
+def question_numbers(text):
+    return [_number(value) for value in re.findall(NUMBER, text)]
+
+def asked_clause(text):
+    # The part of the question after its last full stop is what is being asked
+    return re.split(r'(?<!\brs\.)(?<=[.!?])\s+', text.strip())[-1]
+
+def option_values(options_text):
+    values = {}
+    for letter, text in re.findall(r'^([A-D])\) (.*)$', options_text, re.MULTILINE):
+        text = text.lower()
+        hours_minutes = re.search(rf'{NUMBER}\s*(?:hours?|hrs?)\s*(?:and\s*)?{NUMBER}\s*min', text)
+        fraction = re.fullmatch(rf'\D*{NUMBER}\s*/\s*{NUMBER}\D*', text)
+        numbers = re.findall(NUMBER, text)
+        if hours_minutes:
+            values[letter] = _number(hours_minutes.group(1)) + _number(hours_minutes.group(2)) / 60
+        elif fraction:
+            values[letter] = _number(fraction.group(1)) / _number(fraction.group(2))
+        elif len(numbers) == 1:
+            values[letter] = _number(numbers[0])
+    return values
+
+def compute_percentage(text):
+    numbers = question_numbers(text)
+    if len(numbers) != 2:
+        return None
+    match = re.search(rf'what (?:percent|percentage) of {MONEY}{NUMBER} is {MONEY}{NUMBER}', text)
+    if match:
+        return _number(match.group(2)) / _number(match.group(1)) * 100
+    match = re.search(rf'{MONEY}{NUMBER} is what (?:percent|percentage) of {MONEY}{NUMBER}', text)
+    if match:
+        return _number(match.group(1)) / _number(match.group(2)) * 100
+    match = re.search(rf'{NUMBER}\s*% of (?:a|the|some) number is {NUMBER}', text)
+    if match:
+        return _number(match.group(2)) * 100 / _number(match.group(1))
+    match = re.search(rf'{NUMBER}\s*% of {MONEY}{NUMBER}', text)
+    if match and text.count('%') == 1:
+        return _number(match.group(1)) * _number(match.group(2)) / 100
+    return None
+
+def compute_profit_loss(text):
+    numbers = question_numbers(text)
+    if len(numbers) != 2:
+        return None
+    asked = asked_clause(text)
+    cost = re.search(rf'(?:cost price|c\.?p\.?|bought|buys|purchased|costs?)\D*?{NUMBER}', text)
+    sold = re.search(rf'(?:selling price|s\.?p\.?|sold|sells)\D*?{NUMBER}', text)
+    rate = re.search(rf'{NUMBER}\s*%\s*(profit|gain|loss)|(profit|gain|loss) of {NUMBER}\s*%', text)
+    if cost and sold and not rate:
+        cost_price, selling_price = _number(cost.group(1)), _number(sold.group(1))
+        if re.search(r'(?:profit|gain|loss)\s*(?:percent|percentage|%)', asked):
+            return abs(selling_price - cost_price) / cost_price * 100
+        if re.search(r'\b(?:profit|gain|loss)\b', asked):
+            return abs(selling_price - cost_price)
+    if cost and rate and 'selling price' in asked:
+        percent = _number(rate.group(1) or rate.group(4))
+        kind = rate.group(2) or rate.group(3)
+        return _number(cost.group(1)) * (1 + (-percent if kind == 'loss' else percent) / 100)
+    return None
+
+def compute_interest(text):
+    numbers = question_numbers(text)
+    if len(numbers) != 3 or 'half' in text or 'quarter' in text or 'month' in text:
+        return None
+    principal = re.search(rf'(?:rs\.?|₹|principal of|sum of|amount of)\s*{NUMBER}', text)
+    rate = re.search(rf'{NUMBER}\s*%', text)
+    years = re.search(rf'{NUMBER}\s*years?', text)
+    if not (principal and rate and years):
+        return None
+    p, r, t = _number(principal.group(1)), _number(rate.group(1)) / 100, _number(years.group(1))
+    if t > 100:
+        return None
+    asked = asked_clause(text)
+    compound = 'compound' in text
+    if 'compound interest' in asked:
+        return p * ((1 + r) ** t - 1)
+    if 'simple interest' in asked or ('interest' in asked and not compound):
+        return p * r * t
+    if 'amount' in asked:
+        return p * (1 + r) ** t if compound else p * (1 + r * t)
+    return None
+
+def compute_time_speed_distance(text):
+    numbers = question_numbers(text)
+    if len(numbers) != 2 or re.search(r'm/s|metres? per second|meters? per second|minutes', text):
+        return None
+    speed = re.search(rf'{NUMBER}\s*(?:km/h|km/hr|kmph|km per hour|kilometers per hour|kilometres per hour)', text)
+    distance = re.search(rf'{NUMBER}\s*(?:km|kilometers|kilometres)\b(?!\s*/|\s*per|ph)', text)
+    duration = re.search(rf'{NUMBER}\s*(?:hours?|hrs?)\b', text)
+    asked = asked_clause(text)
+    if speed and duration and re.search(r'distance|how far', asked):
+        return _number(speed.group(1)) * _number(duration.group(1))
+    if distance and duration and 'speed' in asked:
+        return _number(distance.group(1)) / _number(duration.group(1))
+    if distance and speed and re.search(r'time|how long|how many hours', asked):
+        return _number(distance.group(1)) / _number(speed.group(1))
+    return None
+
+# Wording the extractors do not model (article counts, CI-SI differences, ...): never auto-fixed
+AMBIGUOUS_WORDING = re.compile(r'\b(?:difference|articles?|equals?|equal to|same|successive|ratio|twice|thrice|times|both|'
+                               r'respectively|more than|less than|another|remaining|each)\b')
+# Phrases whose every number is an input of the formula; each number in them is a capture group
+EXPLICIT_PHRASES = {
+    "Percentages": [
+        rf'^what is {NUMBER}\s*% of {MONEY}{NUMBER}\s*\??$',
+        rf'^what (?:percent|percentage) of {MONEY}{NUMBER} is {MONEY}{NUMBER}\s*\??$',
+        rf'^{MONEY}{NUMBER} is what (?:percent|percentage) of {MONEY}{NUMBER}\s*\??$',
+        rf'^{NUMBER}\s*% of (?:a|the|some) number is {NUMBER}\. (?:what|find) (?:is )?the number\s*\??$',
+    ],
+    "Profit and Loss": [
+        rf'^an? \w+ (?:buys|bought|purchases|purchased) (?:an? |the )?(?:\w+ ){{0,2}}for {MONEY}{NUMBER} and (?:sells|sold) it for {MONEY}{NUMBER}\. '
+        rf'what is (?:his|her|the) (?:profit|gain|loss)(?: percent| percentage| %)?\s*\??$',
+        rf'^the cost price of (?:an? |the )?(?:\w+ ){{0,2}}is {MONEY}{NUMBER}\. if it is sold at an? (?:profit|gain|loss) of {NUMBER}\s*%, '
+        rf'what is (?:the|its) selling price\s*\??$',
+    ],
+    "Simple and Compound Interest": [
+        rf'^(?:what is|find) the (?:simple|compound) interest on {MONEY}{NUMBER} at {NUMBER}\s*% per annum for {NUMBER} years'
+        rf'(?:, compounded annually)?\s*[.?]?$',
+    ],
+    "Time, Speed, and Distance": [
+        rf'^an? \w+ runs at a speed of {NUMBER} km/h\. how much distance will it cover in {NUMBER} hours\s*\??$',
+        rf'^an? \w+ covers {NUMBER} km in {NUMBER} hours\. what is its speed\s*\??$',
+        rf'^how many hours will an? \w+ take to cover {NUMBER} km at a speed of {NUMBER} km/h\s*\??$',
+    ],
+}
+EXPLICIT_PHRASES["Rate of Interest"] = EXPLICIT_PHRASES["Simple and Compound Interest"]
+
+def is_explicit_question(math_subtopic, text):
+    """True when exactly one known phrase makes up the question and accounts for all of its numbers"""
+    text = text.strip()
+    if AMBIGUOUS_WORDING.search(text):
+        return False
+    matches = [match for match in (re.search(pattern, text) for pattern in EXPLICIT_PHRASES.get(math_subtopic, ())) if match]
+    return len(matches) == 1 and len(matches[0].groups()) == len(question_numbers(text))
+
+MATH_VERIFIERS = {
+    "Percentages": compute_percentage,
+    "Profit and Loss": compute_profit_loss,
+    "Simple and Compound Interest": compute_interest,
+    "Rate of Interest": compute_interest,
+    "Time, Speed, and Distance": compute_time_speed_distance,
+}
+
+def verify_math_answer(math_subtopic, question_text, options_text, correct_answer):
+    """Runs in the verification pool: returns (outcome, key) with outcome one of
+    verified, fixed, mismatch, suspect or unverifiable. Only fixed and mismatch may act on the key."""
+    text = question_text.lower()
+    expected = MATH_VERIFIERS[math_subtopic](text)
+    if expected is None:
+        return 'unverifiable', correct_answer
+    matching = [letter for letter, value in option_values(options_text).items()
+                if abs(value - expected) <= max(0.01, abs(expected) * 0.005)]
+    if correct_answer in matching:
+        return 'verified', correct_answer
+    if not is_explicit_question(math_subtopic, text):
+        # The loose extraction disagrees, but it may have misread the question
+        return 'suspect', correct_answer
+    if len(matching) == 1:
+        return 'fixed', matching[0]
+    return 'mismatch', correct_answer
+
+# Questions the extractors once misread; verify_math_answer must keep their (correct) keys
+MATH_VERIFY_REGRESSIONS = [
+    ("Profit and Loss", "The cost price of 20 articles is equal to the selling price of 16 articles. Find the profit percent.",
+     "A) 20%\nB) 25%\nC) 16%\nD) 80%\n", "B"),
+    ("Simple and Compound Interest", "What is the difference between the compound interest and simple interest on Rs. 8000 at 10% per annum for 2 years?",
+     "A) Rs. 80\nB) Rs. 160\nC) Rs. 1680\nD) Rs. 1600\n", "A"),
+]
+
+def check_math_verifier():
+    """Run the regression questions through verify_math_answer; returns a list of failures"""
+    failures = []
+    for math_subtopic, question_text, options_text, correct_answer in MATH_VERIFY_REGRESSIONS:
+        outcome, key = verify_math_answer(math_subtopic, question_text, options_text, correct_answer)
+        if key != correct_answer or outcome == 'mismatch':
+            failures.append(f"{math_subtopic}: {question_text} -> {outcome} {key} (expected key {correct_answer})")
+    return failures
+
+def get_verify_pool():
+    global verify_pool, verify_pool_warmup
+    with verify_pool_lock:
+        if verify_pool is None:
+            # spawn, not fork: the bot process has threads, and forking them can deadlock a worker
+            verify_pool = concurrent.futures.ProcessPoolExecutor(max_workers=MATH_VERIFY_WORKERS,
+                                                                 mp_context=multiprocessing.get_context('spawn'))
+            # A spawned worker imports the bot before its first task, which can outlast the timeout
+            verify_pool_warmup = [verify_pool.submit(int) for _ in range(MATH_VERIFY_WORKERS)]
+        return verify_pool
+
+def start_verify_pool():
+    if MATH_VERIFY_MODE != 'off':
+        get_verify_pool()
+
+def recycle_verify_pool(pool):
+    """Replace a broken or stuck pool; a timed-out check keeps its worker busy until killed"""
+    global verify_pool
+    with verify_pool_lock:
+        if verify_pool is not pool:
+            return  # another thread already replaced it
+        verify_pool = None
+    get_verify_pool()
+    for process in list((getattr(pool, '_processes', None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def run_verification(pool, math_subtopic, question_text, options_text, correct_answer):
+    try:
+        with measure('math_verify'):
+            return pool.submit(verify_math_answer, math_subtopic, question_text, options_text,
+                               correct_answer).result(timeout=MATH_VERIFY_TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        # result() gave up but the worker is still computing; kill it so it cannot pile up
+        recycle_verify_pool(pool)
+        return 'timeout', correct_answer
+    except concurrent.futures.process.BrokenProcessPool:
+        # A crashed worker breaks the whole pool; start a fresh one
+        recycle_verify_pool(pool)
+        return 'error', correct_answer
+    except Exception as e:
+        logger.warning("Error verifying answer: %s", e)
+        return 'error', correct_answer
+
+def check_answer_key(topic,math_subtopic, question_text, options_text, correct_answer):
+    """Return (correct_answer, key_check) for a parsed question. The key may be fixed;
+    it is None when the question should be regenerated instead of served."""
+    if MATH_VERIFY_MODE == 'off' or topic != "General Mathematics" or math_subtopic not in MATH_VERIFIERS:
+        return correct_answer, None
+    pool = get_verify_pool()
+    if all(future.done() for future in verify_pool_warmup):
+        outcome, key = run_verification(pool, math_subtopic, question_text, options_text, correct_answer)
+    else:
+        # Serve unchecked rather than wait for the workers to start
+        outcome, key = 'skipped', correct_answer
+
+    inc_counter('mcq_math_verifications_total', subtopic=math_subtopic, outcome=outcome)
+    db_execute("INSERT INTO math_verification_stats (subtopic, outcome, total) VALUES (?, ?, 1) "
+               "ON CONFLICT (subtopic, outcome) DO UPDATE SET total = total + 1", (math_subtopic, outcome))
+    if MATH_VERIFY_MODE == 'flag':
+        return correct_answer, outcome
+    if outcome == 'mismatch':
+        return None, outcome
+    return key, outcome
+
+def math_verification_summary():
+    conn = db_connect()
+    try:
+        rows = conn.execute("SELECT subtopic, outcome, total FROM math_verification_stats ORDER BY subtopic").fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return "Math answer checks: none yet"
+    by_subtopic = collections.defaultdict(dict)
+    for subtopic, outcome, total in rows:
+        by_subtopic[subtopic][outcome] = total
+    lines = ["Math answer checks (wrong keys = fixed + mismatch; suspect = disagreement on wording the checks may misread):"]
+    for subtopic, outcomes in by_subtopic.items():
+        checked = outcomes.get('verified', 0) + outcomes.get('fixed', 0) + outcomes.get('mismatch', 0)
+        wrong = outcomes.get('fixed', 0) + outcomes.get('mismatch', 0)
+        rate = f"{wrong / checked * 100:.1f}%" if checked else "n/a"
+        lines.append(f"  {subtopic}: {wrong}/{checked} wrong ({rate}), " + ", ".join(f"{k} {v}" for k, v in sorted(outcomes.items())))
+    return "\n".join(lines)
+
+# Template questions: formula-based math subtopics are generated locally from
+# randomized parameters, so the key is correct by construction and no AI call is
+# made. Each template returns the English and Hindi (question, explanation), the
+# answer, likely wrong answers as distractors, and the unit the options are shown in.
+TEMPLATE_SHARE = float(os.getenv('TEMPLATE_SHARE', '0.5'))  # share of requests for these subtopics served from templates
+
+TEMPLATE_UNITS = {
+    None: ('{}', '{}'),
+    'rs': ('Rs. {}', '₹{}'),
+    'percent': ('{}%', '{}%'),
+    'km': ('{} km', '{} किमी'),
+    'kmph': ('{} km/h', '{} किमी/घंटा'),
+    'mps': ('{} m/s', '{} मी/से'),
+    'hours': ('{} hours', '{} घंटे'),
+    'years': ('{} years', '{} वर्ष'),
+}
+
+def format_number(value):
+    value = round(value, 2)
+    return str(int(value)) if value == int(value) else f"{value:.2f}".rstrip('0').rstrip('.')
+
+def template_percent_of(rng, difficulty):
+    percent = rng.choice({'Easy': [10, 20, 25, 50], 'Medium': [12, 15, 35, 45, 60, 75], 'Hard': [12.5, 17.5, 37.5, 62.5, 135, 240]}[difficulty])
+    number = rng.randint(2, 25) * 20 if difficulty == 'Easy' else rng.randint(5, 100) * 40
+    answer = number * percent / 100
+    p, a = format_number(percent), format_number(answer)
+    return {
+        'English': (f"What is {p}% of {number}?", f"{p}% of {number} = {number} × {p}/100 = {a}."),
+        'Hindi': (f"{number} का {p}% कितना होगा?", f"{number} का {p}% = {number} × {p}/100 = {a}।"),
+        'answer': answer, 'distractors': [answer / 10, number - answer, answer * 2]
+    }
+
+def template_what_percent(rng, difficulty):
+    percent = rng.choice({'Easy': [5, 10, 20, 25, 40, 50, 75], 'Medium': [15, 35, 45, 60, 80, 120, 150]}[difficulty])
+    number = rng.randint(2, 50) * 20
+    part = number * percent // 100
+    return {
+        'English': (f"{part} is what percent of {number}?", f"({part} ÷ {number}) × 100 = {percent}%."),
+        'Hindi': (f"{part}, {number} का कितना प्रतिशत है?", f"({part} ÷ {number}) × 100 = {percent}%।"),
+        'answer': percent, 'distractors': [number / part * 100, percent * 2, percent + 10], 'unit': 'percent'
+    }
+
+def template_successive_change(rng, difficulty):
+    change = rng.choice([10, 20, 30, 40, 50])
+    answer = change * change / 100
+    a = format_number(answer)
+    return {
+        'English': (f"The price of an article is increased by {change}% and then decreased by {change}%. What is the net percentage decrease in its price?",
+                    f"Net change = {change} − {change} − ({change} × {change})/100 = −{a}%, i.e. a decrease of {a}%."),
+        'Hindi': (f"किसी वस्तु के मूल्य में पहले {change}% की वृद्धि और फिर {change}% की कमी की जाती है। मूल्य में कुल कितने प्रतिशत की कमी होगी?",
+                  f"कुल परिवर्तन = {change} − {change} − ({change} × {change})/100 = −{a}%, अर्थात {a}% की कमी।"),
+        'answer': answer, 'distractors': [0, answer * 2, change / 10], 'unit': 'percent'
+    }
+
+def template_profit_percent(rng, difficulty):
+    percent = rng.choice({'Easy': [5, 10, 20, 25], 'Medium': [12, 15, 30, 35, 40]}[difficulty])
+    cost = rng.randint(2, 50) * 100
+    loss = rng.random() < 0.4
+    selling = cost * (100 - percent) // 100 if loss else cost * (100 + percent) // 100
+    difference = abs(selling - cost)
+    kind, kind_hi = ('loss', 'हानि') if loss else ('profit', 'लाभ')
+    return {
+        'English': (f"A shopkeeper buys an article for Rs. {cost} and sells it for Rs. {selling}. What is his {kind} percentage?",
+                    f"{kind.capitalize()} = Rs. {difference}; {kind} % = {difference}/{cost} × 100 = {percent}%."),
+        'Hindi': (f"एक दुकानदार कोई वस्तु ₹{cost} में खरीदकर ₹{selling} में बेचता है। उसका {kind_hi} प्रतिशत कितना है?",
+                  f"{kind_hi} = ₹{difference}; {kind_hi} % = {difference}/{cost} × 100 = {percent}%।"),
+        'answer': percent, 'distractors': [difference / selling * 100, percent * 2, percent + 5], 'unit': 'percent'
+    }
+
+def template_selling_price(rng, difficulty):
+    percent = rng.choice({'Easy': [10, 20, 25], 'Medium': [8, 12, 15, 18, 35]}[difficulty])
+    cost = rng.randint(2, 50) * 100
+    loss = rng.random() < 0.4
+    answer = cost * (100 - percent) // 100 if loss else cost * (100 + percent) // 100
+    kind, kind_hi = ('loss', 'हानि') if loss else ('profit', 'लाभ')
+    sign = '−' if loss else '+'
+    return {
+        'English': (f"The cost price of an article is Rs. {cost}. If it is sold at a {kind} of {percent}%, what is the selling price?",
+                    f"SP = CP × (100 {sign} {percent})/100 = {cost} × {100 - percent if loss else 100 + percent}/100 = Rs. {answer}."),
+        'Hindi': (f"एक वस्तु का क्रय मूल्य ₹{cost} है। यदि इसे {percent}% {kind_hi} पर बेचा जाए, तो विक्रय मूल्य कितना होगा?",
+                  f"विक्रय मूल्य = क्रय मूल्य × (100 {sign} {percent})/100 = {cost} × {100 - percent if loss else 100 + percent}/100 = ₹{answer}।"),
+        'answer': answer, 'distractors': [2 * cost - answer, cost * percent / 100, cost + percent], 'unit': 'rs'
+    }
+
+def template_cost_price(rng, difficulty):
+    percent = rng.choice([8, 12, 15, 18, 24, 35])
+    answer = rng.randint(5, 90) * 100
+    selling = answer * (100 + percent) // 100
+    return {
+        'English': (f"By selling an article for Rs. {selling}, a shopkeeper gains {percent}%. What is the cost price of the article?",
+                    f"CP = SP × 100/(100 + {percent}) = {selling} × 100/{100 + percent} = Rs. {answer}."),
+        'Hindi': (f"एक दुकानदार कोई वस्तु ₹{selling} में बेचकर {percent}% लाभ कमाता है। वस्तु का क्रय मूल्य कितना है?",
+                  f"क्रय मूल्य = विक्रय मूल्य × 100/(100 + {percent}) = {selling} × 100/{100 + percent} = ₹{answer}।"),
+        'answer': answer, 'distractors': [selling * (100 - percent) / 100, selling * 100 / (100 - percent), answer + 100], 'unit': 'rs'
+    }
+
+def template_simple_interest(rng, difficulty):
+    principal = rng.randint(1, 20) * 1000 if difficulty == 'Easy' else rng.randint(2, 60) * 500
+    rate = rng.choice({'Easy': [4, 5, 8, 10], 'Medium': [6, 7.5, 9, 12, 15]}[difficulty])
+    years = rng.randint(2, 5)
+    answer = principal * rate * years / 100
+    r, a = format_number(rate), format_number(answer)
+    return {
+        'English': (f"What is the simple interest on Rs. {principal} at {r}% per annum for {years} years?",
+                    f"SI = P × R × T/100 = {principal} × {r} × {years}/100 = Rs. {a}."),
+        'Hindi': (f"₹{principal} पर {r}% वार्षिक दर से {years} वर्षों का साधारण ब्याज कितना होगा?",
+                  f"साधारण ब्याज = मूलधन × दर × समय/100 = {principal} × {r} × {years}/100 = ₹{a}।"),
+        'answer': answer, 'distractors': [principal + answer, principal * rate / 100, answer + principal * rate / 100], 'unit': 'rs'
+    }
+
+def template_compound_interest(rng, difficulty):
+    principal = rng.randint(1, 20) * 1000
+    rate = rng.choice([5, 10, 20]) if difficulty == 'Hard' else rng.choice([10, 20])
+    years = rng.choice([2, 3]) if difficulty == 'Hard' else 2
+    amount = principal * (1 + rate / 100) ** years
+    answer = amount - principal
+    a, ci = format_number(amount), format_number(answer)
+    return {
+        'English': (f"What is the compound interest on Rs. {principal} at {rate}% per annum for {years} years, compounded annually?",
+                    f"Amount = P(1 + R/100)^T = {principal} × (1 + {rate}/100)^{years} = Rs. {a}; CI = {a} − {principal} = Rs. {ci}."),
+        'Hindi': (f"₹{principal} पर {rate}% वार्षिक दर से {years} वर्षों का चक्रवृद्धि ब्याज (वार्षिक संयोजन) कितना होगा?",
+                  f"मिश्रधन = P(1 + R/100)^T = {principal} × (1 + {rate}/100)^{years} = ₹{a}; चक्रवृद्धि ब्याज = {a} − {principal} = ₹{ci}।"),
+        'answer': answer, 'distractors': [principal * rate * years / 100, amount, answer + principal * rate / 100], 'unit': 'rs'
+    }
+
+def template_interest_rate(rng, difficulty):
+    principal = rng.randint(1, 20) * 1000
+    rate = rng.choice({'Easy': [5, 10], 'Medium': [4, 6, 8, 12], 'Hard': [3, 7, 9, 11, 14]}[difficulty])
+    years = rng.randint(2, 6)
+    interest = principal * rate * years // 100
+    amount = principal + interest
+    return {
+        'English': (f"At what rate of simple interest per annum will Rs. {principal} amount to Rs. {amount} in {years} years?",
+                    f"SI = {amount} − {principal} = {interest}; R = SI × 100/(P × T) = {interest} × 100/({principal} × {years}) = {rate}%."),
+        'Hindi': (f"साधारण ब्याज की किस वार्षिक दर से ₹{principal} की राशि {years} वर्षों में ₹{amount} हो जाएगी?",
+                  f"साधारण ब्याज = {amount} − {principal} = {interest}; दर = ब्याज × 100/(मूलधन × समय) = {interest} × 100/({principal} × {years}) = {rate}%।"),
+        'answer': rate, 'distractors': [interest * 100 / (amount * years), rate * years, rate + 2], 'unit': 'percent'
+    }
+
+def template_average(rng, difficulty):
+    count = 5 if difficulty == 'Easy' else 7
+    average = rng.randint(10, 60) if difficulty == 'Easy' else rng.randint(50, 200)
+    spread = 10 if difficulty == 'Easy' else 30
+    while True:
+        numbers = [rng.randint(average - spread, average + spread) for _ in range(count - 1)]
+        last = average * count - sum(numbers)
+        if last > 0:
+            break
+    numbers.append(last)
+    total = sum(numbers)
+    listed = ", ".join(str(number) for number in numbers)
+    return {
+        'English': (f"What is the average of {listed}?", f"Sum = {total}; average = {total}/{count} = {average}."),
+        'Hindi': (f"{listed} का औसत कितना है?", f"योग = {total}; औसत = {total}/{count} = {average}।"),
+        'answer': average, 'distractors': [total / (count - 1), total / (count + 1), average + 2]
+    }
+
+def template_average_new_member(rng, difficulty):
+    students = rng.randint(20, 40)
+    average = rng.randint(10, 16)
+    increase = rng.randint(1, 2) if difficulty == 'Hard' else 1
+    answer = (average + increase) * (students + 1) - average * students
+    return {
+        'English': (f"The average age of {students} students in a class is {average} years. When the teacher's age is included, the average increases by {increase} year{'s' if increase > 1 else ''}. What is the teacher's age?",
+                    f"Teacher's age = {average + increase} × {students + 1} − {average} × {students} = {answer} years."),
+        'Hindi': (f"एक कक्षा के {students} छात्रों की औसत आयु {average} वर्ष है। शिक्षक की आयु को शामिल करने पर औसत {increase} वर्ष बढ़ जाता है। शिक्षक की आयु कितनी है?",
+                  f"शिक्षक की आयु = {average + increase} × {students + 1} − {average} × {students} = {answer} वर्ष।"),
+        'answer': answer, 'distractors': [average + students * increase, average + (students - 1) * increase, answer + 2], 'unit': 'years'
+    }
+
+def template_ratio_share(rng, difficulty):
+    size = 3 if difficulty == 'Hard' else 2
+    parts = rng.sample(range(1, 10), size)
+    while math.gcd(*parts) != 1:
+        parts = rng.sample(range(1, 10), size)
+    if size == 3:
+        names, names_hi = "Ram, Shyam and Mohan", "राम, श्याम और मोहन"
+        person, person_hi = "Mohan", "मोहन"
+    else:
+        names, names_hi = "Ram and Shyam", "राम और श्याम"
+        person, person_hi = "Shyam", "श्याम"
+    unit = rng.randint(5, 60) * (10 if difficulty == 'Easy' else 20)
+    total = sum(parts) * unit
+    ratio = ":".join(str(part) for part in parts)
+    answer = parts[-1] * unit
+    return {
+        'English': (f"Rs. {total} is divided among {names} in the ratio {ratio}. What is {person}'s share?",
+                    f"{person}'s share = {total} × {parts[-1]}/{sum(parts)} = Rs. {answer}."),
+        'Hindi': (f"₹{total} को {names_hi} के बीच {ratio} के अनुपात में बाँटा जाता है। {person_hi} का हिस्सा कितना है?",
+                  f"{person_hi} का हिस्सा = {total} × {parts[-1]}/{sum(parts)} = ₹{answer}।"),
+        'answer': answer, 'distractors': [part * unit for part in parts[:-1]] + [total / len(parts)], 'unit': 'rs'
+    }
+
+def template_fourth_proportional(rng, difficulty):
+    first, second = rng.sample(range(2, 16), 2)
+    factor = rng.randint(2, 12)
+    third, answer = first * factor, second * factor
+    return {
+        'English': (f"What is the fourth proportional to {first}, {second} and {third}?",
+                    f"{first} : {second} = {third} : x, so x = {second} × {third}/{first} = {answer}."),
+        'Hindi': (f"{first}, {second} और {third} का चतुर्थानुपाती क्या है?",
+                  f"{first} : {second} = {third} : x, अतः x = {second} × {third}/{first} = {answer}।"),
+        'answer': answer, 'distractors': [first * third / second, second * third, third + second - first]
+    }
+
+def template_distance(rng, difficulty):
+    speed = rng.randint(6, 18) * 5
+    hours = rng.randint(2, 6)
+    answer = speed * hours
+    return {
+        'English': (f"A train runs at a speed of {speed} km/h. How much distance will it cover in {hours} hours?",
+                    f"Distance = speed × time = {speed} × {hours} = {answer} km."),
+        'Hindi': (f"एक रेलगाड़ी {speed} किमी/घंटा की गति से चलती है। वह {hours} घंटे में कितनी दूरी तय करेगी?",
+                  f"दूरी = गति × समय = {speed} × {hours} = {answer} किमी।"),
+        'answer': answer, 'distractors': [speed * (hours + 1), speed * (hours - 1), answer + 10], 'unit': 'km'
+    }
+
+def template_speed(rng, difficulty):
+    answer = rng.randint(6, 18) * 5
+    hours = rng.randint(2, 6)
+    distance = answer * hours
+    return {
+        'English': (f"A car covers {distance} km in {hours} hours. What is its speed?",
+                    f"Speed = distance/time = {distance}/{hours} = {answer} km/h."),
+        'Hindi': (f"एक कार {hours} घंटे में {distance} किमी की दूरी तय करती है। उसकी गति कितनी है?",
+                  f"गति = दूरी/समय = {distance}/{hours} = {answer} किमी/घंटा।"),
+        'answer': answer, 'distractors': [distance / (hours + 1), answer + 5, answer - 5], 'unit': 'kmph'
+    }
+
+def template_travel_time(rng, difficulty):
+    speed = rng.randint(6, 16) * 5
+    answer = rng.randint(2, 9)
+    distance = speed * answer
+    return {
+        'English': (f"How many hours will a bus take to cover {distance} km at a speed of {speed} km/h?",
+                    f"Time = distance/speed = {distance}/{speed} = {answer} hours."),
+        'Hindi': (f"एक बस {speed} किमी/घंटा की गति से {distance} किमी की दूरी कितने घंटे में तय करेगी?",
+                  f"समय = दूरी/गति = {distance}/{speed} = {answer} घंटे।"),
+        'answer': answer, 'distractors': [answer + 1, answer - 1, distance / (speed + 10)], 'unit': 'hours'
+    }
+
+def template_speed_conversion(rng, difficulty):
+    multiple = rng.randint(1, 20)
+    speed = 18 * multiple
+    answer = 5 * multiple
+    return {
+        'English': (f"A train is running at {speed} km/h. What is its speed in metres per second?",
+                    f"km/h × 5/18 = m/s, so {speed} × 5/18 = {answer} m/s."),
+        'Hindi': (f"एक रेलगाड़ी {speed} किमी/घंटा की गति से चल रही है। उसकी गति मीटर प्रति सेकंड में कितनी है?",
+                  f"किमी/घंटा × 5/18 = मी/से, अतः {speed} × 5/18 = {answer} मी/से।"),
+        'answer': answer, 'distractors': [speed * 18 / 5, answer + 5, answer * 2], 'unit': 'mps'
+    }
+
+# (going, returning) speeds whose harmonic mean is a whole number
+AVERAGE_SPEED_PAIRS = [(30, 60), (40, 60), (60, 90), (20, 30), (36, 45), (42, 56), (45, 90), (60, 40), (25, 100), (30, 45)]
+
+def template_average_speed(rng, difficulty):
+    going, returning = rng.choice(AVERAGE_SPEED_PAIRS)
+    answer = 2 * going * returning / (going + returning)
+    a = format_number(answer)
+    return {
+        'English': (f"A person travels from town P to town Q at {going} km/h and returns at {returning} km/h. What is the average speed for the whole journey?",
+                    f"Average speed = 2xy/(x + y) = 2 × {going} × {returning}/({going} + {returning}) = {a} km/h."),
+        'Hindi': (f"एक व्यक्ति नगर P से नगर Q तक {going} किमी/घंटा की गति से जाता है और {returning} किमी/घंटा की गति से लौटता है। पूरी यात्रा में उसकी औसत गति कितनी है?",
+                  f"औसत गति = 2xy/(x + y) = 2 × {going} × {returning}/({going} + {returning}) = {a} किमी/घंटा।"),
+        'answer': answer, 'distractors': [(going + returning) / 2, going * returning / (going + returning), answer + 4], 'unit': 'kmph'
+    }
+
+def template_discounted_price(rng, difficulty):
+    marked = rng.randint(3, 60) * 100
+    discount = rng.choice([10, 20, 25, 30, 50])
+    answer = marked * (100 - discount) // 100
+    return {
+        'English': (f"The marked price of a shirt is Rs. {marked}. If a discount of {discount}% is given, what is the selling price?",
+                    f"SP = {marked} × (100 − {discount})/100 = Rs. {answer}."),
+        'Hindi': (f"एक कमीज़ का अंकित मूल्य ₹{marked} है। {discount}% की छूट देने पर उसका विक्रय मूल्य कितना होगा?",
+                  f"विक्रय मूल्य = {marked} × (100 − {discount})/100 = ₹{answer}।"),
+        'answer': answer, 'distractors': [marked * discount / 100, marked * (100 + discount) / 100, marked - discount], 'unit': 'rs'
+    }
+
+def template_discount_percent(rng, difficulty):
+    marked = rng.randint(3, 60) * 100
+    answer = rng.choice([5, 8, 12, 15, 18, 22, 35, 40])
+    selling = marked * (100 - answer) // 100
+    return {
+        'English': (f"An article marked at Rs. {marked} is sold for Rs. {selling}. What is the discount percentage?",
+                    f"Discount = {marked} − {selling} = Rs. {marked - selling}; discount % = {marked - selling}/{marked} × 100 = {answer}%."),
+        'Hindi': (f"₹{marked} अंकित मूल्य वाली एक वस्तु ₹{selling} में बेची जाती है। छूट प्रतिशत कितना है?",
+                  f"छूट = {marked} − {selling} = ₹{marked - selling}; छूट % = {marked - selling}/{marked} × 100 = {answer}%।"),
+        'answer': answer, 'distractors': [(marked - selling) / selling * 100, answer + 5, 100 - answer], 'unit': 'percent'
+    }
+
+def template_successive_discounts(rng, difficulty):
+    first, second = rng.sample([10, 15, 20, 25, 30, 40, 50], 2)
+    answer = first + second - first * second / 100
+    a = format_number(answer)
+    return {
+        'English': (f"What single discount is equivalent to two successive discounts of {first}% and {second}%?",
+                    f"Single discount = {first} + {second} − ({first} × {second})/100 = {a}%."),
+        'Hindi': (f"{first}% और {second}% की दो क्रमिक छूटों के तुल्य एकल छूट कितनी है?",
+                  f"एकल छूट = {first} + {second} − ({first} × {second})/100 = {a}%।"),
+        'answer': answer, 'distractors': [first + second, (first + second) / 2, answer + 2], 'unit': 'percent'
+    }
+
+def series_question(terms, answer, rule, rule_hi, distractors):
+    listed = ", ".join(str(term) for term in terms)
+    return {
+        'English': (f"Find the next number in the series: {listed}, ?", f"{rule} The next number is {answer}."),
+        'Hindi': (f"श्रृंखला में अगली संख्या ज्ञात कीजिए: {listed}, ?", f"{rule_hi} अगली संख्या {answer} है।"),
+        'answer': answer, 'distractors': distractors
+    }
+
+def template_arithmetic_series(rng, difficulty):
+    start, step = rng.randint(2, 50), rng.randint(2, 15)
+    terms = [start + step * i for i in range(5)]
+    answer = terms[-1] + step
+    return series_question(terms, answer, f"Each term is {step} more than the one before.", f"प्रत्येक पद पिछले पद से {step} अधिक है।",
+                           [answer + step, answer - 1, answer + 2])
+
+def template_geometric_series(rng, difficulty):
+    start, ratio = rng.randint(1, 5), rng.randint(2, 4)
+    terms = [start * ratio ** i for i in range(5)]
+    answer = terms[-1] * ratio
+    return series_question(terms, answer, f"Each term is {ratio} times the one before.", f"प्रत्येक पद पिछले पद का {ratio} गुना है।",
+                           [terms[-1] + terms[-1] - terms[-2], answer + ratio, answer * ratio])
+
+def template_difference_series(rng, difficulty):
+    if rng.random() < 0.5:
+        start, offset = rng.randint(1, 6), rng.choice([-1, 1, 2, 3])
+        terms = [(start + i) ** 2 + offset for i in range(5)]
+        answer = (start + 5) ** 2 + offset
+        sign = '+' if offset > 0 else '−'
+        return series_question(terms, answer, f"The terms are n² {sign} {abs(offset)} for n = {start}, {start + 1}, ...",
+                               f"पद n² {sign} {abs(offset)} हैं, जहाँ n = {start}, {start + 1}, ...",
+                               [terms[-1] + terms[-1] - terms[-2], answer + 1, answer + 2 * (start + 5)])
+    start, step, growth = rng.randint(2, 20), rng.randint(1, 6), rng.randint(1, 4)
+    terms = [start]
+    for i in range(4):
+        terms.append(terms[-1] + step + growth * i)
+    difference = step + growth * 4
+    answer = terms[-1] + difference
+    return series_question(terms, answer, f"The differences grow by {growth} each time, so the next difference is {difference}.",
+                           f"अंतर हर बार {growth} बढ़ता है, इसलिए अगला अंतर {difference} है।",
+                           [answer - growth, answer + growth, terms[-1] + terms[-1] - terms[-2] + 2 * growth])
+
+def template_square_root(rng, difficulty):
+    root = rng.randint(11, 35) if difficulty == 'Easy' else rng.randint(32, 99)
+    # The square with the mirrored last digit ends in the same digit (24² = 576, 26² = 676)
+    mirrored = root - root % 10 + (10 - root % 10) % 10
+    return {
+        'English': (f"What is the square root of {root * root}?", f"{root} × {root} = {root * root}, so √{root * root} = {root}."),
+        'Hindi': (f"{root * root} का वर्गमूल कितना है?", f"{root} × {root} = {root * root}, अतः √{root * root} = {root}।"),
+        'answer': root, 'distractors': [mirrored, root + 1, root - 1]
+    }
+
+def template_cube_root(rng, difficulty):
+    root = rng.randint(6, 30)
+    cube = root ** 3
+    return {
+        'English': (f"What is the cube root of {cube}?", f"{root} × {root} × {root} = {cube}, so ∛{cube} = {root}."),
+        'Hindi': (f"{cube} का घनमूल कितना है?", f"{root} × {root} × {root} = {cube}, अतः ∛{cube} = {root}।"),
+        'answer': root, 'distractors': [root + 1, root - 1, root + 2]
+    }
+
+def template_root_sum(rng, difficulty):
+    square_root, cube_root = rng.randint(12, 40), rng.randint(4, 15)
+    square, cube = square_root ** 2, cube_root ** 3
+    answer = square_root + cube_root
+    return {
+        'English': (f"What is the value of √{square} + ∛{cube}?", f"√{square} = {square_root} and ∛{cube} = {cube_root}, so the value is {square_root} + {cube_root} = {answer}."),
+        'Hindi': (f"√{square} + ∛{cube} का मान कितना है?", f"√{square} = {square_root} और ∛{cube} = {cube_root}, अतः मान = {square_root} + {cube_root} = {answer}।"),
+        'answer': answer, 'distractors': [answer + 1, answer - 2, square_root + cube_root + 10]
+    }
+
+ALL_DIFFICULTIES = ("Easy", "Medium", "Hard")
+INTEREST_TEMPLATES = [(("Easy", "Medium"), template_simple_interest), (("Medium", "Hard"), template_compound_interest),
+                      (ALL_DIFFICULTIES, template_interest_rate)]
+# math_subtopic -> [(difficulties, template)]
+MATH_TEMPLATES = {
+    "Percentages": [(ALL_DIFFICULTIES, template_percent_of), (("Easy", "Medium"), template_what_percent),
+                    (("Hard",), template_successive_change)],
+    "Profit and Loss": [(("Easy", "Medium"), template_profit_percent), (("Easy", "Medium"), template_selling_price),
+                        (("Hard",), template_cost_price)],
+    "Simple and Compound Interest": INTEREST_TEMPLATES,
+    "Rate of Interest": INTEREST_TEMPLATES,
+    "Averages": [(("Easy", "Medium"), template_average), (("Medium", "Hard"), template_average_new_member)],
+    "Ratio and Proportion": [(ALL_DIFFICULTIES, template_ratio_share), (("Medium", "Hard"), template_fourth_proportional)],
+    "Time, Speed, and Distance": [(("Easy",), template_distance), (("Easy", "Medium"), template_speed),
+                                  (("Medium",), template_travel_time), (("Medium", "Hard"), template_speed_conversion),
+                                  (("Hard",), template_average_speed)],
+    "Discounts": [(("Easy", "Medium"), template_discounted_price), (("Medium", "Hard"), template_discount_percent),
+                  (("Hard",), template_successive_discounts)],
+    "Number Series": [(("Easy",), template_arithmetic_series), (("Easy", "Medium"), template_geometric_series),
+                      (("Medium", "Hard"), template_difference_series)],
+    "Square Root and Cube Root": [(("Easy", "Hard"), template_square_root), (("Medium", "Hard"), template_cube_root),
+                                  (("Hard",), template_root_sum)],
+}
+
+def template_options(rng, answer, distractors):
+    """Return the four shuffled option values and the letter of the answer"""
+    answer = round(answer, 2)
+    values = []
+    for value in distractors:
+        value = round(value, 2)
+        if value >= 0 and value != answer and value not in values:
+            values.append(value)
+    # Too few distinct distractors: take the nearest values on either side of the answer
+    step = max(1, round(abs(answer) / 10))
+    offset = 1
+    while len(values) < 3:
+        for value in (answer + step * offset, answer - step * offset):
+            if value > 0 and value not in values and len(values) < 3:
+                values.append(value)
+        offset += 1
+    values = values[:3] + [answer]
+    rng.shuffle(values)
+    return values, 'ABCD'[values.index(answer)]
+
+def build_template_question(math_subtopic, difficulty, language, rng=random):
+    """Return question_data for a new template question, or None when the subtopic has no template at this difficulty"""
+    templates = [template for difficulties, template in MATH_TEMPLATES.get(math_subtopic, ()) if difficulty in difficulties]
+    if not templates:
+        return None
+    question = rng.choice(templates)(rng, difficulty)
+    values, correct_answer = template_options(rng, question['answer'], question['distractors'])
+    hindi = language == "Hindi"
+    unit = TEMPLATE_UNITS[question.get('unit')][1 if hindi else 0]
+    question_text, explanation = question["Hindi" if hindi else "English"]
+    return {
+        'question_text': question_text,
+        'options_text': "".join(f"{letter}) {unit.format(format_number(value))}\n" for letter, value in zip('ABCD', values)),
+        'correct_answer': correct_answer,
+        'explanation': explanation,
+        'topic': "General Mathematics",
+        'difficulty': difficulty,
+        'math_subtopic': math_subtopic,
+        'language': "Hindi" if hindi else "English",
+        'key_check': 'template',
+        'is_template': True
+    }
+
+def has_templates(preferences):
+    return preferences["topic"] == "General Mathematics" and preferences.get("math_subtopic") in MATH_TEMPLATES
+
+def prefers_template(preferences):
+    return TEMPLATE_SHARE > 0 and has_templates(preferences) and random.random() < TEMPLATE_SHARE
+
+def make_template_questions(preferences, count, reason):
+    """Build and store up to `count` template questions for the user's preferences"""
+    if not has_templates(preferences):
+        return []
+    with measure('template_question'):
+        questions = [build_template_question(preferences["math_subtopic"], preferences["difficulty"], preferences["language"])
+                     for _ in range(count)]
+    questions = [question for question in questions if question]
+    if questions:
+        save_questions_to_db(questions)
+        inc_counter('mcq_template_questions_total', len(questions), subtopic=preferences["math_subtopic"], reason=reason)
+    return questions
+
+def prepare_offline_question(chat_id, preferences, reason, use_stored=True):
+    """A due review, else a template question, else (with use_stored) a stored one; never calls the AI"""
+    question_data = get_due_review(chat_id) or next(iter(make_template_questions(preferences, 1, reason)), None)
+    if question_data is None and use_stored:
+        question_data = get_fallback_question(chat_id, preferences)
+        inc_counter('mcq_fallback_questions_total', result='hit' if question_data else 'miss')
+    return question_data
+
+# Streaming generation: the question is sent as soon as its four options have
+# arrived, while the answer key and explanation are still being generated
+STREAMING_GENERATION = os.getenv('STREAMING_GENERATION', 'off').lower() in ('1', 'on', 'true', 'yes')
+
+class StreamingMCQParser:
+    OPTIONS_END = re.compile(r'^\s*D\)[^\n]*\S[^\n]*\n', re.MULTILINE)
+    ANSWER_START = re.compile(r'Correct Answer|Answer:', re.IGNORECASE)
+
+    def __init__(self):
+        self.text = ""
+
+    def feed(self, piece):
+        self.text += piece
+
+    def options_end(self):
+        # Option D is complete once its line has ended or the answer section has begun
+        ends = [match.start() for match in [self.ANSWER_START.search(self.text)] if match]
+        options_match = self.OPTIONS_END.search(self.text)
+        if options_match:
+            ends.append(options_match.end())
+        return min(ends) if ends else None
+
+    def question_and_options(self):
+        """(question_text, options_text) from the part streamed so far, or None while options are still arriving"""
+        end = self.options_end()
+        if end is None:
+            return None
+        question_text, options_text, _, _ = parse_question(self.text[:end])
+        if not is_complete_question(question_text, options_text, 'A'):
+            return None
+        return question_text, options_text
+
+def stream_completion(loop, queue, kwargs, abandoned):
+    """Run a streamed chat completion, handing text pieces to the event loop's queue; returns the usage.
+    Stops reading (and returns None) once the abandoned event is set."""
+    usage = None
+    started = time.perf_counter()
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=500,
-            temperature=0.7
-        )
-        
-        full_response = response.choices[0].message.content.strip()
-        
-        # Determine if image is needed - ONLY for cases where visual representation is absolutely essential
-        needs_image = False
-        if topic == "General Mathematics" and math_subtopic:
-            # Only for topics that absolutely require visual representation
-            essential_visual_topics = ["data interpretation", "quadratic equations", "geometry", "trigonometry", "statistics"]
-            if any(img_topic in math_subtopic.lower() for img_topic in essential_visual_topics):
-                # Additional check: only generate image if question explicitly mentions visual elements
-                essential_visual_keywords = ["chart", "graph", "diagram", "figure", "triangle", "circle", "rectangle", "bar chart", "pie chart", "plot", "visual"]
-                question_lower = full_response.lower()
-                needs_image = any(keyword in question_lower for keyword in essential_visual_keywords)
-        elif topic in ["General Science"]:
-            # Only for science topics that explicitly mention visual elements
-            essential_science_keywords = ["diagram", "structure", "cell", "molecule", "reaction", "circuit", "organ"]
-            question_lower = full_response.lower()
-            needs_image = any(keyword in question_lower for keyword in essential_science_keywords)
-        elif topic in ["General Management with MP GK"]:
-            # Only for MP topics that explicitly mention maps or diagrams
-            essential_mp_keywords = ["map", "district", "state", "geography", "location", "diagram"]
-            question_lower = full_response.lower()
-            needs_image = any(keyword in question_lower for keyword in essential_mp_keywords)
-        
-        return full_response, topic, math_subtopic, needs_image
-        
-    except Exception as e:
-        print(f"Error generating MCQ: {e}")
-        return "Error generating question", topic, math_subtopic, False
+        stream = get_openai_client().chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        for chunk in stream:
+            if abandoned.is_set():
+                stream.close()
+                return None
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                loop.call_soon_threadsafe(queue.put_nowait, chunk.choices[0].delta.content)
+        llm_latencies[kwargs.get('model')].append(time.perf_counter() - started)
+        return usage
+    finally:
+        loop.call_soon_threadsafe(queue.put_nowait, None)
 
 # Interface texts
 interface_texts = {
     "English": {
-        "welcome": "Welcome to MCQ Practice Bot! 📚\n\nThis bot helps you practice multiple choice questions for various topics.\n\nCommands:\n/start - Start the bot\n/help - Show help\n/question - Get a manual question\n/settings - Configure preferences\n/stats - View your statistics\n/language - Change language",
-        "help_text": "MCQ Practice Bot Help 📖\n\nCommands:\n/start - Start the bot\n/help - Show help\n/question - Get a manual question\n/settings - Configure preferences\n/stats - View your statistics\n/language - Change language\n\nRate Limit: 5 seconds between questions",
+        "welcome": "Welcome to MCQ Practice Bot! 📚\n\nThis bot helps you practice multiple choice questions for various topics.\n\nCommands:\n/start - Start the bot\n/help - Show help\n/question - Get a manual question\n/settings - Configure preferences\n/stats - View your statistics\n/language - Change language\n/schedule <minutes|off> - How often scheduled questions arrive\n/quiet <start> <end> - Hours with no scheduled questions",
+        "help_text": "MCQ Practice Bot Help 📖\n\nCommands:\n/start - Start the bot\n/help - Show help\n/question - Get a manual question\n/settings - Configure preferences\n/stats - View your statistics\n/language - Change language\n/schedule <minutes|off> - How often scheduled questions arrive\n/quiet <start> <end> - Hours with no scheduled questions\n\nRate Limit: 5 seconds between questions",
         "question_ready": "📝 Question Ready!",
+        "review_ready": "🔁 Review Question!",
         "topic": "Topic:",
         "difficulty": "Difficulty:",
         "question": "Question:",
         "reply_instruction": "Reply with A, B, C, or D to answer.",
         "cooldown_message": "⏰ Please wait {remaining:.1f} seconds before requesting another question.",
         "processing_message": "⏳ Your question is being prepared... Please wait.",
+        "service_unavailable": "⚠️ Questions are temporarily unavailable. Please try again in a minute.",
+        "answer_key_pending": "⏳ The answer key is still being prepared. Please answer again in a moment.",
+        "question_withdrawn": "⚠️ That question could not be completed and has been withdrawn. Here is another one.",
+        "quiz_started": "🧩 Quiz: {count} questions. Tap an option in each poll to answer.",
+        "quiz_finished": "🏁 Quiz finished! {correct}/{answered} correct ({total} questions).",
+        "quiz_usage": "Usage: /quiz [number of questions, 1-{max}] or /quiz stop",
+        "quiz_none": "No quiz in progress. Start one with /quiz.",
         "correct_answer": "✅ Correct!",
         "wrong_answer": "❌ Incorrect!",
         "correct_option": "The correct answer is:",
@@ -662,18 +3430,28 @@ interface_texts = {
         "correct_answers": "Correct Answers:",
         "wrong_answers": "Wrong Answers:",
         "accuracy": "Accuracy:",
+        "by_topic": "📚 By Topic:",
+        "by_difficulty": "🎯 By Difficulty:",
         "reset_stats": "Reset Stats"
     },
     "Hindi": {
-        "welcome": "MCQ अभ्यास बॉट में आपका स्वागत है! 📚\n\nयह बॉट विभिन्न विषयों के लिए बहुविकल्पीय प्रश्नों का अभ्यास करने में आपकी मदद करता है।\n\nकमांड:\n/start - बॉट शुरू करें\n/help - सहायता दिखाएं\n/question - मैनुअल प्रश्न प्राप्त करें\n/settings - प्राथमिकताएं कॉन्फ़िगर करें\n/stats - अपने आंकड़े देखें\n/language - भाषा बदलें",
-        "help_text": "MCQ अभ्यास बॉट सहायता 📖\n\nकमांड:\n/start - बॉट शुरू करें\n/help - सहायता दिखाएं\n/question - मैनुअल प्रश्न प्राप्त करें\n/settings - प्राथमिकताएं कॉन्फ़िगर करें\n/stats - अपने आंकड़े देखें\n/language - भाषा बदलें\n\nदर सीमा: प्रश्नों के बीच 5 सेकंड",
+        "welcome": "MCQ अभ्यास बॉट में आपका स्वागत है! 📚\n\nयह बॉट विभिन्न विषयों के लिए बहुविकल्पीय प्रश्नों का अभ्यास करने में आपकी मदद करता है।\n\nकमांड:\n/start - बॉट शुरू करें\n/help - सहायता दिखाएं\n/question - मैनुअल प्रश्न प्राप्त करें\n/settings - प्राथमिकताएं कॉन्फ़िगर करें\n/stats - अपने आंकड़े देखें\n/language - भाषा बदलें\n/schedule <मिनट|off> - निर्धारित प्रश्न कितनी बार आएं\n/quiet <शुरू> <अंत> - बिना निर्धारित प्रश्नों के घंटे",
+        "help_text": "MCQ अभ्यास बॉट सहायता 📖\n\nकमांड:\n/start - बॉट शुरू करें\n/help - सहायता दिखाएं\n/question - मैनुअल प्रश्न प्राप्त करें\n/settings - प्राथमिकताएं कॉन्फ़िगर करें\n/stats - अपने आंकड़े देखें\n/language - भाषा बदलें\n/schedule <मिनट|off> - निर्धारित प्रश्न कितनी बार आएं\n/quiet <शुरू> <अंत> - बिना निर्धारित प्रश्नों के घंटे\n\nदर सीमा: प्रश्नों के बीच 5 सेकंड",
         "question_ready": "📝 प्रश्न तैयार!",
+        "review_ready": "🔁 दोहराव प्रश्न!",
         "topic": "विषय:",
         "difficulty": "कठिनाई:",
         "question": "प्रश्न:",
         "reply_instruction": "उत्तर देने के लिए A, B, C, या D का उत्तर दें।",
         "cooldown_message": "⏰ कृपया दूसरा प्रश्न मांगने से पहले {remaining:.1f} सेकंड प्रतीक्षा करें।",
         "processing_message": "⏳ आपका प्रश्न तैयार हो रहा है... कृपया प्रतीक्षा करें।",
+        "service_unavailable": "⚠️ प्रश्न अभी उपलब्ध नहीं हैं। कृपया एक मिनट बाद पुनः प्रयास करें।",
+        "answer_key_pending": "⏳ उत्तर कुंजी अभी तैयार हो रही है। कृपया थोड़ी देर बाद फिर से उत्तर दें।",
+        "question_withdrawn": "⚠️ वह प्रश्न पूरा नहीं हो सका और वापस ले लिया गया है। यह रहा दूसरा प्रश्न।",
+        "quiz_started": "🧩 क्विज़: {count} प्रश्न। उत्तर देने के लिए हर पोल में एक विकल्प चुनें।",
+        "quiz_finished": "🏁 क्विज़ पूरा हुआ! {correct}/{answered} सही ({total} प्रश्न)।",
+        "quiz_usage": "उपयोग: /quiz [प्रश्नों की संख्या, 1-{max}] या /quiz stop",
+        "quiz_none": "कोई क्विज़ नहीं चल रहा है। /quiz से शुरू करें।",
         "correct_answer": "✅ सही!",
         "wrong_answer": "❌ गलत!",
         "correct_option": "सही उत्तर है:",
@@ -683,12 +3461,13 @@ interface_texts = {
         "correct_answers": "सही उत्तर:",
         "wrong_answers": "गलत उत्तर:",
         "accuracy": "सटीकता:",
+        "by_topic": "📚 विषय अनुसार:",
+        "by_difficulty": "🎯 कठिनाई अनुसार:",
         "reset_stats": "आंकड़े रीसेट करें"
     }
 }
 
 # Global variables
-active_questions = {}
 app = None
 
 # Bot commands
@@ -705,15 +3484,312 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     texts = interface_texts["English"]
     await update.message.reply_text(texts["help_text"])
 
+def is_complete_question(question_text, options_text, correct_answer):
+    return (correct_answer in ['A', 'B', 'C', 'D'] and question_text != "Question not found"
+            and len(re.findall(r'^[A-D]\) \S', options_text, re.MULTILINE)) == 4)
+
+def prepare_question(chat_id, preferences):
+    """Return (question_data, needs_image) for the user's next question: a due review if any, else a fresh one.
+    question_data is None when nothing can be served."""
+    review = get_due_review(chat_id)
+    inc_counter('mcq_cache_requests_total', cache='review', result='hit' if review else 'miss')
+    if review:
+        return review, False
+    
+    selected_topic = preferences["topic"]
+    difficulty = preferences["difficulty"]
+    language = preferences["language"]
+    math_subtopic = preferences.get("math_subtopic")
+    
+    bilingual = BILINGUAL_GENERATION and language in ("English", "Hindi")
+    if bilingual:
+        ready = take_ready_question(chat_id, preferences)
+        if ready:
+            return ready, False
+    
+    # Generate question with validation
+    max_attempts = 3
+    generated = False
+    for attempt in range(max_attempts):
+        generation_info = {}
+        full_response, topic, math_subtopic, needs_image = generate_mcq(selected_topic, difficulty, chat_id, BILINGUAL if bilingual else language,
+                                                                         math_subtopic, generation_info)
+        if full_response is None:
+            # LLM errored or the circuit is open; retrying right away will not help
+            break
+        if bilingual:
+            versions = parse_bilingual_response(full_response)
+            question_text, options_text, correct_answer, explanation = versions[language] if versions else (None, None, None, None)
+        else:
+            question_text, options_text, correct_answer, explanation = parse_question(full_response)
+        
+        parsed = bool(question_text) and is_complete_question(question_text, options_text, correct_answer)
+        key_check = None
+        if parsed:
+            # The Hindi version of a pair shares the key, and its English twin is what the checks can read
+            check_text, check_options = versions["English"][:2] if bilingual else (question_text, options_text)
+            correct_answer, key_check = check_answer_key(topic, math_subtopic, check_text, check_options, correct_answer)
+            parsed = correct_answer is not None
+        record_route_outcome(generation_info, parsed)
+        if parsed:
+            inc_counter('mcq_parse_attempts_total', result='ok')
+            generated = True
+            break
+        inc_counter('mcq_parse_attempts_total', result='failed' if attempt == max_attempts - 1 else 'retry')
+    
+    # Never store or send a broken question; serve a template question or one from the stored bank instead
+    if not generated:
+        templates = make_template_questions(preferences, 1, 'fallback')
+        if templates:
+            return templates[0], False
+        fallback = get_fallback_question(chat_id, preferences)
+        inc_counter('mcq_fallback_questions_total', result='hit' if fallback else 'miss')
+        return fallback, False
+    
+    math_subtopic = math_subtopic if topic == "General Mathematics" else None
+    
+    if bilingual:
+        pair = [{'question_text': version[0], 'options_text': version[1], 'correct_answer': correct_answer, 'explanation': version[3],
+                 'topic': topic, 'difficulty': difficulty, 'math_subtopic': math_subtopic, 'language': name, 'key_check': key_check,
+                 'origin_chat_id': chat_id}
+                for name, version in versions.items()]
+        save_questions_to_db(pair, paired=True)
+        question_data = next(question for question in pair if question['language'] == language)
+        for question in pair:
+            if question is not question_data:
+                buffer_ready_question(question)
+        question_data['full_response'] = full_response
+        return question_data, needs_image
+    
+    # Save question to database
+    question_id = save_question_to_db(topic, difficulty, question_text, correct_answer, explanation, math_subtopic, options_text, language, key_check)
+    
+    question_data = {
+        'question_id': question_id,
+        'question_text': question_text,
+        'options_text': options_text,
+        'correct_answer': correct_answer,
+        'explanation': explanation,
+        'topic': topic,
+        'difficulty': difficulty,
+        'math_subtopic': math_subtopic,
+        'full_response': full_response
+    }
+    return question_data, needs_image
+
+def format_question_message(question_data, texts):
+    difficulty_emoji = {"Easy": "🟢", "Medium": "🟡", "Hard": "🔴"}
+    topic = question_data['topic']
+    difficulty = question_data['difficulty']
+    
+    # Include subtopic for General Mathematics
+    topic_display = topic
+    if topic == "General Mathematics" and question_data.get('math_subtopic'):
+        topic_display = f"{topic} - {question_data['math_subtopic']}"
+    
+    header = texts['review_ready'] if question_data.get('is_review') else texts['question_ready']
+    return f"{header}\n{texts['topic']} {topic_display}\n{texts['difficulty']} {difficulty_emoji.get(difficulty, '🟡')} {difficulty}\n\n{texts['question']} {question_data['question_text']}\n\n{question_data['options_text']}\n\n{texts['reply_instruction']}"
+
+# Telegram file_ids of images already uploaded, by question id, so a re-sent question reuses its image
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', '1000'))
+image_file_ids = collections.OrderedDict()
+
+def remember_image(question_id, file_id):
+    if question_id is None:
+        return
+    image_file_ids[question_id] = file_id
+    image_file_ids.move_to_end(question_id)
+    while len(image_file_ids) > IMAGE_CACHE_SIZE:
+        image_file_ids.popitem(last=False)
+
+async def send_question_message(bot, chat_id, question_data, needs_image, texts):
+    question_message = format_question_message(question_data, texts)
+    
+    cached_file_id = image_file_ids.get(question_data.get('question_id'))
+    inc_counter('mcq_cache_requests_total', cache='image_file_id', result='hit' if cached_file_id else 'miss')
+    if cached_file_id:
+        try:
+            with measure('telegram_send', method='send_photo'):
+                await bot.send_photo(chat_id=chat_id, photo=cached_file_id, caption=question_message, parse_mode="Markdown")
+            return
+        except Exception as e:
+            logger.warning("Error sending cached image: %s", e)
+            image_file_ids.pop(question_data.get('question_id'), None)
+    
+    # Generate and send image if needed
+    if needs_image:
+        try:
+            topic = question_data['topic']
+            math_subtopic = question_data.get('math_subtopic')
+            logger.info("Generating image for topic: %s, math_subtopic: %s", topic, math_subtopic)
+            image_url = generate_question_image(topic, math_subtopic, question_data['question_text'], question_data['options_text'])
+            if image_url:
+                image_filename = f"temp_question_{chat_id}.png"
+                if download_image(image_url, image_filename):
+                    with open(image_filename, 'rb') as photo, measure('telegram_send', method='send_photo'):
+                        message = await bot.send_photo(chat_id=chat_id, photo=photo, caption=question_message, parse_mode="Markdown")
+                    if message.photo:
+                        remember_image(question_data.get('question_id'), message.photo[-1].file_id)
+                    try:
+                        os.remove(image_filename)
+                    except:
+                        pass
+                    return
+        except Exception as e:
+            logger.exception("Error with image generation")
+    
+    with measure('telegram_send', method='send_message'):
+        await bot.send_message(chat_id=chat_id, text=question_message, parse_mode="Markdown")
+
+async def stream_question(bot, chat_id, preferences, texts):
+    """Generate a question over a streamed completion and send it once its options are in.
+    Returns True when a complete question was delivered, None when the caller should fall back to prepare_question."""
+    if not llm_breaker.allow_request():
+        inc_counter('mcq_llm_short_circuited_total')
+        return None
+    
+    try:
+        topic = preferences["topic"]
+        difficulty = preferences["difficulty"]
+        language = preferences["language"]
+        math_subtopic = preferences.get("math_subtopic") if topic == "General Mathematics" else None
+        route = choose_route(topic, difficulty, language)
+        generation_info = {'route': route}
+        prompt = await asyncio.to_thread(build_mcq_prompt, topic, difficulty, language, math_subtopic)
+        
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        kwargs = {'model': route['model'], 'messages': [{"role": "user", "content": prompt}],
+                  'max_tokens': route['max_tokens'], 'temperature': 0.7}
+        started = time.perf_counter()
+        abandoned = threading.Event()
+        future = llm_executor.submit(contextvars.copy_context().run, stream_completion, loop, queue, kwargs, abandoned)
+    except BaseException:
+        # The request (possibly the half-open probe) was allowed above; settle it so the breaker is not left probing
+        llm_breaker.record_failure()
+        raise
+    
+    parser = StreamingMCQParser()
+    question_data = None
+    usage = None
+    finished = False
+    try:
+        with measure('openai_stream'):
+            while True:
+                piece = await asyncio.wait_for(queue.get(), LLM_TIMEOUT_SECONDS)
+                if piece is None:
+                    break
+                parser.feed(piece)
+                if question_data is None:
+                    head = parser.question_and_options()
+                    if head:
+                        # The answer key stays None until the rest of the completion arrives
+                        question_data = {
+                            'question_id': None, 'question_text': head[0], 'options_text': head[1],
+                            'correct_answer': None, 'explanation': None, 'topic': topic,
+                            'difficulty': difficulty, 'math_subtopic': math_subtopic, 'sent_at': time.time()
+                        }
+                        await run_state(state_backend.set_active_question, chat_id, question_data)
+                        with measure('telegram_send', method='send_message'):
+                            await bot.send_message(chat_id=chat_id, text=format_question_message(question_data, texts), parse_mode="Markdown")
+                        observe_latency('mcq_stream_first_question_seconds', time.perf_counter() - started)
+            usage = await asyncio.wrap_future(future)
+        finished = True
+        llm_breaker.record_success()
+    except Exception as e:
+        inc_counter('mcq_llm_errors_total', model=route['model'])
+        logger.error("Error streaming MCQ: %s", e)
+    finally:
+        if not finished:
+            llm_breaker.record_failure()
+            # Failed, timed out or cancelled: stop the worker thread and still account for the tokens
+            # the provider billed, estimated from what was sent and received unless the usage chunk came
+            abandoned.set()
+            if future.done() and not future.cancelled() and future.exception() is None:
+                usage = future.result()
+            elif parser.text or not future.done():
+                usage = estimate_usage(prompt, parser.text)
+                inc_counter('mcq_llm_usage_estimated_total', model=route['model'])
+            record_token_usage(generation_info, route['model'], usage)
+    
+    full_response = parser.text.strip()
+    question_text, options_text, correct_answer, explanation = parse_question(full_response) if full_response else (None, None, None, None)
+    parsed = finished and is_complete_question(question_text, options_text, correct_answer)
+    key_check = None
+    if parsed:
+        correct_answer, key_check = await asyncio.to_thread(check_answer_key, topic, math_subtopic, question_text, options_text, correct_answer)
+        parsed = correct_answer is not None
+    generation_info['latency'] = time.perf_counter() - started
+    if finished:
+        record_token_usage(generation_info, route['model'], usage)
+    if full_response:
+        record_route_outcome(generation_info, parsed)
+    inc_counter('mcq_stream_generations_total', result='ok' if parsed else ('withdrawn' if question_data else 'failed'))
+    
+    if not parsed:
+        if question_data is not None:
+            await run_state(state_backend.pop_active_question, chat_id)
+            await bot.send_message(chat_id=chat_id, text=texts['question_withdrawn'])
+        return None
+    
+    question_id = await asyncio.to_thread(save_question_to_db, topic, difficulty, question_text, correct_answer, explanation, math_subtopic,
+                                          options_text, language, key_check)
+    if question_data is None:
+        # The options only became parseable at the very end; send the finished question as usual
+        question_data = {'question_text': question_text, 'options_text': options_text, 'topic': topic,
+                         'difficulty': difficulty, 'math_subtopic': math_subtopic, 'sent_at': time.time()}
+        await send_question_message(bot, chat_id, question_data, False, texts)
+    # Keep the text the user was shown; only the key and the stored id are filled in
+    question_data.update({'question_id': question_id, 'correct_answer': correct_answer,
+                          'explanation': explanation, 'full_response': full_response})
+    await run_state(state_backend.set_active_question, chat_id, question_data)
+    return True
+
+async def deliver_question(bot, chat_id, preferences, texts, source='question'):
+    """Prepare, store and send the user's next question; returns False when nothing could be served"""
+    token = start_ledger(chat_id, source, preferences)
+    outcome = 'failed'
+    try:
+        question_data = needs_image = None
+        over_budget = await asyncio.to_thread(budget_exceeded, chat_id) if USER_DAILY_BUDGET_USD or DAILY_BUDGET_USD else None
+        if over_budget:
+            # No new generation once a budget is spent: a due review, a template or a stored question, else nothing
+            question_data = await asyncio.to_thread(prepare_offline_question, chat_id, preferences, 'budget')
+            if question_data is None:
+                return False
+        elif prefers_template(preferences):
+            question_data = await asyncio.to_thread(prepare_offline_question, chat_id, preferences, 'share', False)
+        # Streamed questions go out as plain text, so topics that may need an image take the regular path
+        elif STREAMING_GENERATION and not may_need_image(preferences["topic"], preferences.get("math_subtopic")):
+            question_data = await asyncio.to_thread(get_due_review, chat_id)
+            if question_data is None and await stream_question(bot, chat_id, preferences, texts):
+                outcome = 'generated'
+                return True
+        if question_data is None:
+            # Generation blocks on the network, so it runs in a worker thread
+            question_data, needs_image = await asyncio.to_thread(prepare_question, chat_id, preferences)
+        if question_data is None:
+            return False
+        outcome = 'generated' if question_data.get('full_response') else ('template' if question_data.get('is_template') else 'stored')
+        
+        # Store active question
+        question_data['sent_at'] = time.time()
+        await run_state(state_backend.set_active_question, chat_id, question_data)
+        
+        await send_question_message(bot, chat_id, question_data, needs_image, texts)
+        return True
+    finally:
+        await finish_ledger(token, outcome)
+
 async def manual_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Atomically check if user can process and set processing flag
-    if not check_and_set_processing(chat_id):
+    if not await run_state(check_and_set_processing, chat_id):
         preferences = get_user_preferences(chat_id)
         language = preferences.get("language", "English")
         
-        remaining_time = get_cooldown_remaining(chat_id)
+        remaining_time = await run_state(get_cooldown_remaining, chat_id)
         if remaining_time > 0:
             texts = interface_texts.get(language, interface_texts["English"])
             cooldown_message = texts["cooldown_message"].format(remaining=remaining_time)
@@ -730,171 +3806,96 @@ async def manual_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Get user preferences
         preferences = get_user_preferences(chat_id)
-        selected_topic = preferences["topic"]
-        difficulty = preferences["difficulty"]
-        language = preferences["language"]
-        math_subtopic = preferences.get("math_subtopic")
-        
-        # Generate question with validation
-        max_attempts = 3
-        for attempt in range(max_attempts):
-            full_response, topic, math_subtopic, needs_image = generate_mcq(selected_topic, difficulty, chat_id, language, math_subtopic)
-            question_text, options_text, correct_answer, explanation = parse_question(full_response)
-            
-            if correct_answer and correct_answer in ['A', 'B', 'C', 'D']:
-                break
-            elif attempt == max_attempts - 1:
-                correct_answer = random.choice(['A', 'B', 'C', 'D'])
-                explanation = "Answer assigned randomly due to parsing issue."
-        
-        # Store active question
-        active_questions[chat_id] = {
-            'question_text': question_text,
-            'options_text': options_text,
-            'correct_answer': correct_answer,
-            'explanation': explanation,
-            'topic': topic,
-            'difficulty': difficulty,
-            'full_response': full_response
-        }
-        
-        # Save question to database
-        save_question_to_db(topic, difficulty, question_text, correct_answer, explanation, math_subtopic if topic == "General Mathematics" else None)
-        
-        # Get language-specific texts
-        texts = interface_texts.get(language, interface_texts["English"])
-        difficulty_emoji = {"Easy": "🟢", "Medium": "🟡", "Hard": "🔴"}
-        
-        # Include subtopic for General Mathematics
-        topic_display = topic
-        if topic == "General Mathematics" and math_subtopic:
-            topic_display = f"{topic} - {math_subtopic}"
+        texts = interface_texts.get(preferences["language"], interface_texts["English"])
         
-        question_message = f"{texts['question_ready']}\n{texts['topic']} {topic_display}\n{texts['difficulty']} {difficulty_emoji.get(difficulty, '🟡')} {difficulty}\n\n{texts['question']} {question_text}\n\n{options_text}\n\n{texts['reply_instruction']}"
-        
-        # Generate and send image if needed
-        if needs_image:
-            try:
-                print(f"Generating image for topic: {topic}, math_subtopic: {math_subtopic}")
-                image_url = generate_question_image(topic, math_subtopic, question_text, options_text)
-                if image_url:
-                    image_filename = f"temp_question_{chat_id}.png"
-                    if download_image(image_url, image_filename):
-                        with open(image_filename, 'rb') as photo:
-                            await context.bot.send_photo(chat_id=chat_id, photo=photo, caption=question_message, parse_mode="Markdown")
-                        try:
-                            os.remove(image_filename)
-                        except:
-                            pass
-                    else:
-                        await update.message.reply_text(question_message, parse_mode="Markdown")
-                else:
-                    await update.message.reply_text(question_message, parse_mode="Markdown")
-            except Exception as e:
-                print(f"Error with image generation: {e}")
-                await update.message.reply_text(question_message, parse_mode="Markdown")
-        else:
-            await update.message.reply_text(question_message, parse_mode="Markdown")
+        if not await deliver_question(context.bot, chat_id, preferences, texts):
+            await update.message.reply_text(texts["service_unavailable"])
             
     except Exception as e:
-        print(f"Error in manual_question: {e}")
+        logger.exception("Error in manual_question")
     finally:
-        clear_processing(chat_id)
+        await run_state(clear_processing, chat_id)
 
 async def send_question_to_user(context, chat_id):
-    """Send a personalized question to a specific user"""
-    if not check_and_set_processing(chat_id):
-        print(f"Skipping scheduled question for user {chat_id} - already processing or in cooldown")
-        return
+    """Send a personalized question to a specific user; returns True when one was sent"""
+    if not await run_state(check_and_set_processing, chat_id):
+        logger.info("Skipping scheduled question - already processing or in cooldown", extra={'chat_id': chat_id})
+        return False
     
     try:
         preferences = get_user_preferences(chat_id)
-        selected_topic = preferences["topic"]
-        difficulty = preferences["difficulty"]
-        language = preferences["language"]
-        math_subtopic = preferences.get("math_subtopic")
-        
-        # Generate question with validation
-        max_attempts = 3
-        for attempt in range(max_attempts):
-            full_response, topic, math_subtopic, needs_image = generate_mcq(selected_topic, difficulty, chat_id, language, math_subtopic)
-            question_text, options_text, correct_answer, explanation = parse_question(full_response)
-            
-            if correct_answer and correct_answer in ['A', 'B', 'C', 'D']:
-                break
-            elif attempt == max_attempts - 1:
-                correct_answer = random.choice(['A', 'B', 'C', 'D'])
-                explanation = "Answer assigned randomly due to parsing issue."
-        
-        # Store active question
-        active_questions[chat_id] = {
-            'question_text': question_text,
-            'options_text': options_text,
-            'correct_answer': correct_answer,
-            'explanation': explanation,
-            'topic': topic,
-            'difficulty': difficulty,
-            'full_response': full_response
-        }
-        
-        # Save question to database
-        save_question_to_db(topic, difficulty, question_text, correct_answer, explanation, math_subtopic if topic == "General Mathematics" else None)
         
         # Get language-specific texts
-        texts = interface_texts.get(language, interface_texts["English"])
-        difficulty_emoji = {"Easy": "🟢", "Medium": "🟡", "Hard": "🔴"}
-        
-        # Include subtopic for General Mathematics
-        topic_display = topic
-        if topic == "General Mathematics" and math_subtopic:
-            topic_display = f"{topic} - {math_subtopic}"
-        
-        question_message = f"{texts['question_ready']}\n{texts['topic']} {topic_display}\n{texts['difficulty']} {difficulty_emoji.get(difficulty, '🟡')} {difficulty}\n\n{texts['question']} {question_text}\n\n{options_text}\n\n{texts['reply_instruction']}"
-        
-        # Generate and send image if needed
-        if needs_image:
-            try:
-                print(f"Generating image for topic: {topic}, math_subtopic: {math_subtopic}")
-                image_url = generate_question_image(topic, math_subtopic, question_text, options_text)
-                if image_url:
-                    image_filename = f"temp_question_{chat_id}.png"
-                    if download_image(image_url, image_filename):
-                        with open(image_filename, 'rb') as photo:
-                            await context.bot.send_photo(chat_id=chat_id, photo=photo, caption=question_message, parse_mode="Markdown")
-                        try:
-                            os.remove(image_filename)
-                        except:
-                            pass
-                    else:
-                        await context.bot.send_message(chat_id=chat_id, text=question_message, parse_mode="Markdown")
-                else:
-                    await context.bot.send_message(chat_id=chat_id, text=question_message, parse_mode="Markdown")
-            except Exception as e:
-                print(f"Error with image generation: {e}")
-                await context.bot.send_message(chat_id=chat_id, text=question_message, parse_mode="Markdown")
-        else:
-            await context.bot.send_message(chat_id=chat_id, text=question_message, parse_mode="Markdown")
+        texts = interface_texts.get(preferences["language"], interface_texts["English"])
+        if not await deliver_question(context.bot, chat_id, preferences, texts, source='broadcast'):
+            logger.info("Skipping scheduled question - no question available", extra={'chat_id': chat_id})
+            return False
+        return True
             
     except Exception as e:
-        print(f"Error in send_question_to_user: {e}")
+        logger.exception("Error in send_question_to_user", extra={'chat_id': chat_id})
     finally:
-        clear_processing(chat_id)
+        await run_state(clear_processing, chat_id)
+
+def in_quiet_hours(quiet_start, quiet_end, hour):
+    if quiet_start is None or quiet_end is None or quiet_start == quiet_end:
+        return False
+    if quiet_start < quiet_end:
+        return quiet_start <= hour < quiet_end
+    # Window wraps past midnight, e.g. 22 -> 7
+    return hour >= quiet_start or hour < quiet_end
+
+def select_due_users(rows, cycle, now, interval_seconds, local_hour):
+    due = []
+    for chat_id, schedule_minutes, quiet_start, quiet_end, last_cycle, last_sent_at in rows:
+        if not owns_chat(chat_id) or not schedule_minutes or last_cycle == cycle:
+            continue
+        # Half an interval of slack keeps a user's slot stable from cycle to cycle
+        if last_sent_at and now - last_sent_at < schedule_minutes * 60 - interval_seconds / 2:
+            continue
+        if in_quiet_hours(quiet_start, quiet_end, local_hour):
+            continue
+        due.append(chat_id)
+    return due
 
 async def send_scheduled_questions(context: ContextTypes.DEFAULT_TYPE):
-    """Send questions to all active users"""
-    active_users = get_all_active_users()
-    for user_chat_id in active_users:
-        try:
-            await send_question_to_user(context, user_chat_id)
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            print(f"Error sending question to user {user_chat_id}: {e}")
+    """Send questions to the users hashed into the current schedule slot"""
+    interval_seconds = SCHEDULE_INTERVAL_MINUTES * 60
+    slot_seconds = interval_seconds / SCHEDULE_SLOTS
+    now = time.time()
+    cycle = int(now // interval_seconds)
+    slot = int((now % interval_seconds) // slot_seconds)
+    
+    # One runner per shard and slot, even if a worker was restarted with the same index
+    if not await run_state(state_backend.acquire_leadership, f"broadcast:{WORKER_INDEX}", WORKER_ID, slot_seconds):
+        return
+    
+    local_hour = datetime.datetime.now(TIMEZONE).hour
+    rows = get_slot_users(slot, SCHEDULE_SLOTS)
+    due_users = select_due_users(rows, cycle, now, interval_seconds, local_hour)
+    previous_progress = {row[0]: (row[0], row[4], row[5]) for row in rows}
+    set_gauge('mcq_broadcast_queue_depth', len(due_users))
+    
+    for i in range(0, len(due_users), SCHEDULE_BATCH_SIZE):
+        batch = due_users[i:i + SCHEDULE_BATCH_SIZE]
+        # Progress is recorded before sending: a crash loses at most one batch instead of resending it
+        mark_broadcast_sent(batch, cycle)
+        results = await asyncio.gather(*(send_question_to_user(context, chat_id) for chat_id in batch), return_exceptions=True)
+        set_gauge('mcq_broadcast_queue_depth', max(0, len(due_users) - i - len(batch)))
+        for user_chat_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error("Error sending question: %s", result, extra={'chat_id': user_chat_id})
+        # Users skipped (cooldown, a question in flight, nothing to serve) stay due for a later run
+        unserved = [previous_progress[chat_id] for chat_id, result in zip(batch, results) if result is not True]
+        if unserved:
+            restore_broadcast_progress(unserved)
 
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user_answer = update.message.text.strip().upper()
     
-    if chat_id not in active_questions:
+    question_data = await run_state(state_backend.get_active_question, chat_id)
+    if question_data is None:
         await update.message.reply_text("No active question found. Please request a new question.")
         return
     
@@ -902,7 +3903,16 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please reply with A, B, C, or D.")
         return
     
-    question_data = active_questions[chat_id]
+    # A streamed question is visible before its answer key has arrived
+    if question_data['correct_answer'] is None:
+        texts = interface_texts.get(get_user_preferences(chat_id).get("language", "English"), interface_texts["English"])
+        await update.message.reply_text(texts['answer_key_pending'])
+        return
+    
+    # Claim the question atomically so a second worker cannot grade it twice
+    if await run_state(state_backend.pop_active_question, chat_id) is None:
+        return
+    
     correct_answer = question_data['correct_answer']
     explanation = question_data['explanation']
     
@@ -912,7 +3922,7 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     texts = interface_texts.get(language, interface_texts["English"])
     
     is_correct = user_answer == correct_answer
-    save_user_answer(chat_id, is_correct)
+    save_user_answer(chat_id, is_correct, question_data, user_answer)
     
     if is_correct:
         response_message = f"{texts['correct_answer']}\n\n{texts['explanation']} {explanation}"
@@ -920,7 +3930,171 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         response_message = f"{texts['wrong_answer']}\n\n{texts['correct_option']} {correct_answer}\n\n{texts['explanation']} {explanation}"
     
     await update.message.reply_text(response_message)
-    del active_questions[chat_id]
+
+# Quiz sessions: N questions prepared in one batch and sent as Telegram quiz polls.
+# Poll answers are kept in the state backend and written to the database when the session ends.
+QUIZ_DEFAULT_QUESTIONS = int(os.getenv('QUIZ_DEFAULT_QUESTIONS', '5'))
+QUIZ_MAX_QUESTIONS = int(os.getenv('QUIZ_MAX_QUESTIONS', '10'))
+# Polls close after this long (Telegram allows 5-600 s); a session is scored and cleared once its last poll closed
+QUIZ_POLL_OPEN_SECONDS = min(600, max(5, int(os.getenv('QUIZ_POLL_OPEN_SECONDS', '600'))))
+POLL_QUESTION_LIMIT = 300
+POLL_OPTION_LIMIT = 100
+POLL_EXPLANATION_LIMIT = 200
+
+def prepare_quiz_questions(chat_id, preferences, count, generate=True):
+    """Up to `count` questions from one batched generation and templates, topped up from the stored bank"""
+    template_count = sum(1 for _ in range(count) if prefers_template(preferences))
+    questions = []
+    if generate and count > template_count:
+        questions = generate_mcq_batch(preferences["topic"], preferences["difficulty"], chat_id, preferences["language"],
+                                       preferences.get("math_subtopic"), count - template_count)
+    if questions:
+        save_questions_to_db(questions)
+    # Templates make up their share plus whatever the batch did not deliver
+    questions += make_template_questions(preferences, count - len(questions), 'quiz')
+    
+    used_ids = {question['question_id'] for question in questions}
+    while len(questions) < count:
+        fallback = get_fallback_question(chat_id, preferences, used_ids)
+        inc_counter('mcq_fallback_questions_total', result='hit' if fallback else 'miss')
+        if fallback is None:
+            break
+        used_ids.add(fallback['question_id'])
+        questions.append(fallback)
+    return questions
+
+async def send_quiz_poll(bot, chat_id, index, total, question):
+    options = re.findall(r'^[A-D]\) (.*)$', question['options_text'], re.MULTILINE)[:4]
+    poll_question = f"{index + 1}/{total}. {question['question_text']}"
+    if len(poll_question) > POLL_QUESTION_LIMIT or any(len(option) > POLL_OPTION_LIMIT for option in options):
+        # Too long for a poll: show the full text and let the poll carry only the letters
+        with measure('telegram_send', method='send_message'):
+            await bot.send_message(chat_id=chat_id, text=f"{poll_question}\n\n{question['options_text']}")
+        poll_question, options = f"{index + 1}/{total}", ['A', 'B', 'C', 'D']
+    
+    explanation = (question.get('explanation') or '')[:POLL_EXPLANATION_LIMIT] or None
+    with measure('telegram_send', method='send_poll'):
+        message = await bot.send_poll(chat_id=chat_id, question=poll_question, options=options, type='quiz', is_anonymous=False,
+                                      correct_option_id='ABCD'.index(question['correct_answer']), explanation=explanation,
+                                      open_period=QUIZ_POLL_OPEN_SECONDS)
+    await run_state(state_backend.add_quiz_poll, chat_id, message.poll.id, index, time.time())
+
+async def finish_quiz_session(bot, chat_id):
+    """Score and store a chat's quiz session; returns False if there was none"""
+    popped = await run_state(state_backend.pop_quiz_session, chat_id)
+    if popped is None:
+        return False
+    session, polls = popped
+    questions = session['questions']
+    # The session is gone, so its expiry job has nothing left to do
+    job = scheduler.get_job(f"quiz:{chat_id}")
+    if job is not None:
+        job.remove()
+    
+    results = []
+    for poll in polls:
+        if poll['chosen'] is None:
+            continue
+        question_data = dict(questions[poll['index']], sent_at=poll['sent_at'])
+        results.append((question_data, poll['chosen'], poll['chosen'] == question_data['correct_answer'], poll['answered_at']))
+    # One transaction for the whole session instead of one per answer
+    await asyncio.to_thread(save_user_answers, chat_id, results)
+    inc_counter('mcq_quiz_sessions_total', result='completed' if polls and len(results) == len(polls) else 'partial')
+    
+    correct = sum(1 for result in results if result[2])
+    texts = interface_texts.get(session.get('language'), interface_texts["English"])
+    await bot.send_message(chat_id=chat_id, text=texts['quiz_finished'].format(correct=correct, answered=len(results), total=len(polls)))
+    return True
+
+async def expire_quiz_session(application, chat_id):
+    # Runs once the session's last poll has closed; a no-op if the session already finished
+    try:
+        if await finish_quiz_session(application.bot, chat_id):
+            inc_counter('mcq_quiz_sessions_expired_total')
+    except Exception as e:
+        logger.exception("Error expiring quiz session", extra={'chat_id': chat_id})
+
+async def quiz_expiry_job(application):
+    """Finish sessions whose polls have all closed but that have no finish job (e.g. after a restart)"""
+    # Polls go out right after the session starts; a minute covers sending them
+    started_before = time.time() - QUIZ_POLL_OPEN_SECONDS - 60
+    for chat_id in await run_state(state_backend.expired_quiz_sessions, started_before):
+        if owns_chat(chat_id):
+            await expire_quiz_session(application, chat_id)
+
+async def quiz_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    preferences = get_user_preferences(chat_id)
+    texts = interface_texts.get(preferences["language"], interface_texts["English"])
+    
+    if args and args[0].lower() == "stop":
+        if not await finish_quiz_session(context.bot, chat_id):
+            await update.message.reply_text(texts["quiz_none"])
+        return
+    if args and (not args[0].isdigit() or not 1 <= int(args[0]) <= QUIZ_MAX_QUESTIONS):
+        await update.message.reply_text(texts["quiz_usage"].format(max=QUIZ_MAX_QUESTIONS))
+        return
+    count = int(args[0]) if args else QUIZ_DEFAULT_QUESTIONS
+    
+    if not await run_state(check_and_set_processing, chat_id):
+        remaining_time = await run_state(get_cooldown_remaining, chat_id)
+        if remaining_time > 0:
+            await update.message.reply_text(texts["cooldown_message"].format(remaining=remaining_time))
+        else:
+            await update.message.reply_text(texts["processing_message"])
+        return
+    
+    try:
+        user = update.effective_user
+        register_user(chat_id, user.username, user.first_name, user.last_name)
+        
+        # An unfinished session is scored before the new one starts
+        await finish_quiz_session(context.bot, chat_id)
+        
+        token = start_ledger(chat_id, 'quiz', preferences)
+        questions = []
+        try:
+            over_budget = await asyncio.to_thread(budget_exceeded, chat_id) if USER_DAILY_BUDGET_USD or DAILY_BUDGET_USD else None
+            questions = await asyncio.to_thread(prepare_quiz_questions, chat_id, preferences, count, not over_budget)
+        finally:
+            await finish_ledger(token, 'generated' if questions else 'failed')
+        if not questions:
+            await update.message.reply_text(texts["service_unavailable"])
+            return
+        
+        await run_state(state_backend.start_quiz_session, chat_id, {'questions': questions, 'language': preferences["language"], 'started_at': time.time()})
+        sent = 0
+        try:
+            await update.message.reply_text(texts["quiz_started"].format(count=len(questions)))
+            for index, question in enumerate(questions):
+                await send_quiz_poll(context.bot, chat_id, index, len(questions), question)
+                sent += 1
+        finally:
+            # The session is complete once every poll actually sent is answered, or when the last one closes
+            answered = await run_state(state_backend.set_quiz_poll_count, chat_id, sent)
+            if answered is not None and answered >= sent:
+                await finish_quiz_session(context.bot, chat_id)
+            else:
+                scheduler.add_job(expire_quiz_session, 'date', args=[context.application, chat_id], id=f"quiz:{chat_id}", replace_existing=True,
+                                  run_date=datetime.datetime.now(TIMEZONE) + datetime.timedelta(seconds=QUIZ_POLL_OPEN_SECONDS + 5))
+    
+    except Exception as e:
+        logger.exception("Error in quiz_command")
+    finally:
+        await run_state(clear_processing, chat_id)
+
+async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    answer = update.poll_answer
+    if not answer.option_ids:
+        return
+    
+    progress = await run_state(state_backend.record_quiz_answer, answer.poll_id, 'ABCD'[answer.option_ids[0]], time.time())
+    if progress is None:
+        return
+    chat_id, answered, total = progress
+    if answered >= total:
+        await finish_quiz_session(context.bot, chat_id)
 
 async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -942,9 +4116,6 @@ async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    total, correct, wrong = get_user_stats(chat_id)
-    accuracy = (correct / total * 100) if total > 0 else 0
-    
     preferences = get_user_preferences(chat_id)
     language = preferences.get("language", "English")
     texts = interface_texts.get(language, interface_texts["English"])
@@ -952,9 +4123,26 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [[InlineKeyboardButton(texts["reset_stats"], callback_data="reset_stats")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    stats_text = f"{texts['stats_title']}\n\n{texts['total_questions']} {total}\n{texts['correct_answers']} {correct}\n{texts['wrong_answers']} {wrong}\n{texts['accuracy']} {accuracy:.1f}%"
+    stats_text = build_stats_text(chat_id, texts)
     await update.message.reply_text(stats_text, reply_markup=reply_markup)
 
+def build_stats_text(chat_id, texts):
+    total, correct, wrong = get_user_stats(chat_id)
+    accuracy = (correct / total * 100) if total > 0 else 0
+    stats_text = f"{texts['stats_title']}\n\n{texts['total_questions']} {total}\n{texts['correct_answers']} {correct}\n{texts['wrong_answers']} {wrong}\n{texts['accuracy']} {accuracy:.1f}%"
+    
+    by_topic, by_difficulty = get_user_breakdown(chat_id)
+    if by_topic:
+        stats_text += f"\n\n{texts['by_topic']}"
+        for topic, topic_total, topic_correct, topic_latency in by_topic:
+            stats_text += f"\n• {topic}: {topic_correct}/{topic_total} ({topic_correct / topic_total * 100:.0f}%, ~{topic_latency / topic_total / 1000:.0f}s)"
+    if by_difficulty:
+        stats_text += f"\n\n{texts['by_difficulty']}"
+        order = {"Easy": 0, "Medium": 1, "Hard": 2}
+        for difficulty, diff_total, diff_correct, _ in sorted(by_difficulty, key=lambda row: order.get(row[0], 3)):
+            stats_text += f"\n• {difficulty}: {diff_correct}/{diff_total} ({diff_correct / diff_total * 100:.0f}%)"
+    return stats_text
+
 async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1070,9 +4258,6 @@ async def language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_stats_from_callback(query):
     chat_id = query.message.chat_id
-    total, correct, wrong = get_user_stats(chat_id)
-    accuracy = (correct / total * 100) if total > 0 else 0
-    
     preferences = get_user_preferences(chat_id)
     language = preferences.get("language", "English")
     texts = interface_texts.get(language, interface_texts["English"])
@@ -1080,7 +4265,7 @@ async def show_stats_from_callback(query):
     keyboard = [[InlineKeyboardButton(texts["reset_stats"], callback_data="reset_stats")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    stats_text = f"{texts['stats_title']}\n\n{texts['total_questions']} {total}\n{texts['correct_answers']} {correct}\n{texts['wrong_answers']} {wrong}\n{texts['accuracy']} {accuracy:.1f}%"
+    stats_text = build_stats_text(chat_id, texts)
     await query.edit_message_text(stats_text, reply_markup=reply_markup)
 
 async def reset_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1096,6 +4281,95 @@ async def reset_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     
     await query.edit_message_text("✅ Statistics reset successfully!")
 
+async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if not context.args:
+        result = db_execute("SELECT COALESCE(schedule_minutes, 30), quiet_start, quiet_end FROM user_preferences WHERE chat_id = ?", (chat_id,), fetch=True)
+        schedule_minutes, quiet_start, quiet_end = result if result else (30, None, None)
+        frequency = f"every {schedule_minutes} minutes" if schedule_minutes else "off"
+        quiet = f"{quiet_start}:00-{quiet_end}:00" if quiet_start is not None and quiet_end is not None else "none"
+        await update.message.reply_text(f"⏰ Scheduled questions: {frequency}\n🌙 Quiet hours: {quiet}\n\nUsage: /schedule <minutes|off>, /quiet <start hour> <end hour>|off")
+        return
+    
+    value = context.args[0].lower()
+    if value == "off":
+        update_user_preferences(chat_id, schedule_minutes=0)
+        await update.message.reply_text("✅ Scheduled questions turned off.")
+        return
+    if not value.isdigit() or int(value) < SCHEDULE_INTERVAL_MINUTES:
+        await update.message.reply_text(f"Please give a number of minutes (at least {SCHEDULE_INTERVAL_MINUTES}) or 'off'.")
+        return
+    
+    # Sends happen once per interval, so round to a whole number of intervals
+    minutes = round(int(value) / SCHEDULE_INTERVAL_MINUTES) * SCHEDULE_INTERVAL_MINUTES
+    update_user_preferences(chat_id, schedule_minutes=minutes)
+    await update.message.reply_text(f"✅ Scheduled questions every {minutes} minutes.")
+
+async def quiet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    if len(args) == 1 and args[0].lower() == "off":
+        update_user_preferences(chat_id, quiet_start=None, quiet_end=None)
+        await update.message.reply_text("✅ Quiet hours removed.")
+        return
+    if len(args) != 2 or not all(arg.isdigit() and 0 <= int(arg) <= 23 for arg in args):
+        await update.message.reply_text("Usage: /quiet <start hour> <end hour> (0-23), e.g. /quiet 22 7, or /quiet off")
+        return
+    
+    quiet_start, quiet_end = int(args[0]), int(args[1])
+    update_user_preferences(chat_id, quiet_start=quiet_start, quiet_end=quiet_end)
+    await update.message.reply_text(f"✅ No scheduled questions between {quiet_start}:00 and {quiet_end}:00.")
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        return
+    # Telegram messages are limited to 4096 characters
+    await update.message.reply_text(f"{router_summary()}\n\n{math_verification_summary()}\n\n{metrics_summary()}"[:4000])
+
+async def costs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        return
+    summary = await asyncio.to_thread(cost_summary)
+    await update.message.reply_text(summary[:4000])
+
+async def traces_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        return
+    traces = list(slow_traces)
+    if context.args and context.args[0].lstrip('-').isdigit():
+        traces = [trace for trace in traces if trace['chat_id'] == int(context.args[0])]
+    if not traces:
+        await update.message.reply_text(f"No traces slower than {TRACE_SLOW_MS:.0f}ms recorded.")
+        return
+    text = "\n\n".join(format_trace(trace) for trace in traces[-5:])
+    await update.message.reply_text(text[-4000:])
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        return
+    global profile_running
+    if profile_running:
+        await update.message.reply_text("A profiling run is already in progress.")
+        return
+    profile_running = True
+    seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else 30
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    # Run in the background so other updates keep being handled (and profiled) meanwhile
+    async def profile_and_report():
+        global profile_running
+        try:
+            report = await run_profiler(seconds)
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=report[:4000])
+        finally:
+            profile_running = False
+    try:
+        await update.message.reply_text(f"⏱️ Profiling for {seconds} seconds...")
+        context.application.create_task(profile_and_report())
+    except BaseException:
+        profile_running = False
+        raise
+
 async def language_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("🇺🇸 English", callback_data="language_English")],
@@ -1104,39 +4378,310 @@ async def language_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("🌐 Select Language:", reply_markup=reply_markup)
 
-def main():
-    global app
-    
-    # Initialize database
-    init_database()
+# Warm-start snapshots: in-process state that is otherwise rebuilt from slow paths
+# after a restart is written to a gzipped JSON file at shutdown and periodically,
+# and loaded again on boot if it is recent enough
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'mcq_snapshot.json.gz' if WORKER_COUNT <= 1 else f'mcq_snapshot_{WORKER_INDEX}.json.gz')
+SNAPSHOT_INTERVAL_MINUTES = float(os.getenv('SNAPSHOT_INTERVAL_MINUTES', '5'))
+SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv('SNAPSHOT_MAX_AGE_SECONDS', str(6 * 3600)))
+
+def build_snapshot():
+    """Copy the in-memory state into a JSON-serializable dict (call from the event loop thread)"""
+    now = time.time()
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created_at': now,
+        # JSON object keys are strings, so chat-keyed maps are stored as pairs
+        'preference_cache': [[chat_id, expires, preferences] for chat_id, (expires, preferences) in preference_cache.items() if expires > now],
+        'image_file_ids': list(image_file_ids.items()),
+        'llm_latencies': {model: list(latencies) for model, latencies in llm_latencies.items()},
+        'model_outcomes': {model: list(outcomes) for model, outcomes in model_outcomes.items()},
+        'ready_questions': [[list(key), list(questions)] for key, questions in ready_questions.items() if questions],
+    }
+    # The SQLite backend is already durable; only process-local state needs saving
+    if isinstance(state_backend, MemoryStateBackend):
+        snapshot['active_questions'] = list(state_backend.active_questions.items())
+        snapshot['last_question_time'] = [[chat_id, at] for chat_id, at in state_backend.last_question_time.items() if now - at < QUESTION_COOLDOWN]
+        with state_backend.lock:
+            snapshot['quiz_sessions'] = [[chat_id, entry] for chat_id, entry in state_backend.quiz_sessions.items()]
+    return snapshot
+
+def write_snapshot(snapshot, path=SNAPSHOT_PATH):
+    # Write to a temporary file first so a crash mid-write never leaves a truncated snapshot
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, 'wt', encoding='utf-8', compresslevel=5) as f:
+        json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, path)
+    set_gauge('mcq_snapshot_bytes', os.path.getsize(path))
+
+def restore_snapshot(snapshot):
+    """Load a snapshot's sections into memory; returns the number of active questions restored"""
+    for chat_id, expires, preferences in snapshot.get('preference_cache', []) if PREFERENCE_CACHE_SECONDS > 0 else []:
+        preference_cache.setdefault(chat_id, (expires, preferences))
+    for question_id, file_id in snapshot.get('image_file_ids', []):
+        remember_image(question_id, file_id)
+    for model, latencies in snapshot.get('llm_latencies', {}).items():
+        llm_latencies[model].extend(latencies)
+    for model, outcomes in snapshot.get('model_outcomes', {}).items():
+        model_outcomes[model].extend(tuple(outcome) for outcome in outcomes)
+    for key, questions in snapshot.get('ready_questions', []):
+        ready_questions[tuple(key)].extend(questions)
     
-    # Create application
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    if not isinstance(state_backend, MemoryStateBackend):
+        return 0
+    for chat_id, question in snapshot.get('active_questions', []):
+        state_backend.active_questions.setdefault(chat_id, question)
+    for chat_id, at in snapshot.get('last_question_time', []):
+        state_backend.last_question_time.setdefault(chat_id, at)
+    with state_backend.lock:
+        for chat_id, entry in snapshot.get('quiz_sessions', []):
+            if chat_id not in state_backend.quiz_sessions:
+                state_backend.quiz_sessions[chat_id] = entry
+                for poll_id in entry['polls']:
+                    state_backend.quiz_polls[poll_id] = chat_id
+    return len(snapshot.get('active_questions', []))
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    if not os.path.exists(path):
+        return
+    started = time.perf_counter()
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable snapshot %s: %s", path, e)
+        return
+    age = time.time() - snapshot.get('created_at', 0)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        logger.warning("Ignoring snapshot %s: version %s, expected %s", path, snapshot.get('version'), SNAPSHOT_VERSION)
+        return
+    if age > SNAPSHOT_MAX_AGE_SECONDS:
+        logger.info("Ignoring snapshot %s: %.0f minutes old", path, age / 60)
+        return
+    restored = restore_snapshot(snapshot)
+    logger.info("Restored snapshot from %.0fs ago in %.0f ms (%d active questions, %d cached preferences, %d cached images, %d ready questions)",
+                age, (time.perf_counter() - started) * 1000, restored, len(preference_cache), len(image_file_ids),
+                sum(len(questions) for questions in ready_questions.values()))
+
+async def snapshot_job(application):
+    snapshot = build_snapshot()
+    with measure('snapshot'):
+        await asyncio.to_thread(write_snapshot, snapshot)
+
+scheduler = AsyncIOScheduler(timezone=TIMEZONE)
+
+async def on_startup(application):
+    load_snapshot()
+    start_verify_pool()
+    await start_scheduler(application)
+
+async def on_shutdown(application):
+    await stop_scheduler(application)
+    # PTB runs post_shutdown after SIGTERM/SIGINT stop the application
+    try:
+        write_snapshot(build_snapshot())
+        logger.info("Snapshot written to %s", SNAPSHOT_PATH)
+    except Exception as e:
+        logger.exception("Error writing snapshot")
+    if verify_pool is not None:
+        verify_pool.shutdown(cancel_futures=True)
+
+async def start_scheduler(application):
+    if SCHEDULED_QUESTIONS:
+        slot_seconds = SCHEDULE_INTERVAL_MINUTES * 60 / SCHEDULE_SLOTS
+        # max_instances=1 skips a slot run while the previous one is still going
+        scheduler.add_job(send_scheduled_questions, 'interval', seconds=slot_seconds, args=[application],
+                          id='scheduled_questions', max_instances=1, coalesce=True, replace_existing=True)
+    if SNAPSHOT_INTERVAL_MINUTES > 0:
+        scheduler.add_job(snapshot_job, 'interval', minutes=SNAPSHOT_INTERVAL_MINUTES, args=[application],
+                          id='snapshot', max_instances=1, coalesce=True, replace_existing=True)
+    scheduler.add_job(quiz_expiry_job, 'interval', seconds=QUIZ_POLL_OPEN_SECONDS, args=[application],
+                      id='quiz_expiry', max_instances=1, coalesce=True, replace_existing=True)
+    if ARCHIVE_INTERVAL_HOURS > 0:
+        scheduler.add_job(archive_job, 'interval', hours=ARCHIVE_INTERVAL_HOURS, args=[application],
+                          id='archive', max_instances=1, coalesce=True, replace_existing=True)
+    if scheduler.get_jobs():
+        scheduler.start()
+
+async def stop_scheduler(application):
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+def build_application(token=TELEGRAM_TOKEN, base_url=TELEGRAM_API_BASE_URL):
+    builder = (Application.builder().token(token).concurrent_updates(CONCURRENT_UPDATES)
+               .post_init(on_startup).post_shutdown(on_shutdown))
+    if base_url:
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
     
     # Add handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("question", manual_question))
-    app.add_handler(CommandHandler("settings", show_settings))
-    app.add_handler(CommandHandler("stats", show_stats))
-    app.add_handler(CommandHandler("language", language_command))
+    application.add_handler(CommandHandler("start", instrument_handler(start)))
+    application.add_handler(CommandHandler("help", instrument_handler(help_command)))
+    application.add_handler(CommandHandler("question", instrument_handler(manual_question)))
+    application.add_handler(CommandHandler("quiz", instrument_handler(quiz_command)))
+    application.add_handler(CommandHandler("settings", instrument_handler(show_settings)))
+    application.add_handler(CommandHandler("stats", instrument_handler(show_stats)))
+    application.add_handler(CommandHandler("language", instrument_handler(language_command)))
+    application.add_handler(CommandHandler("schedule", instrument_handler(schedule_command)))
+    application.add_handler(CommandHandler("quiet", instrument_handler(quiet_command)))
+    application.add_handler(CommandHandler("metrics", instrument_handler(metrics_command)))
+    application.add_handler(CommandHandler("costs", instrument_handler(costs_command)))
+    application.add_handler(CommandHandler("traces", instrument_handler(traces_command)))
+    application.add_handler(CommandHandler("profile", instrument_handler(profile_command)))
     
     # Add callback handlers with proper priority
-    app.add_handler(CallbackQueryHandler(topic_math_subtopic_callback, pattern="^topic_math_subtopic_"))
-    app.add_handler(CallbackQueryHandler(topic_callback, pattern="^topic_"))
-    app.add_handler(CallbackQueryHandler(difficulty_callback, pattern="^difficulty_"))
-    app.add_handler(CallbackQueryHandler(language_callback, pattern="^language_"))
-    app.add_handler(CallbackQueryHandler(reset_stats_callback, pattern="^reset_stats$"))
-    app.add_handler(CallbackQueryHandler(settings_callback, pattern="^settings_"))
+    application.add_handler(CallbackQueryHandler(instrument_handler(topic_math_subtopic_callback), pattern="^topic_math_subtopic_"))
+    application.add_handler(CallbackQueryHandler(instrument_handler(topic_callback), pattern="^topic_"))
+    application.add_handler(CallbackQueryHandler(instrument_handler(difficulty_callback), pattern="^difficulty_"))
+    application.add_handler(CallbackQueryHandler(instrument_handler(language_callback), pattern="^language_"))
+    application.add_handler(CallbackQueryHandler(instrument_handler(reset_stats_callback), pattern="^reset_stats$"))
+    application.add_handler(CallbackQueryHandler(instrument_handler(settings_callback), pattern="^settings_"))
+    
+    # Add handlers for answers: quiz polls, and plain text replies (commands and other updates never reach handle_answer)
+    application.add_handler(PollAnswerHandler(instrument_handler(handle_poll_answer)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler(handle_answer)))
     
-    # Add message handler for answers
-    app.add_handler(MessageHandler(filters=None, callback=handle_answer))
+    return application
+
+# Webhook router: the one endpoint Telegram posts to when several workers share a token
+class WebhookRouterHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            shard = update_shard(json.loads(body))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        headers = {'Content-Type': 'application/json'}
+        if self.headers.get('X-Telegram-Bot-Api-Secret-Token'):
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.headers['X-Telegram-Bot-Api-Secret-Token']
+        request = urllib.request.Request(f"http://{ROUTER_UPSTREAM_HOST}:{PORT + 1 + shard}{self.path}", data=body, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                status, reply = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, reply = e.code, e.read()
+        except OSError as e:
+            # Telegram retries undelivered updates, so a worker that is restarting loses nothing
+            inc_counter('mcq_router_errors_total', shard=shard)
+            logger.warning("Could not forward update to worker %d: %s", shard, e)
+            status, reply = 502, b''
+        inc_counter('mcq_router_updates_total', shard=shard, status=status)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+    
+    def log_message(self, format, *args):
+        pass
+
+def run_router():
+    server = ThreadingHTTPServer(("0.0.0.0", PORT), WebhookRouterHandler)
+    logger.info("Routing webhook updates on port %d to %d workers on ports %d-%d.", PORT, WORKER_COUNT, PORT + 1, PORT + WORKER_COUNT)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="MP Patwari MCQ practice bot. Runs the bot when no command is given.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='run the bot (default)')
+    subparsers.add_parser('route-webhook', help='forward webhook updates on PORT to the WORKER_COUNT workers by chat')
+    
+    export_parser = subparsers.add_parser('export-questions', help='write the question bank as JSONL')
+    export_parser.add_argument('--output', '-o', default='-', help='output file (default: stdout)')
+    export_parser.add_argument('--topic')
+    export_parser.add_argument('--difficulty', choices=QUESTION_DIFFICULTIES)
+    export_parser.add_argument('--subtopic', help='math subtopic')
+    export_parser.add_argument('--since', help='first creation date to include, YYYY-MM-DD')
+    export_parser.add_argument('--until', help='last creation date to include, YYYY-MM-DD')
+    
+    import_parser = subparsers.add_parser('import-questions', help='load questions from JSONL, skipping duplicates')
+    import_parser.add_argument('input', help="JSONL file ('-' for stdin)")
+    import_parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    
+    subparsers.add_parser('migrate', help='apply pending schema migrations and exit')
+    subparsers.add_parser('check-math', help='run the math answer-check regression questions and exit')
+    archive_parser = subparsers.add_parser('archive', help=f'move old questions and route log rows to {ARCHIVE_DB_PATH}')
+    archive_parser.add_argument('--days', type=int, default=QUESTION_RETENTION_DAYS, help='question retention in days')
+    archive_parser.add_argument('--route-log-days', type=int, default=ROUTE_LOG_RETENTION_DAYS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    
+    if args.command == 'route-webhook':
+        run_router()
+        return
+    
+    # Initialize database
+    version = init_database()
+    
+    if args.command == 'migrate':
+        print(f"Schema is at version {version}.")
+        return
+    if args.command == 'check-math':
+        failures = check_math_verifier()
+        for failure in failures:
+            print(f"FAIL {failure}")
+        print(f"{len(MATH_VERIFY_REGRESSIONS) - len(failures)}/{len(MATH_VERIFY_REGRESSIONS)} math answer-check regressions passed.")
+        sys.exit(1 if failures else 0)
+    if args.command == 'archive':
+        moved = archive_old_rows(args.days, args.route_log_days)
+        print(f"Archived {moved['questions']} questions, {moved['model_route_log']} route log rows and {moved['generation_costs']} cost events to {ARCHIVE_DB_PATH}.")
+        return
+    if args.command == 'export-questions':
+        if args.output == '-':
+            written = export_questions(sys.stdout, args.topic, args.difficulty, args.subtopic, args.since, args.until)
+        else:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                written = export_questions(f, args.topic, args.difficulty, args.subtopic, args.since, args.until)
+        print(f"Exported {written} questions.", file=sys.stderr)
+        return
+    if args.command == 'import-questions':
+        started = time.perf_counter()
+        if args.input == '-':
+            counts = import_questions(sys.stdin, args.batch_size)
+        else:
+            with open(args.input, encoding='utf-8') as f:
+                counts = import_questions(f, args.batch_size)
+        print(f"Read {counts['read']} questions in {time.perf_counter() - started:.1f}s: {counts['inserted']} imported, "
+              f"{counts['duplicates']} duplicates skipped, {counts['invalid']} invalid.", file=sys.stderr)
+        return
     
-    print("Bot started successfully!")
-    print("Note: Scheduled questions are disabled for now. Use /question for manual questions.")
+    run_bot()
+
+def run_bot():
+    global app
+    
+    if METRICS_PORT:
+        start_metrics_server()
+        logger.info("Metrics available at http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    
+    # Create application
+    app = build_application()
+    
+    logger.info("Bot started successfully! (worker %d/%d, state backend: %s)", WORKER_INDEX + 1, WORKER_COUNT, STATE_BACKEND)
+    if SCHEDULED_QUESTIONS:
+        logger.info("Scheduled questions every %s minutes across %d slots.", SCHEDULE_INTERVAL_MINUTES, SCHEDULE_SLOTS)
+    else:
+        logger.info("Note: Scheduled questions are disabled. Use /question for manual questions.")
     
-    # Run the bot
-    app.run_polling()
+    # Run the bot. Several workers behind one token need webhook mode, since
+    # Telegram allows only one getUpdates consumer per token. WEBHOOK_URL points at the
+    # router (route-webhook), which forwards each update to port PORT + 1 + update_shard(update).
+    if WEBHOOK_URL:
+        if WORKER_COUNT > 1:
+            logger.info("Listening for webhook updates of shard %d on port %d.", WORKER_INDEX, WEBHOOK_PORT)
+        app.run_webhook(listen="0.0.0.0", port=WEBHOOK_PORT, url_path="webhook", webhook_url=WEBHOOK_URL, drop_pending_updates=False)
+    else:
+        if WORKER_COUNT > 1:
+            logger.warning("WORKER_COUNT > 1 without WEBHOOK_URL; only one worker can poll for updates.")
+        app.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The bot reads its configuration at import time
+workdir = tempfile.mkdtemp(prefix='mcq-tests-')
+os.environ.update({
+    'TELEGRAM_BOT_TOKEN': '123456:test',
+    'OPENAI_API_KEY': 'sk-test',
+    'DB_PATH': os.path.join(workdir, 'mcq_bot.db'),
+    'STATE_DB_PATH': os.path.join(workdir, 'mcq_state.db'),
+    'ARCHIVE_DB_PATH': os.path.join(workdir, 'mcq_archive.db'),
+    'SNAPSHOT_PATH': os.path.join(workdir, 'snapshot.json.gz'),
+    'SCHEDULED_QUESTIONS': 'off',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import patwari_mcq_bot
+
+@pytest.fixture
+def bot():
+    return patwari_mcq_bot
+
+@pytest.fixture
+def db_path(bot, tmp_path, monkeypatch):
+    """A fresh, empty database file for one test"""
+    path = str(tmp_path / 'mcq_bot.db')
+    monkeypatch.setattr(bot, 'DB_PATH', path)
+    return path
@@ -0,0 +1,69 @@
+import pytest
+
+@pytest.fixture
+def breaker(bot):
+    return bot.CircuitBreaker(failure_threshold=3, reset_timeout=60)
+
+def elapse(breaker, seconds):
+    # Move the breaker's timestamps back instead of sleeping
+    if breaker.opened_at is not None:
+        breaker.opened_at -= seconds
+    if breaker.probing is not None:
+        breaker.probing -= seconds
+
+def test_opens_after_threshold(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.is_rejecting()
+    assert not breaker.allow_request()
+
+def test_success_resets_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_rejecting()
+
+def test_half_open_lets_one_probe_through(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+    elapse(breaker, 60)
+    assert not breaker.is_rejecting()
+    assert breaker.allow_request()
+    assert breaker.is_probing()
+    assert not breaker.allow_request()
+
+def test_probe_success_closes(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+    elapse(breaker, 60)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert not breaker.is_probing()
+    assert breaker.allow_request()
+    assert breaker.allow_request()
+
+def test_probe_failure_reopens(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+    elapse(breaker, 60)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert not breaker.is_probing()
+    assert breaker.is_rejecting()
+    assert not breaker.allow_request()
+
+def test_lost_probe_is_replaced_after_reset_timeout(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+    elapse(breaker, 60)
+    assert breaker.allow_request()
+    # The probe never reports back
+    elapse(breaker, 59)
+    assert not breaker.allow_request()
+    elapse(breaker, 1)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
@@ -0,0 +1,78 @@
+import sqlite3
+
+def latest_version(bot):
+    return bot.SCHEMA_MIGRATIONS[-1][0]
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def test_versions_are_consecutive(bot):
+    versions = [version for version, _, _, _ in bot.SCHEMA_MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
+
+def test_fresh_database_reaches_latest_version(bot, db_path):
+    assert bot.init_database() == latest_version(bot)
+    conn = sqlite3.connect(db_path)
+    try:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == latest_version(bot)
+        # Set before the first table, so no VACUUM was needed
+        assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        assert 'hedges' in columns(conn, 'generation_costs')
+        assert 'hedges' in columns(conn, 'cost_rollups')
+    finally:
+        conn.close()
+
+def test_init_database_is_idempotent(bot, db_path):
+    bot.init_database()
+    bot.register_user(42, 'user', 'Test', None)
+    assert bot.init_database() == latest_version(bot)
+    conn = sqlite3.connect(db_path)
+    try:
+        assert conn.execute("SELECT chat_id FROM users").fetchall() == [(42,)]
+    finally:
+        conn.close()
+
+def test_unversioned_database_is_upgraded(bot, db_path):
+    # The schema written by init_database before migrations existed (user_version 0)
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE users (chat_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
+                            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, is_active BOOLEAN DEFAULT TRUE);
+        CREATE TABLE user_preferences (chat_id INTEGER PRIMARY KEY, topic TEXT DEFAULT 'General Knowledge',
+                                       difficulty TEXT DEFAULT 'Medium', language TEXT DEFAULT 'English',
+                                       math_subtopic TEXT DEFAULT NULL);
+        CREATE TABLE user_stats (chat_id INTEGER PRIMARY KEY, total_questions INTEGER DEFAULT 0,
+                                 correct_answers INTEGER DEFAULT 0, wrong_answers INTEGER DEFAULT 0);
+        CREATE TABLE questions (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, difficulty TEXT, question_text TEXT,
+                                correct_answer TEXT, explanation TEXT, math_subtopic TEXT DEFAULT NULL,
+                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        INSERT INTO users (chat_id, username, first_name) VALUES (7, 'old', 'Old');
+        INSERT INTO user_preferences (chat_id, topic) VALUES (7, 'Indian History');
+        INSERT INTO questions (topic, difficulty, question_text, correct_answer, explanation)
+            VALUES ('Indian History', 'Easy', 'Who founded the Maurya Empire?', 'A', 'Chandragupta Maurya');
+    ''')
+    conn.close()
+
+    assert bot.init_database() == latest_version(bot)
+    conn = sqlite3.connect(db_path)
+    try:
+        assert conn.execute("SELECT topic, schedule_minutes FROM user_preferences WHERE chat_id = 7").fetchone() == ('Indian History', 30)
+        assert {'content_hash', 'language', 'pair_id', 'key_check'} <= columns(conn, 'questions')
+        assert conn.execute("SELECT question_text FROM questions").fetchall() == [('Who founded the Maurya Empire?',)]
+    finally:
+        conn.close()
+
+def test_partially_migrated_database_resumes(bot, db_path):
+    conn = sqlite3.connect(db_path)
+    conn.isolation_level = None
+    for version, _, migration, _ in bot.SCHEMA_MIGRATIONS[:10]:
+        migration(conn)
+        conn.execute(f'PRAGMA user_version = {version}')
+    conn.close()
+
+    assert bot.init_database() == latest_version(bot)
+    conn = sqlite3.connect(db_path)
+    try:
+        assert 'hedges' in columns(conn, 'cost_rollups')
+    finally:
+        conn.close()
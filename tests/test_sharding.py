@@ -0,0 +1,47 @@
+import pytest
+
+CHAT_IDS = list(range(-60, 60)) + [123456789, 987654321, -1001234567890, -1009876543210]
+
+@pytest.mark.parametrize('worker_count', [1, 2, 3, 30])
+@pytest.mark.parametrize('slot_count', [1, 7, 30])
+def test_each_worker_covers_every_slot(bot, worker_count, slot_count):
+    # Chat ids are split by worker first; the slot must not be correlated with it
+    for worker in range(worker_count):
+        owned = [chat_id for chat_id in range(-3000, 3000) if chat_id % worker_count == worker]
+        assert {bot.schedule_slot(chat_id, slot_count, worker_count) for chat_id in owned} == set(range(slot_count))
+
+def test_single_worker_slots_are_unchanged(bot):
+    for chat_id in CHAT_IDS:
+        assert bot.schedule_slot(chat_id, 30, 1) == chat_id % 30
+
+@pytest.mark.parametrize('worker_count', [1, 2, 3])
+@pytest.mark.parametrize('slot_count', [7, 30])
+def test_get_slot_users_matches_schedule_slot(bot, db_path, worker_count, slot_count):
+    bot.init_database()
+    for chat_id in CHAT_IDS:
+        bot.register_user(chat_id, None, 'Test', None)
+    for slot in range(slot_count):
+        selected = {row[0] for row in bot.get_slot_users(slot, slot_count, worker_count)}
+        assert selected == {chat_id for chat_id in CHAT_IDS if bot.schedule_slot(chat_id, slot_count, worker_count) == slot}
+
+@pytest.mark.parametrize('update, chat_id', [
+    ({'message': {'chat': {'id': -1001234567890}}}, -1001234567890),
+    ({'edited_message': {'chat': {'id': 41}}}, 41),
+    ({'callback_query': {'from': {'id': 7}, 'message': {'chat': {'id': 43}}}}, 43),
+    ({'callback_query': {'from': {'id': 47}}}, 47),
+    ({'poll_answer': {'user': {'id': 53}}}, 53),
+    ({'my_chat_member': {'chat': {'id': -59}}}, -59),
+])
+def test_update_shard_follows_chat_id(bot, update, chat_id):
+    for worker_count in (1, 2, 3, 4):
+        assert bot.update_shard(update, worker_count) == chat_id % worker_count
+
+def test_update_without_chat_goes_to_first_worker(bot):
+    assert bot.update_shard({'update_id': 1}, 4) == 0
+
+def test_owns_chat_agrees_with_router(bot, monkeypatch):
+    monkeypatch.setattr(bot, 'WORKER_COUNT', 3)
+    for worker in range(3):
+        monkeypatch.setattr(bot, 'WORKER_INDEX', worker)
+        for chat_id in CHAT_IDS:
+            assert bot.owns_chat(chat_id) == (bot.update_shard({'message': {'chat': {'id': chat_id}}}, 3) == worker)